@@ -1,20 +1,26 @@
-from urllib.parse import urljoin, urlparse, urldefrag
+from urllib.parse import urljoin, urlparse
 import time
 import requests
 from urllib.robotparser import RobotFileParser
 import asyncio
-from bs4 import BeautifulSoup
-import os
+from typing import Set
+
+from crawler.page_store import PageStore
+from crawler.streaming import DEFAULT_MAX_BYTES, NonHtmlCache, stream_page
 
 class Crawler:
-  def __init__(self, root_url: str, max_pages: int, delay: float, output_dir: str, num_workers: int):
+  def __init__(self, root_url: str, max_pages: int, delay: float, output_dir: str, num_workers: int,
+               max_bytes: int = DEFAULT_MAX_BYTES):
     self.root_url = root_url
     self.max_pages = max_pages
     self.delay = delay
     self.visited = set()
     self.queue = asyncio.Queue()
     self.output_dir = output_dir
+    self.store = PageStore(output_dir)
     self.num_workers = num_workers
+    self.max_bytes = max_bytes
+    self.non_html = NonHtmlCache()
     
     self.visited_lock = asyncio.Lock()
     self.queue_lock = asyncio.Lock()
@@ -24,6 +30,8 @@ class Crawler:
     self.last_request_time = time.time()
 
   async def fetch_page(self, wid: int, url: str):
+    if self.non_html.skip(url):
+      return None
     async with self.visited_lock:
       if url in self.visited:
         return
@@ -43,32 +51,18 @@ class Crawler:
       rp.read()
       if not rp.can_fetch(self.user_agent, url):
         return None
-      response = await asyncio.to_thread(requests.get, url, headers={"User-Agent": self.user_agent})
+      # store the response by digest while it streams in
+      return await asyncio.to_thread(
+          stream_page, requests.get, url, sink=self.store.sink(url),
+          cache=self.non_html, max_bytes=self.max_bytes, tags=["a"],
+          headers={"User-Agent": self.user_agent})
     except Exception as e:
       print(f"Error fetching {url}: {e}")
       return None
-    # dump the response to a file
-    filename = f"{self.output_dir}/{parsed.netloc}/{parsed.path}"
-    if filename.endswith("/"):
-      filename = filename + "index"
-    filename += ".html"
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w") as f:
-      f.write(response.text)
-    return response.text
-    
-  async def parse(self, text: str, base_url: str):
-    # identify the nested pages
-    soup = BeautifulSoup(text, "html.parser")
-    for link in soup.find_all("a"):
-      href = link.get("href")
-      if href is None:
-        continue
-      href = urljoin(base_url, href)
-      href, _ = urldefrag(href)
-      scheme = urlparse(href).scheme
-      if scheme not in ["http", "https"]:
-        continue
+
+  async def parse(self, links: Set[str]):
+    # queue the nested pages
+    for href in links:
       async with self.visited_lock:
         if href in self.visited:
           continue
@@ -85,11 +79,9 @@ class Crawler:
           break
         continue
       try:
-        text = await self.fetch_page(wid, url)
-        parsed = urlparse(url)
-        base_url = f"{parsed.scheme}://{parsed.netloc}"
-        if text is not None:
-          await self.parse(text, base_url)
+        links = await self.fetch_page(wid, url)
+        if links is not None:
+          await self.parse(links)
       finally:
         self.queue.task_done()
     print(f"worker {wid} stopped.")
@@ -1,42 +1,42 @@
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse, urljoin, urldefrag
+from urllib.parse import urlparse, urljoin
 from urllib.robotparser import RobotFileParser
-import os
 import asyncio
 import time
-from typing import List, Set, Tuple
+from typing import List, Optional, Set
 import requests
 
-async def process_url(url: str, agent:str) -> Tuple[str, List[str]]:
-  html_text = ""
+from crawler.page_store import PageStore
+from crawler.streaming import DEFAULT_MAX_BYTES, NonHtmlCache, stream_page
+
+async def process_url(url: str, agent:str, sink,
+                      cache: Optional[NonHtmlCache] = None,
+                      max_bytes: int = DEFAULT_MAX_BYTES) -> List[str]:
   new_urls: List[str] = []
-  # download the text
+  # download the text into sink, extracting other links as it streams
   parsed = urlparse(url)
   rp = RobotFileParser(urljoin(f"{parsed.scheme}://{parsed.netloc}", "robot.txt"))
   rp.read()
   if rp.can_fetch(url, agent):
     try:
-      response = await asyncio.to_thread(requests.get, url, headers = {"User-Agent": agent})
+      links = await asyncio.to_thread(
+          stream_page, requests.get, url, sink = sink,
+          cache = cache, max_bytes = max_bytes, headers = {"User-Agent": agent})
     except Exception as e:
       print(f"Error fetching {url}: {e}")
-      return html_text, new_urls
-    # extract other links
-    html_text = response.text
-    soup = BeautifulSoup(html_text, "html.parser")
-    for field in soup.find_all(["a", "link"]):
-      href = field.get("href")
-      if href and isinstance(href, str):
-        new_url = urljoin(url, href)
-        new_url, _ = urldefrag(new_url)
-        if urlparse(new_url).scheme in ["http", "https"]:
-          new_urls.append(new_url)
-  return html_text, new_urls	
+      return new_urls
+    if links:
+      new_urls.extend(links)
+  return new_urls
 
 
 class Crawler:
-  def __init__(self, root_url: str, output_dir: str):
+  def __init__(self, root_url: str, output_dir: str,
+               max_bytes: int = DEFAULT_MAX_BYTES):
     self.root_url = root_url
     self.output_dir = output_dir
+    self.store = PageStore(output_dir)
+    self.max_bytes = max_bytes
+    self.non_html = NonHtmlCache()
     self.queue = asyncio.Queue()
     self.agent = "Agent for Education"
 
@@ -66,24 +66,15 @@ class Crawler:
       self.last_crawl_time = time.time()
       if self.is_running.is_set():
         continue
+      if self.non_html.skip(url):
+        continue
       try:
-        html_text, new_urls = await process_url(url, agent = self.agent)
+        # stored by digest in the page store by process_url
+        new_urls = await process_url(url, agent = self.agent, sink = self.store.sink(url),
+                                     cache = self.non_html, max_bytes = self.max_bytes)
       except Exception as e:
         print(f"Error processing url: {e}")
         continue
-      parsed = urlparse(url)
-      # save to file
-      filename = f"{self.output_dir}/{parsed.netloc}/{parsed.path}"
-      if filename.endswith("/"):
-        filename += "index"
-      filename += ".html"
-      os.makedirs(os.path.dirname(filename), exist_ok = True)
-      try:
-        with open(filename, "w") as f:
-          f.write(html_text)
-      except Exception as e:
-        print(f"Error writing file to {filename}: {e}")
-        pass
       async with self.visited_lock:
         self.visited.add(url)
         for x in new_urls:
@@ -11,13 +11,15 @@ from urllib.parse import urlparse, urljoin, urldefrag
 from collections import deque
 from typing import Set, Dict, Optional
 import requests
-from bs4 import BeautifulSoup
 import threading
 import queue
 
+from crawler.streaming import DEFAULT_MAX_BYTES, NonHtmlCache, stream_page
+
 
 class WebCrawler:
-    def __init__(self, seed_url: str, output_dir: str = "crawled_links", delay: float = 1.0):
+    def __init__(self, seed_url: str, output_dir: str = "crawled_links", delay: float = 1.0,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
         """
         Initialize the web crawler.
         
@@ -25,10 +27,13 @@ class WebCrawler:
             seed_url: The starting URL to crawl
             output_dir: Directory to save crawled links
             delay: Delay between requests in seconds (polite crawling)
+            max_bytes: Pages larger than this are abandoned mid-download
         """
         self.seed_url = seed_url
         self.output_dir = output_dir
         self.delay = delay
+        self.max_bytes = max_bytes
+        self.non_html = NonHtmlCache()
         
         parsed = urlparse(seed_url)
         self.domain = parsed.netloc
@@ -82,17 +87,20 @@ class WebCrawler:
                 time.sleep(self.delay - elapsed)
             self.last_request_time = time.time()
     
-    def fetch_page(self, url: str) -> Optional[str]:
-        """Fetch page content with error handling."""
+    def fetch_page(self, url: str) -> Optional[Set[str]]:
+        """Stream page content and extract its links, with error handling.
+
+        Returns None for failed requests, non-HTML content and oversized pages.
+        """
         session = requests.Session()
         session.headers.update({
             'User-Agent': 'WebCrawler/1.0 (Educational Purpose; +https://example.com/bot)'
         })
         
         try:
-            response = session.get(url, timeout=10, allow_redirects=True)
-            response.raise_for_status()
-            return response.text
+            return stream_page(session.get, url, cache=self.non_html,
+                               max_bytes=self.max_bytes, raise_for_status=True,
+                               timeout=10, allow_redirects=True)
         except requests.exceptions.Timeout:
             print(f"⏱️  Timeout: {url}")
             return None
@@ -103,26 +111,6 @@ class WebCrawler:
             print(f"❌ Request failed: {url} - {str(e)}")
             return None
     
-    def extract_links(self, html: str, page_url: str) -> Set[str]:
-        """Extract all links from HTML content."""
-        links = set()
-        
-        try:
-            soup = BeautifulSoup(html, 'html.parser')
-            
-            for tag in soup.find_all(['a', 'link']):
-                href = tag.get('href')
-                if not href or not isinstance(href, str):
-                    continue
-                
-                normalized = self.normalize_url(href, page_url)
-                if normalized:
-                    links.add(normalized)
-        except Exception as e:
-            print(f"⚠️  Error parsing HTML from {page_url}: {str(e)}")
-        
-        return links
-    
     def worker(self, worker_id: int, max_pages: int):
         """Worker thread that processes URLs from the queue."""
         while True:
@@ -133,6 +121,10 @@ class WebCrawler:
                     break
                 continue
             
+            if self.non_html.skip(url):
+                self.to_visit.task_done()
+                continue
+            
             with self.visited_lock:
                 should_stop = self.pages_crawled >= max_pages
                 already_visited = url in self.visited
@@ -154,14 +146,12 @@ class WebCrawler:
             print(f"\n[Worker-{worker_id}] [{current_page}/{max_pages}] Crawling: {url}")
             
             self.wait_for_rate_limit()
-            html = self.fetch_page(url)
+            links = self.fetch_page(url)
             
-            if not html:
+            if links is None:
                 self.to_visit.task_done()
                 continue
             
-            links = self.extract_links(html, url)
-            
             internal_links = 0
             external_links = 0
             
@@ -277,10 +267,10 @@ def main():
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
-  python crawler.py https://example.com
-  python crawler.py https://example.com --max-pages 50 --delay 0.5
-  python crawler.py https://example.com --workers 4
-  python crawler.py https://blog.example.com --output my_crawl_results --workers 3
+  python -m crawler.crawler https://example.com
+  python -m crawler.crawler https://example.com --max-pages 50 --delay 0.5
+  python -m crawler.crawler https://example.com --workers 4
+  python -m crawler.crawler https://blog.example.com --output my_crawl_results --workers 3
         """
     )
     
@@ -309,6 +299,13 @@ Examples:
         help='Output directory for crawled links (default: crawled_links)'
     )
     
+    parser.add_argument(
+        '--max-bytes',
+        type=int,
+        default=DEFAULT_MAX_BYTES,
+        help=f'Abandon pages larger than this many bytes (default: {DEFAULT_MAX_BYTES})'
+    )
+    
     parser.add_argument(
         '--workers',
         type=int,
@@ -325,7 +322,8 @@ Examples:
     crawler = WebCrawler(
         seed_url=args.seed_url,
         output_dir=args.output,
-        delay=args.delay
+        delay=args.delay,
+        max_bytes=args.max_bytes
     )
     
     try:
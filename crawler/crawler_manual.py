@@ -1,50 +1,31 @@
-from bs4 import BeautifulSoup
 from typing import Set
-from urllib.parse import urljoin, urldefrag, urlparse
+from urllib.parse import urljoin, urlparse
 from urllib.robotparser import RobotFileParser
 import requests
-import os
 import time
 import queue
 import threading
 
+from crawler.page_store import PageStore
+from crawler.streaming import (DEFAULT_MAX_BYTES, LinkParser, NonHtmlCache,
+                               stream_page)
+
 
 def get_outbound_links(text: str, base_url: str) -> Set[str]:
-  ret: Set[str] = set()
+  parser = LinkParser(base_url, ["a", "link"])
   try:
-    soup = BeautifulSoup(text, "html.parser")
-    for tag in soup.find_all(["a", "link"]):
-      href = tag.get("href")
-      if not href or not isinstance(href, str):
-        continue
-      url = urljoin(base_url, href)
-      url = urldefrag(url).url
-      parsed = urlparse(url)
-      if parsed.scheme in {"http", "https"}:
-        ret.add(url)
-
+    parser.feed(text)
+    parser.close()
   except Exception as e:
     print(f"Error parsing HTML: {str(e)}")
-    return ret
-  return ret
-
-
-def construct_filepath(output_dir: str, domain: str, path: str) -> str:
-  filepath = os.path.join(output_dir, domain, path.lstrip("/"))
-  if path == "" or path.endswith("/"):
-    filepath += "index"
-  filepath = filepath + ".html"
-  try:
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-  except Exception as e:
-    pass
-  return filepath
+  return parser.links
 
 
 class Crawler:
 
   def __init__(self, seed_url: str, delay: float, output_dir: str,
-               max_pages: int, num_workers: int):
+               max_pages: int, num_workers: int,
+               max_bytes: int = DEFAULT_MAX_BYTES):
     self.seed_url = seed_url
     self.session = requests.Session()
     self.visited_url: Set[str] = set()
@@ -52,11 +33,13 @@ class Crawler:
     self.queue.put(seed_url)
     self.max_pages = max_pages
     self.output_dir = output_dir
-    if not os.path.exists(output_dir):
-      os.makedirs(output_dir)
+    # pages are stored once per distinct body; see crawler.page_store
+    self.store = PageStore(output_dir)
     self.agent = "WebCrawler/1.0 Educational Purpose"
     self.delay = delay
     self.num_workers = num_workers
+    self.max_bytes = max_bytes
+    self.non_html = NonHtmlCache()
     self.last_request_time = time.time()
     self.finish_crawl = threading.Event()
 
@@ -65,16 +48,20 @@ class Crawler:
     self.rate_limit_lock = threading.Lock()
 
   def fetch_page(self, url: str):
-    outbound_links: Set[str] = set()
     try:
       with self.rate_limit_lock:
         elapsed = time.time() - self.last_request_time
         if elapsed < self.delay:
           time.sleep(self.delay - elapsed)
           self.last_request_time = time.time()
-      response = self.session.get(url, timeout=10, allow_redirects=True)
-      text = response.text
-      outbound_links = get_outbound_links(text, url)
+      # the body is hashed into the page store and parsed as it streams in
+      outbound_links = stream_page(self.session.get, url,
+                                   sink=self.store.sink(url),
+                                   cache=self.non_html,
+                                   max_bytes=self.max_bytes,
+                                   timeout=10, allow_redirects=True)
+      if outbound_links is None:
+        return
       with self.visited_lock:
         outbound_links = outbound_links - self.visited_url
         with self.queue_lock:
@@ -82,12 +69,6 @@ class Crawler:
             if not self.finish_crawl.is_set():
               print(f"thread {threading.current_thread().name} put {link}")
               self.queue.put(link)
-      # write to file
-      parsed = urlparse(url)
-      filepath = construct_filepath(self.output_dir, parsed.netloc,
-                                    parsed.path)
-      with open(filepath, "w") as f:
-        f.write(text)
     except Exception as e:
       print(f"Error fetching page {str(url)}: {str(e)}")
 
@@ -0,0 +1,140 @@
+"""Content-addressed storage for crawled pages.
+
+Bodies are hashed while they stream in and stored once, under their
+digest, however many URLs serve them (mirrors, printer-friendly copies,
+tracking-parameter variants):
+
+  <root>/objects/<first 2 hex digits>/<rest of digest>
+  <root>/manifest.jsonl   one {"url", "digest", "size", "time"} line per fetch
+
+Bodies up to SPOOL_SIZE are held in memory and a duplicate is dropped
+without touching the disk; larger ones spill to a temporary file in the
+store, which is renamed into place or removed on commit. The manifest is
+append-only; the last line for a URL wins.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+SPOOL_SIZE = 1024 * 1024
+MANIFEST = "manifest.jsonl"
+
+
+class StoredPage:
+  """A sink for streaming.stream_page (write/commit/abort) that files the
+  body under its digest."""
+
+  def __init__(self, store: "PageStore", url: str):
+    self.store = store
+    self.url = url
+    self.hashfunc = hashlib.sha256()
+    self.buf = bytearray()
+    self.size = 0
+    self.f = None
+    self.tmp_path: Optional[str] = None
+    self.digest: Optional[str] = None
+
+  def write(self, chunk: bytes):
+    self.hashfunc.update(chunk)
+    self.size += len(chunk)
+    if self.f is not None:
+      self.f.write(chunk)
+      return
+    self.buf += chunk
+    if len(self.buf) > SPOOL_SIZE:
+      self.tmp_path = self.store.tmp_path()
+      self.f = open(self.tmp_path, "wb")
+      self.f.write(self.buf)
+      self.buf = bytearray()
+
+  def commit(self):
+    self.digest = self.hashfunc.hexdigest()
+    if self.f is not None:
+      self.f.close()
+    self.store.add(self.url, self.digest, self.size, self.tmp_path,
+                   bytes(self.buf))
+    self.buf = bytearray()
+
+  def abort(self):
+    if self.f is not None:
+      self.f.close()
+      try:
+        os.remove(self.tmp_path)
+      except OSError:
+        pass
+    self.buf = bytearray()
+
+
+class PageStore:
+
+  def __init__(self, root_dir: str):
+    self.root_dir = root_dir
+    self.objects_dir = os.path.join(root_dir, "objects")
+    self.tmp_dir = os.path.join(root_dir, "tmp")
+    os.makedirs(self.objects_dir, exist_ok=True)
+    os.makedirs(self.tmp_dir, exist_ok=True)
+    # url -> digest
+    self.manifest: Dict[str, str] = {}
+    self.stored_bytes = 0
+    self.duplicate_bytes = 0
+    self.lock = threading.Lock()
+    self.manifest_path = os.path.join(root_dir, MANIFEST)
+    if os.path.exists(self.manifest_path):
+      with open(self.manifest_path) as f:
+        for line in f:
+          try:
+            rec = json.loads(line)
+          except ValueError:
+            # a torn last line from a crash
+            continue
+          self.manifest[rec["url"]] = rec["digest"]
+    self.manifest_file = open(self.manifest_path, "a")
+
+  def sink(self, url: str) -> StoredPage:
+    return StoredPage(self, url)
+
+  def tmp_path(self) -> str:
+    return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.part")
+
+  def object_path(self, digest: str) -> str:
+    return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+  def add(self, url: str, digest: str, size: int, tmp_path: Optional[str],
+          body: bytes):
+    # body is used when the page never spilled to tmp_path
+    path = self.object_path(digest)
+    with self.lock:
+      if os.path.exists(path):
+        self.duplicate_bytes += size
+        if tmp_path is not None:
+          os.remove(tmp_path)
+      else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if tmp_path is None:
+          tmp_path = self.tmp_path()
+          with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        self.stored_bytes += size
+      self.manifest[url] = digest
+      self.manifest_file.write(json.dumps(
+          {"url": url, "digest": digest, "size": size, "time": time.time()}) + "\n")
+      self.manifest_file.flush()
+
+  def lookup(self, url: str) -> Optional[str]:
+    """Path of the body stored for url, if it was fetched."""
+    with self.lock:
+      digest = self.manifest.get(url)
+    return self.object_path(digest) if digest else None
+
+  def urls(self, digest: str) -> List[str]:
+    with self.lock:
+      return sorted(u for u, d in self.manifest.items() if d == digest)
+
+  def close(self):
+    with self.lock:
+      self.manifest_file.close()
@@ -0,0 +1,156 @@
+"""Streaming page fetch: response bytes are fed to an incremental link parser
+as they arrive instead of buffering and decoding the whole body first."""
+import codecs
+import posixpath
+import threading
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+from urllib.parse import urldefrag, urljoin, urlparse
+
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024
+HTML_TYPES = {"text/html", "application/xhtml+xml"}
+# extensions of server-rendered pages, never remembered as non-HTML
+HTML_EXTENSIONS = {".html", ".htm", ".xhtml", ".shtml", ".php", ".asp",
+                   ".aspx", ".jsp", ".cgi"}
+# non-HTML responses needed before a pattern is skipped
+NON_HTML_MIN_HITS = 3
+# (host, directory or path, extension)
+Pattern = Tuple[str, str, str]
+
+
+class LinkParser(HTMLParser):
+  """Collects absolute http(s) hrefs from the given tags, fed incrementally."""
+
+  def __init__(self, base_url: str, tags: Iterable[str] = ("a", "link")):
+    super().__init__(convert_charrefs=True)
+    self.base_url = base_url
+    self.tags = set(tags)
+    self.links: Set[str] = set()
+
+  def handle_starttag(self, tag, attrs):
+    if tag not in self.tags:
+      return
+    for name, value in attrs:
+      if name != "href" or not value:
+        continue
+      url = urldefrag(urljoin(self.base_url, value)).url
+      if urlparse(url).scheme in ("http", "https"):
+        self.links.add(url)
+
+
+class NonHtmlCache:
+  """Per-host memory of URL patterns that served non-HTML, so later links
+  matching them are skipped without a request.
+
+  A pattern is the directory plus file extension of the path, or, for URLs
+  with a query string, the path itself (`export?id=1`, `export?id=2`, ...).
+  It is skipped only after `min_hits` non-HTML responses and as long as no
+  URL matching it served HTML. Extensions that usually name pages are never
+  remembered.
+  """
+
+  def __init__(self, min_hits: int = NON_HTML_MIN_HITS):
+    self.min_hits = min_hits
+    # pattern -> non-HTML responses seen
+    self.hits: Dict[Pattern, int] = {}
+    # patterns that served HTML at least once
+    self.html: Set[Pattern] = set()
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def pattern(url: str) -> Optional[Pattern]:
+    parts = urlparse(url)
+    path = parts.path or "/"
+    directory, name = posixpath.split(path)
+    ext = posixpath.splitext(name)[1].lower()
+    if ext in HTML_EXTENSIONS:
+      return None
+    if parts.query:
+      return parts.netloc, path, "?"
+    return parts.netloc, directory, ext
+
+  def record(self, url: str, html: bool = False):
+    key = self.pattern(url)
+    if key is None:
+      return
+    with self.lock:
+      if html:
+        self.html.add(key)
+        self.hits.pop(key, None)
+      elif key not in self.html:
+        self.hits[key] = self.hits.get(key, 0) + 1
+
+  def skip(self, url: str) -> bool:
+    key = self.pattern(url)
+    if key is None:
+      return False
+    with self.lock:
+      return self.hits.get(key, 0) >= self.min_hits
+
+
+def _charset(params: str) -> str:
+  for param in params.split(";"):
+    name, _, value = param.partition("=")
+    if name.strip().lower() == "charset" and value:
+      try:
+        return codecs.lookup(value.strip().strip('"\'')).name
+      except LookupError:
+        break
+  return "utf-8"
+
+
+def stream_page(get: Callable, url: str, sink=None,
+                cache: Optional[NonHtmlCache] = None,
+                max_bytes: int = DEFAULT_MAX_BYTES,
+                tags: Iterable[str] = ("a", "link"),
+                base_url: Optional[str] = None,
+                raise_for_status: bool = False,
+                **kwargs) -> Optional[Set[str]]:
+  """Fetch `url` with `get` (e.g. `requests.get` or `session.get`) and return
+  the links found in it, or None if the page was skipped.
+
+  Non-HTML responses are abandoned after the headers and remembered in
+  `cache`; bodies larger than `max_bytes` are abandoned as soon as the limit
+  is crossed. Raw bytes are passed to `sink` (write/commit/abort) if given.
+  Request errors propagate to the caller.
+  """
+  if cache is not None and cache.skip(url):
+    return None
+  response = get(url, stream=True, **kwargs)
+  with response:
+    if raise_for_status:
+      response.raise_for_status()
+    content_type = response.headers.get("Content-Type", "")
+    mime, _, params = content_type.partition(";")
+    is_html = not content_type or mime.strip().lower() in HTML_TYPES
+    if cache is not None:
+      cache.record(url, html=is_html)
+    if not is_html:
+      return None
+    length = response.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > max_bytes:
+      return None
+
+    decoder = codecs.getincrementaldecoder(_charset(params))(errors="replace")
+    parser = LinkParser(base_url or url, tags)
+    received = 0
+    try:
+      for chunk in response.iter_content(CHUNK_SIZE):
+        received += len(chunk)
+        if received > max_bytes:
+          if sink is not None:
+            sink.abort()
+          return None
+        if sink is not None:
+          sink.write(chunk)
+        parser.feed(decoder.decode(chunk))
+      parser.feed(decoder.decode(b"", final=True))
+      parser.close()
+    except BaseException:
+      if sink is not None:
+        sink.abort()
+      raise
+    if sink is not None:
+      sink.commit()
+    return parser.links
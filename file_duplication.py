@@ -1,77 +1,145 @@
-import queue
-import os
-import threading
-from typing import Dict, Tuple, Set
-import hashlib
+import argparse
+from typing import Dict, Iterator, List, Optional, Tuple, Set
+
+from filededup.chunking import ChunkIndex, index_paths
+from filededup.external import external_duplicates
+from filededup.hash_engine import HashEngine
+from filededup.hashing import DEFAULT_ALGO, staged_duplicates
+from filededup.io_scheduler import DEFAULT_PER_DEVICE, IoScheduler
+from filededup.walker import walk
 
 class FileDuplication:
-    def __init__(self, root_dir: str):
-        self.root_dir = str
-        self.all_dirs = queue.Queue()
-        self.all_dirs.put(root_dir)
-        self.map: Dict[Tuple[int, int], Set[str]] = {}
-        self.map_lock = threading.Lock()
-        self.queue_lock = threading.Lock()
+    def __init__(self, root_dir: str, io_order: Optional[str] = None,
+                 per_device: int = DEFAULT_PER_DEVICE):
+        self.root_dir = root_dir
+        # hash in on-disk order (see filededup.io_scheduler); applies to
+        # the engines created here, not to one passed in
+        self.io_order = io_order
+        self.per_device = per_device
+        # size -> paths, filled during traversal; only collisions get hashed
+        self.sizes: Dict[int, List[str]] = {}
+        # (dev, inode) -> paths, for files with more than one link; only the
+        # first path goes into sizes, so each inode is hashed once
+        self.links: Dict[Tuple[int, int], List[str]] = {}
+        # the groups and the bytes held by the extra copies in each (hardlinks
+        # count for nothing, since they share their data); filled by
+        # in-memory runs only
+        self.map: Dict[Tuple[int, str], Set[str]] = {}
+        self.wasted: Dict[Tuple[int, str], int] = {}
 
-    def process_dir(self, dir: str):
-        files = [f for f in os.listdir(dir) if os.path.isfile(os.path.join(dir, f))]
-        file_stats: Dict[Tuple[int, int], Set[str]] = {}
-        for f in files:
-            f = f"{dir}/{f}"
-            size = os.path.getsize(f)
-            rsum = self.rsum(f)
-            if (size, rsum) not in file_stats:
-                file_stats[(size, rsum)] = set()
-            file_stats[(size, rsum)].add(f"{dir}/{f}")
-        return file_stats     
+    def _engine(self, num_workers: Optional[int] = None) -> HashEngine:
+        io = (IoScheduler(self.io_order, self.per_device)
+              if self.io_order else None)
+        return HashEngine(num_workers, io=io)
 
-    def rsum(self, fname:str):
-        ret = 0
-        with open(fname, 'rb') as f:
-            while chunk := f.read(8192):
-                hashfunc = hashlib.new("sha256")
-                hashfunc.update(chunk)
-                hashval = hashfunc.hexdigest()
-                ret += int(hashval, 16)
-        return ret
+    def _walk(self, num_workers: int,
+              first_link: Dict[str, Tuple[int, int]]) -> Iterator[Tuple[str, int]]:
+        # (path, size) with one path per inode; the other links are
+        # remembered in self.links
+        for entry in walk(self.root_dir, num_workers):
+            if entry.nlink > 1:
+                paths = self.links.setdefault((entry.dev, entry.ino), [])
+                paths.append(entry.path)
+                if len(paths) > 1:
+                    continue
+                first_link[entry.path] = (entry.dev, entry.ino)
+            yield entry.path, entry.size
 
-    def worker(self):
-        while True:
-            try:
-                with self.queue_lock:
-                    dir = self.all_dirs.get(block=False)
-                    child_dirs = [f"{dir}/{d}" for d in os.listdir(dir) if os.path.isdir(os.path.join(dir, d))]
-                    for d in child_dirs:
-                        self.all_dirs.put(d)
-            except queue.Empty:
-                print(f"{threading.current_thread().name} is done")
-                break
-            print(f"{threading.current_thread().name} is processing {dir}")
-            file_stats = self.process_dir(dir)
-            print(f"{threading.current_thread().name} processed {dir}")
-            with self.map_lock:
-                for k, v in file_stats.items():
-                    if k not in self.map:
-                        self.map[k] = v
-                    else:
-                        self.map[k] = self.map[k].union(v)
+    def iter_groups(self, num_workers: int, engine: Optional[HashEngine] = None,
+                    algo: str = DEFAULT_ALGO, max_memory: Optional[int] = None,
+                    tmp_dir: Optional[str] = None
+                    ) -> Iterator[Tuple[Tuple[int, str], Set[str], int]]:
+        """Yields duplicate groups as ((size, digest), paths, wasted bytes);
+        see run(). Each call starts over from an empty state.
 
-    def run(self, num_workers: int):
-        threads = []
-        for _ in range(num_workers):
-            t = threading.Thread(target = self.worker)
-            threads.append(t)
-            t.start()
-        for t in threads:
-            t.join()
-            print(f"{t.name} joined")
+        With max_memory (bytes), grouping runs out of core on sorted run
+        files under tmp_dir (see filededup.external), and `sizes` and
+        `wasted` are left empty so memory does not grow with the number of
+        groups; the groups are the same as in memory.
+        """
+        self.sizes = {}
+        self.links = {}
+        self.map = {}
+        self.wasted = {}
+        own_engine = engine is None
+        if own_engine:
+            engine = self._engine(num_workers)
+        try:
+            first_link: Dict[str, Tuple[int, int]] = {}
+            files = self._walk(num_workers, first_link)
+            if max_memory is None:
+                for path, size in files:
+                    self.sizes.setdefault(size, []).append(path)
+                groups = staged_duplicates(self.sizes, engine, algo).items()
+            else:
+                groups = external_duplicates(files, engine, algo, max_memory,
+                                             tmp_dir)
+            for (size, digest), paths in groups:
+                paths = set(paths)
+                wasted = size * (len(paths) - 1)
+                if max_memory is None:
+                    self.wasted[(size, digest)] = wasted
+                for path in list(paths):
+                    if path in first_link:
+                        paths.update(self.links[first_link[path]])
+                yield (size, digest), paths, wasted
+        finally:
+            if own_engine:
+                engine.shutdown()
 
-        return self.map
+    def run(self, num_workers: int, engine: Optional[HashEngine] = None,
+            algo: str = DEFAULT_ALGO, max_memory: Optional[int] = None,
+            tmp_dir: Optional[str] = None):
+        """Returns duplicate groups keyed by (size, digest); see
+        filededup.hashing for the available algorithms.
 
-if __name__ == "__main__":
-    fd = FileDuplication("output")
-    dups = fd.run(2)
-    for v in dups.values():
-        print(" ".join(v))
+        The tree is traversed by num_workers threads (see filededup.walker)
+        and hashing runs on `engine`, by default a pool of num_workers
+        threads. Hardlinked paths are hashed once and listed with their
+        group; a group made only of links to one file is not reported.
+        Pass max_memory to group out of core (see iter_groups); the groups
+        are still collected into the returned dict, so iterate iter_groups
+        instead to stay within the ceiling.
+        """
+        groups = {key: paths for key, paths, _ in self.iter_groups(
+            num_workers, engine, algo, max_memory, tmp_dir)}
+        if max_memory is None:
+            self.map = groups
+        return groups
 
+    def chunk_index(self, engine: Optional[HashEngine] = None,
+                    algo: str = DEFAULT_ALGO) -> ChunkIndex:
+        """Chunk every file found by an in-memory run() (one path per
+        inode) for a block-level report; see filededup.chunking."""
+        own_engine = engine is None
+        if own_engine:
+            engine = self._engine()
+        jobs = [(path, size) for size, paths in self.sizes.items()
+                for path in paths]
+        try:
+            return index_paths(jobs, engine, algo)
+        finally:
+            if own_engine:
+                engine.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="report duplicate files under a directory")
+    parser.add_argument("root", nargs="?", default="output")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-memory", type=int,
+                        help="group out of core, buffering at most this many "
+                             "bytes of records")
+    parser.add_argument("--tmp-dir", help="directory for the run files")
+    args = parser.parse_args()
+    fd = FileDuplication(args.root)
+    # groups are printed as they are found
+    for _, paths, wasted in fd.iter_groups(args.workers,
+                                           max_memory=args.max_memory,
+                                           tmp_dir=args.tmp_dir):
+        print(f"{wasted} bytes wasted: " + " ".join(paths))
+    if args.max_memory is None:
+        report = fd.chunk_index().report()
+        print(f"{report['reclaimable_bytes']} of {report['total_bytes']} "
+              "bytes reclaimable by block-level dedup")
 
@@ -0,0 +1,398 @@
+"""End-to-end benchmark of the dedup scanners and client/server pairs.
+
+A reproducible tree is generated from a seed, with these knobs:
+- file count;
+- a lognormal size distribution;
+- the share of whole-file copies, partial copies and hardlinks;
+- directory depth.
+
+A partial copy is an earlier file with a block in the middle changed, so
+it has the same size and edges as the original and only a full hash can
+tell the two apart. Each case then runs in a fresh subprocess against the
+same tree:
+
+  file_duplication           FileDuplication.run
+  file_duplication_external  FileDuplication.run with --max-memory
+  filedup_asyncio            FileDedup.scan_local
+  client                     filededup.client.scan_local
+  client_v2                  filededup.client_v2.scan_dir
+  stream_pair                scan_local, sync and a duplicates query against
+                             a StreamServer on localhost
+  http_pair                  scan_dir, /sync and GET /duplicates against
+                             filededup.server on localhost (needs Flask)
+
+For every case the benchmark reports:
+- files/s and MB/s over the whole tree;
+- read/write-class syscalls per file (syscr + syscw from /proc/self/io);
+- peak RSS;
+- time until the duplicate groups are available (from the server, for the
+  pairs);
+- the number of groups found, checked against the number generated.
+
+Hash caches start empty, so every file is hashed. The tree has just been
+written and is in the page cache unless --drop-caches is given (root
+only). With --io-order, the engines that the cases build themselves get
+an IoScheduler. The pairs run the server in the same process, so their
+RSS covers both sides.
+
+  python -m filededup.benchmark --files 20000 --json bench.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional
+
+from filededup.walker import DEFAULT_THREADS
+
+CASES = ("file_duplication", "file_duplication_external", "filedup_asyncio",
+         "client", "client_v2", "stream_pair", "http_pair")
+MIN_FILE_SIZE = 16
+# bytes replaced in the middle of a partial copy
+PARTIAL_BLOCK = 64
+
+
+class TreeSpec(NamedTuple):
+  files: int = 10000
+  median_kb: float = 16.0
+  sigma: float = 1.5
+  max_mb: float = 64.0
+  dup_ratio: float = 0.3
+  partial_ratio: float = 0.05
+  hardlink_ratio: float = 0.02
+  depth: int = 3
+  fanout: int = 8
+  seed: int = 0
+
+
+def _content(seed: int, size: int) -> bytearray:
+  return bytearray(random.Random(seed).randbytes(size))
+
+
+def generate_tree(root_dir: str, spec: TreeSpec) -> dict:
+  """Write the tree described by spec under root_dir and return what was
+  generated, including the number of duplicate groups to expect."""
+  rng = random.Random(spec.seed)
+  max_size = int(spec.max_mb * 1024 * 1024)
+  mu = math.log(spec.median_kb * 1024)
+  # (content seed, size) of files that may be copied
+  originals: List[tuple] = []
+  copies: Counter = Counter()
+  written: List[str] = []
+  total = 0
+  links = 0
+  for i in range(spec.files):
+    dirs = [f"d{rng.randrange(spec.fanout)}" for _ in range(spec.depth)]
+    dir_path = os.path.join(root_dir, *dirs)
+    os.makedirs(dir_path, exist_ok=True)
+    path = os.path.join(dir_path, f"f{i}.bin")
+    r = rng.random()
+    if written and r < spec.hardlink_ratio:
+      os.link(rng.choice(written), path)
+      links += 1
+      continue
+    r -= spec.hardlink_ratio
+    if originals and r < spec.dup_ratio + spec.partial_ratio:
+      j = rng.randrange(len(originals))
+      data = _content(*originals[j])
+      if r < spec.dup_ratio or len(data) <= PARTIAL_BLOCK:
+        copies[j] += 1
+      else:
+        mid = len(data) // 2
+        data[mid:mid + PARTIAL_BLOCK] = rng.randbytes(PARTIAL_BLOCK)
+    else:
+      size = min(max(int(rng.lognormvariate(mu, spec.sigma)), MIN_FILE_SIZE),
+                 max_size)
+      originals.append((rng.getrandbits(64), size))
+      data = _content(*originals[-1])
+    with open(path, "wb") as f:
+      f.write(data)
+    written.append(path)
+    total += len(data)
+  return {
+      **spec._asdict(),
+      "paths": spec.files,
+      "inodes": len(written),
+      "hardlinks": links,
+      "bytes": total,
+      "duplicate_groups": len(copies),
+  }
+
+
+def _groups(files: Dict[str, str]) -> int:
+  # files: path -> key with one path per inode, as from scanner.file_keys
+  return sum(1 for n in Counter(files.values()).values() if n > 1)
+
+
+def _free_port() -> int:
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+
+def _engine(args):
+  from filededup.hash_engine import HashEngine
+  from filededup.io_scheduler import IoScheduler
+  return HashEngine(args.workers,
+                    io=IoScheduler(args.io_order) if args.io_order else None)
+
+
+def _case_file_duplication(root: str, work: str, args) -> int:
+  from file_duplication import FileDuplication
+  max_memory = args.max_memory if args.case.endswith("external") else None
+  engine = _engine(args)
+  try:
+    # counted as they stream out, so the external case stays in its ceiling
+    return sum(1 for _ in FileDuplication(root).iter_groups(
+        args.workers, engine, max_memory=max_memory, tmp_dir=work))
+  finally:
+    engine.shutdown()
+
+
+def _case_filedup_asyncio(root: str, work: str, args) -> int:
+  from filedup_asyncio import FileDedup
+  from filededup.scanner import file_keys
+  dedup = FileDedup(root, False, "localhost", 0, 0,
+                    cache_path=os.path.join(work, "cache.sqlite"))
+  return _groups(file_keys(asyncio.run(dedup.scan_local())))
+
+
+def _case_client(root: str, work: str, args) -> int:
+  from filededup import client
+  from filededup.scanner import file_keys
+  client.root_dir = root
+  client.cache_path = os.path.join(work, "cache.sqlite")
+  return _groups(file_keys(asyncio.run(client.scan_local())))
+
+
+def _case_client_v2(root: str, work: str, args) -> int:
+  from filededup.client_v2 import scan_dir
+  from filededup.hash_cache import HashCache
+  cache = HashCache(os.path.join(work, "cache.sqlite"))
+  engine = _engine(args)
+  try:
+    return _groups(asyncio.run(scan_dir(root, cache, engine)))
+  finally:
+    engine.shutdown()
+
+
+def _case_stream_pair(root: str, work: str, args) -> int:
+  from filedup_asyncio import FileDedup
+  from filededup import wire
+  from filededup.index import FileIndex
+  from filededup.scanner import file_keys
+  from filededup.stream_server import StreamServer
+  from filededup.sync import SyncClient
+
+  async def run():
+    port = _free_port()
+    server = await asyncio.start_server(StreamServer(FileIndex()).handle,
+                                        "127.0.0.1", port)
+    dedup = FileDedup(root, False, "127.0.0.1", port, 1,
+                      cache_path=os.path.join(work, "cache.sqlite"))
+    async with server:
+      files = file_keys(await dedup.scan_local())
+      reader, writer = await asyncio.open_connection("127.0.0.1", port)
+      sync = SyncClient("bench")
+      sync.handle_reply(await wire.send_sync(reader, writer, sync.delta(files),
+                                             "gzip"))
+      reply = await wire.query(reader, writer, {"op": "duplicates", "limit": 0})
+      writer.close()
+      return reply["total"]
+
+  return asyncio.run(run())
+
+
+def _case_http_pair(root: str, work: str, args) -> int:
+  import requests
+  from werkzeug.serving import make_server
+  # the server module opens its SQLite file relative to the working dir
+  from filededup import server
+  from filededup.client_v2 import scan_dir
+  from filededup.hash_cache import HashCache
+  from filededup.sync import SyncClient
+
+  port = _free_port()
+  httpd = make_server("127.0.0.1", port, server.app, threaded=True)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  engine = _engine(args)
+  try:
+    files = asyncio.run(scan_dir(root, HashCache(os.path.join(work, "cache.sqlite")),
+                                 engine))
+    url = f"http://127.0.0.1:{port}"
+    with requests.Session() as session:
+      SyncClient("bench").push(
+          files, lambda msg: session.post(f"{url}/sync", json=msg).json())
+      return session.get(f"{url}/duplicates", params={"limit": 0}).json()["total"]
+  finally:
+    engine.shutdown()
+    httpd.shutdown()
+
+
+_RUNNERS = {
+    "file_duplication": _case_file_duplication,
+    "file_duplication_external": _case_file_duplication,
+    "filedup_asyncio": _case_filedup_asyncio,
+    "client": _case_client,
+    "client_v2": _case_client_v2,
+    "stream_pair": _case_stream_pair,
+    "http_pair": _case_http_pair,
+}
+
+
+def _io_syscalls() -> Optional[int]:
+  try:
+    with open("/proc/self/io") as f:
+      counters = dict(line.split(": ") for line in f.read().splitlines())
+  except OSError:
+    return None
+  return int(counters["syscr"]) + int(counters["syscw"])
+
+
+def run_case(args) -> dict:
+  # runs in the child process
+  before = _io_syscalls()
+  start = time.perf_counter()
+  groups = _RUNNERS[args.case](args.tree, args.work, args)
+  elapsed = time.perf_counter() - start
+  after = _io_syscalls()
+  return {
+      "case": args.case,
+      "seconds": elapsed,
+      "groups": groups,
+      "syscalls": after - before if before is not None else None,
+      # KB on Linux
+      "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+  }
+
+
+def _drop_caches():
+  os.sync()
+  with open("/proc/sys/vm/drop_caches", "w") as f:
+    f.write("3")
+
+
+def run(work_dir: str, spec: TreeSpec, cases: List[str], workers: int,
+        max_memory: int, drop_caches: bool = False,
+        io_order: Optional[str] = None) -> dict:
+  root = os.path.join(work_dir, "tree")
+  start = time.perf_counter()
+  tree = generate_tree(root, spec)
+  tree["generate_seconds"] = round(time.perf_counter() - start, 3)
+  repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  env = dict(os.environ)
+  env["PYTHONPATH"] = os.pathsep.join(
+      p for p in (repo_dir, env.get("PYTHONPATH")) if p)
+  results = []
+  for case in cases:
+    case_dir = tempfile.mkdtemp(prefix=f"{case}-", dir=work_dir)
+    result_path = os.path.join(case_dir, "result.json")
+    if drop_caches:
+      _drop_caches()
+    proc = subprocess.run(
+        [sys.executable, "-m", "filededup.benchmark", "--case", case,
+         "--tree", root, "--work", case_dir, "--result", result_path,
+         "--workers", str(workers), "--max-memory", str(max_memory)]
+        + (["--io-order", io_order] if io_order else []),
+        cwd=case_dir, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0 or not os.path.exists(result_path):
+      error = proc.stderr.strip().splitlines()
+      results.append({"case": case, "error": error[-1] if error else
+                      f"exit status {proc.returncode}"})
+      continue
+    with open(result_path) as f:
+      r = json.load(f)
+    seconds = r["seconds"] or 1e-9
+    results.append({
+        "case": case,
+        "files_per_s": round(tree["paths"] / seconds, 1),
+        "mb_per_s": round(tree["bytes"] / seconds / 1e6, 1),
+        "syscalls_per_file": (round(r["syscalls"] / tree["paths"], 2)
+                              if r["syscalls"] is not None else None),
+        "peak_rss_mb": round(r["peak_rss_mb"], 1),
+        "time_to_results_s": round(r["seconds"], 3),
+        "groups": r["groups"],
+        "correct": r["groups"] == tree["duplicate_groups"],
+    })
+  return {
+      "time": time.time(),
+      "host": {"python": platform.python_version(),
+               "platform": platform.platform(), "cpus": os.cpu_count()},
+      "workers": workers,
+      "io_order": io_order,
+      "tree": tree,
+      "results": results,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--dir", help="scratch directory (default: a temp dir)")
+  parser.add_argument("--cases", default=",".join(CASES),
+                      help="comma-separated subset of: " + ", ".join(CASES))
+  parser.add_argument("--workers", type=int, default=DEFAULT_THREADS)
+  parser.add_argument("--max-memory", type=int, default=64 * 1024 * 1024,
+                      help="RAM ceiling for file_duplication_external")
+  parser.add_argument("--io-order", choices=("inode", "extent"),
+                      help="hash in on-disk order (see filededup.io_scheduler)")
+  parser.add_argument("--drop-caches", action="store_true",
+                      help="drop the page cache before each case (root only)")
+  parser.add_argument("--json", help="also write results to this file")
+  for field, default in TreeSpec._field_defaults.items():
+    parser.add_argument(f"--{field.replace('_', '-')}", type=type(default),
+                        default=default)
+  # internal: run one case in this process
+  parser.add_argument("--case", help=argparse.SUPPRESS)
+  parser.add_argument("--tree", help=argparse.SUPPRESS)
+  parser.add_argument("--work", help=argparse.SUPPRESS)
+  parser.add_argument("--result", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.case:
+    result = run_case(args)
+    with open(args.result, "w") as f:
+      json.dump(result, f)
+    return
+
+  cases = [c.strip() for c in args.cases.split(",") if c.strip()]
+  unknown = set(cases) - set(CASES)
+  if unknown:
+    parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+  spec = TreeSpec(**{f: getattr(args, f) for f in TreeSpec._fields})
+  with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+    report = run(work_dir, spec, cases, args.workers, args.max_memory,
+                 args.drop_caches, args.io_order)
+  tree = report["tree"]
+  print(f'{tree["paths"]} paths, {tree["inodes"]} inodes, '
+        f'{tree["bytes"] / 1e6:.1f} MB, {tree["duplicate_groups"]} duplicate groups')
+  print(f"{'case':<26} {'files/s':>10} {'MB/s':>8} {'sys/file':>9} "
+        f"{'RSS MB':>8} {'seconds':>8} {'groups':>7}")
+  for r in report["results"]:
+    if "error" in r:
+      print(f"{r['case']:<26} error: {r['error']}")
+      continue
+    syscalls = r["syscalls_per_file"] if r["syscalls_per_file"] is not None else "-"
+    mark = "" if r["correct"] else " (wrong)"
+    print(f"{r['case']:<26} {r['files_per_s']:>10} {r['mb_per_s']:>8} "
+          f"{syscalls:>9} {r['peak_rss_mb']:>8} {r['time_to_results_s']:>8} "
+          f"{r['groups']:>7}{mark}")
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,407 @@
+"""Content-defined chunking, for measuring block-level (partial) duplication.
+
+Whole-file keys miss files that share most of their bytes, such as crawled
+pages or logs. Here files are cut into variable-size chunks FastCDC style:
+a gear rolling hash h = (h << 1) + GEAR[byte] runs over the data and a chunk
+ends where the hash matches a mask, so an insertion only moves the
+boundaries near it. Normalized chunking uses a stricter mask before the
+average size and a looser one after it, which keeps chunk sizes close to
+AVG_SIZE, between MIN_SIZE and MAX_SIZE.
+
+The hash at a position depends only on the 64 bytes ending there, so with
+numpy installed it is computed for a whole buffer at once in log2(64) = 6
+shifted adds and candidate boundaries are found with a vector compare.
+Without numpy a plain loop produces the same cut points, hashing from
+MIN_SIZE - 64 bytes into each chunk on.
+
+ChunkIndex gathers the chunk lists of many files (optionally from many
+machines) and reports how many bytes block-level dedup could reclaim. It is
+kept in memory only. Uploads follow the sequence rules of filededup.sync:
+
+  {"client_id": ..., "base_seq": n, "seq": n + 1, "full": false,
+   "upserts": {path: [[digest, length], ...]}, "removed": [path, ...]}
+
+is applied if base_seq is the last sequence number acknowledged for the
+client, and answered with "resync" otherwise (first contact, or a server
+restart that lost the index), on which ChunkClient forgets what it sent
+and uploads every file again, the first message carrying "full": true.
+Every message is bounded: ChunkClient sends removals BATCH_SIZE paths at a
+time and chunk lists until BATCH_CHUNKS chunks are gathered (one file's
+list is never split), each batch one sequence step.
+
+  python -m filededup.chunking ROOT [--top 10] [--json]
+"""
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from filededup.hash_engine import HashEngine
+from filededup.hashing import (ALGORITHMS, DEFAULT_ALGO, new_hash, parse_key,
+                               tag_digest)
+from filededup.index import Member, format_member
+from filededup.walker import walk
+from filededup.wire import BATCH_SIZE
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+MIN_SIZE = 2 * 1024
+AVG_SIZE = 8 * 1024
+MAX_SIZE = 64 * 1024
+# FastCDC's masks for 8 KB chunks: 15 bits before AVG_SIZE, 11 after
+MASK_S = 0x0003590703530000
+MASK_L = 0x0000d90003530000
+WINDOW = 64
+READ_SIZE = 4 * 1024 * 1024
+# chunk lists per upload message, about 5 MB of JSON
+BATCH_CHUNKS = 64 * 1024
+
+_M64 = (1 << 64) - 1
+GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "little")
+             for i in range(256))
+
+# (digest, length) of each chunk, in file order
+Chunks = List[Tuple[str, int]]
+
+
+def _cuts_py(buf: bytes, final: bool) -> List[int]:
+  gear = GEAR
+  n = len(buf)
+  cuts: List[int] = []
+  s = 0
+  while s < n:
+    end = min(n, s + MAX_SIZE)
+    cut = None
+    h = 0
+    for i in range(s + MIN_SIZE - WINDOW, min(end, s + MIN_SIZE - 1)):
+      h = ((h << 1) + gear[buf[i]]) & _M64
+    for i in range(s + MIN_SIZE - 1, min(end, s + AVG_SIZE - 1)):
+      h = ((h << 1) + gear[buf[i]]) & _M64
+      if not h & MASK_S:
+        cut = i + 1
+        break
+    else:
+      for i in range(s + AVG_SIZE - 1, end):
+        h = ((h << 1) + gear[buf[i]]) & _M64
+        if not h & MASK_L:
+          cut = i + 1
+          break
+    if cut is None:
+      if end == s + MAX_SIZE or final:
+        cut = end
+      else:
+        break
+    cuts.append(cut - s)
+    s = cut
+  return cuts
+
+
+def _cuts_numpy(buf: bytes, final: bool) -> List[int]:
+  h = _GEAR_NP[numpy.frombuffer(buf, numpy.uint8)]
+  shift = 1
+  while shift < WINDOW:
+    # after this step h[i] sums the gear values of 2 * shift bytes
+    h[shift:] += h[:-shift] << numpy.uint64(shift)
+    shift *= 2
+  strict = numpy.flatnonzero((h & numpy.uint64(MASK_S)) == 0)
+  loose = numpy.flatnonzero((h & numpy.uint64(MASK_L)) == 0)
+  n = len(buf)
+  cuts: List[int] = []
+  s = 0
+  while s < n:
+    end = min(n, s + MAX_SIZE)
+    cut = None
+    j = numpy.searchsorted(strict, s + MIN_SIZE - 1)
+    if j < len(strict) and strict[j] < min(end, s + AVG_SIZE - 1):
+      cut = int(strict[j]) + 1
+    else:
+      j = numpy.searchsorted(loose, s + AVG_SIZE - 1)
+      if j < len(loose) and loose[j] < end:
+        cut = int(loose[j]) + 1
+    if cut is None:
+      if end == s + MAX_SIZE or final:
+        cut = end
+      else:
+        break
+    cuts.append(cut - s)
+    s = cut
+  return cuts
+
+
+if numpy is not None:
+  _GEAR_NP = numpy.array(GEAR, dtype=numpy.uint64)
+  _cut_points = _cuts_numpy
+else:
+  _cut_points = _cuts_py
+
+
+def chunk_file(path: str, size: int = 0, algo: str = DEFAULT_ALGO) -> Chunks:
+  # (path, size) signature so it can run as a hash engine job
+  ret: Chunks = []
+  buf = b""
+  with open(path, "rb") as f:
+    while True:
+      data = f.read(READ_SIZE)
+      final = not data
+      buf = buf + data if buf else data
+      view = memoryview(buf)
+      pos = 0
+      for length in _cut_points(buf, final):
+        hashfunc = new_hash(algo)
+        hashfunc.update(view[pos:pos + length])
+        ret.append((tag_digest(algo, hashfunc.hexdigest()), length))
+        pos += length
+      view.release()
+      buf = buf[pos:]
+      if final:
+        return ret
+
+
+class ChunkIndex:
+
+  def __init__(self):
+    # member -> its chunk digests, in order
+    self.files: Dict[Member, List[str]] = {}
+    # digest -> chunk length
+    self.sizes: Dict[str, int] = {}
+    # digest -> member -> occurrences
+    self.refs: Dict[str, Dict[Member, int]] = {}
+    # client_id -> last acknowledged upload sequence number
+    self.seqs: Dict[str, Optional[int]] = {}
+    self.lock = threading.RLock()
+
+  def add(self, member: Member, chunks: Chunks):
+    with self.lock:
+      self.remove(member)
+      self.files[member] = [digest for digest, _ in chunks]
+      for digest, length in chunks:
+        self.sizes[digest] = length
+        refs = self.refs.setdefault(digest, {})
+        refs[member] = refs.get(member, 0) + 1
+
+  def remove(self, member: Member):
+    with self.lock:
+      for digest in self.files.pop(member, []):
+        refs = self.refs[digest]
+        refs[member] -= 1
+        if not refs[member]:
+          del refs[member]
+        if not refs:
+          del self.refs[digest]
+          del self.sizes[digest]
+
+  def apply(self, client_id: str, upserts: Dict[str, Chunks],
+            removed: Iterable[str]):
+    with self.lock:
+      for path in removed:
+        self.remove((client_id, path))
+      for path, chunks in upserts.items():
+        self.add((client_id, path), [(d, n) for d, n in chunks])
+
+  def submit(self, msg: dict) -> dict:
+    """Apply one ChunkClient upload; a full one first drops everything
+    held for the client. A malformed upload raises KeyError, TypeError or
+    ValueError before anything is applied."""
+    client_id = str(msg["client_id"])
+    seq = msg.get("seq")
+    upserts = msg.get("upserts", {})
+    removed = msg.get("removed", [])
+    if not isinstance(upserts, dict) or not isinstance(removed, list):
+      raise ValueError("upserts must be a map and removed a list")
+    upserts = {path: [(str(d), int(n)) for d, n in chunks]
+               for path, chunks in upserts.items()}
+    with self.lock:
+      full = bool(msg.get("full"))
+      if not full and self.seqs.get(client_id) != msg.get("base_seq"):
+        return {"status": "resync", "seq": self.seqs.get(client_id)}
+      if full:
+        removed = removed + [p for c, p in self.files if c == client_id]
+      self.apply(client_id, upserts, removed)
+      self.seqs[client_id] = seq
+    return {"status": "ok", "seq": seq}
+
+  def report(self) -> dict:
+    """Totals over every file: stored bytes, bytes left after block-level
+    dedup, and bytes in chunks that more than one machine holds."""
+    with self.lock:
+      total = unique = cross_machine = 0
+      for digest, refs in self.refs.items():
+        size = self.sizes[digest]
+        total += size * sum(refs.values())
+        unique += size
+        if len({client_id for client_id, _ in refs}) > 1:
+          cross_machine += size
+      return {
+          "files": len(self.files),
+          "chunks": len(self.refs),
+          "total_bytes": total,
+          "unique_bytes": unique,
+          "reclaimable_bytes": total - unique,
+          "cross_machine_bytes": cross_machine,
+      }
+
+  def shared(self, member: Member, limit: int = 10) -> List[dict]:
+    # the files sharing most bytes with member
+    with self.lock:
+      counts: Dict[Member, int] = {}
+      for digest in set(self.files.get(member, [])):
+        for other in self.refs[digest]:
+          if other != member:
+            counts[other] = counts.get(other, 0) + self.sizes[digest]
+      top = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]
+      return [{"path": format_member(m), "shared_bytes": n} for m, n in top]
+
+  def top_shared(self, limit: int = 10) -> List[dict]:
+    """Files with the most bytes also found elsewhere, whole-file copies
+    included."""
+    with self.lock:
+      rows = []
+      for member, digests in self.files.items():
+        shared = sum(self.sizes[d] for d in digests
+                     if len(self.refs[d]) > 1 or self.refs[d][member] > 1)
+        if shared:
+          total = sum(self.sizes[d] for d in digests)
+          rows.append({"path": format_member(member), "shared_bytes": shared,
+                       "total_bytes": total})
+      rows.sort(key=lambda r: (-r["shared_bytes"], r["path"]))
+      return rows[:limit]
+
+
+class ChunkClient:
+  """Client side of POST /chunks: only files whose key changed since the
+  last acknowledged upload are chunked and sent again."""
+
+  def __init__(self, client_id: str, engine: HashEngine,
+               algo: str = DEFAULT_ALGO):
+    self.client_id = client_id
+    self.engine = engine
+    self.algo = algo
+    # path -> key as last acknowledged
+    self.sent: Dict[str, str] = {}
+    self.seq = 0
+    self.full = True
+
+  async def _send(self, send: Callable[[dict], Any], upserts: Dict[str, Chunks],
+                  removed: List[str], keys: Dict[str, str]) -> bool:
+    # one batch; keys are those of the files in upserts
+    reply = send({"client_id": self.client_id, "base_seq": self.seq,
+                  "seq": self.seq + 1, "full": self.full,
+                  "upserts": upserts, "removed": removed})
+    if inspect.isawaitable(reply):
+      reply = await reply
+    if reply.get("status") != "ok":
+      self.full = True
+      return False
+    self.seq = reply["seq"]
+    self.full = False
+    for path in removed:
+      del self.sent[path]
+    self.sent.update(keys)
+    return True
+
+  async def _upload(self, files: Dict[str, str],
+                    send: Callable[[dict], Any]) -> bool:
+    if self.full:
+      self.sent = {}
+    removed = [p for p in self.sent if p not in files]
+    changed = {p: k for p, k in files.items() if self.sent.get(p) != k}
+    sent_any = False
+    for i in range(0, len(removed), BATCH_SIZE):
+      if not await self._send(send, {}, removed[i:i + BATCH_SIZE], {}):
+        return False
+      sent_any = True
+    jobs = [(p, parse_key(k)[0]) for p, k in changed.items()]
+    func = functools.partial(chunk_file, algo=self.algo)
+    upserts: Dict[str, Chunks] = {}
+    count = 0
+    results = self.engine.aimap(func, jobs)
+    try:
+      async for (path, _), chunks in results:
+        if chunks is None:
+          continue
+        upserts[path] = chunks
+        count += len(chunks)
+        if count >= BATCH_CHUNKS or len(upserts) >= BATCH_SIZE:
+          if not await self._send(send, upserts, [],
+                                  {p: changed[p] for p in upserts}):
+            return False
+          sent_any = True
+          upserts, count = {}, 0
+    finally:
+      await results.aclose()
+    if upserts or not sent_any:
+      # an unchanged map still goes out, as an empty delta
+      return await self._send(send, upserts, [], {p: changed[p] for p in upserts})
+    return True
+
+  async def push(self, files: Dict[str, str],
+                 send: Callable[[dict], Any]) -> bool:
+    """Upload what changed; files is path -> key, as sent to /sync, and
+    send may be a coroutine function. Even an unchanged map is sent, as an
+    empty delta, so a server that lost the index asks for a resync."""
+    for _ in range(2):
+      if await self._upload(files, send):
+        return True
+    return False
+
+
+def index_paths(jobs: Iterable[Tuple[str, int]], engine: HashEngine,
+                algo: str = DEFAULT_ALGO, index: Optional[ChunkIndex] = None,
+                client_id: str = "") -> ChunkIndex:
+  # jobs: (path, size) pairs, as for HashEngine.imap
+  index = index if index is not None else ChunkIndex()
+  func = functools.partial(chunk_file, algo=algo)
+  for (path, _), chunks in engine.imap(func, jobs):
+    if chunks is not None:
+      index.add((client_id, path), chunks)
+  return index
+
+
+def index_tree(root_dir: str, engine: HashEngine, algo: str = DEFAULT_ALGO,
+               index: Optional[ChunkIndex] = None,
+               client_id: str = "") -> ChunkIndex:
+  # hardlinks share their blocks, so each inode is chunked once
+  inodes = set()
+  jobs = []
+  for entry in walk(root_dir):
+    if (entry.dev, entry.ino) not in inodes:
+      inodes.add((entry.dev, entry.ino))
+      jobs.append((entry.path, entry.size))
+  return index_paths(jobs, engine, algo, index, client_id)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="report block-level duplication under a directory")
+  parser.add_argument("root")
+  parser.add_argument("--algo", choices=sorted(ALGORITHMS), default=DEFAULT_ALGO)
+  parser.add_argument("--top", type=int, default=10)
+  parser.add_argument("--json", action="store_true")
+  args = parser.parse_args()
+  engine = HashEngine()
+  try:
+    index = index_tree(args.root, engine, args.algo)
+  finally:
+    engine.shutdown()
+  report = index.report()
+  report["top_files"] = index.top_shared(args.top)
+  if args.json:
+    print(json.dumps(report, indent=2))
+    return
+  total = report["total_bytes"] or 1
+  print(f'{report["files"]} files, {report["chunks"]} distinct chunks')
+  print(f'{report["reclaimable_bytes"]} of {report["total_bytes"]} bytes '
+        f'({100 * report["reclaimable_bytes"] / total:.1f}%) reclaimable '
+        f'by block-level dedup')
+  for row in report["top_files"]:
+    print(f'{row["shared_bytes"]:>12} / {row["total_bytes"]:<12} {row["path"]}')
+
+
+if __name__ == "__main__":
+  main()
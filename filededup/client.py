@@ -1,58 +1,115 @@
-from typing import Dict, Tuple
-import hashlib
-import os
-import requests
 import asyncio
+import socket
+
+from filededup import metrics
+from filededup.chunking import ChunkClient
+from filededup.hash_cache import DEFAULT_CACHE_PATH, HashCache
+from filededup.hash_engine import HashEngine
+from filededup.hashing import DEFAULT_ALGO
+from filededup.io_scheduler import DEFAULT_PER_DEVICE, IoScheduler
+from filededup.scanner import FileStats, file_keys, scan_tree_async
+from filededup.sync import SyncClient
+from filededup.two_phase import two_phase_updates
+from filededup.upload import HttpClient, SyncUploader
+from filededup.watcher import tree_updates
 
 root_dir = "output"
 host = "localhost"
 port = 8080
+cache_path = DEFAULT_CACHE_PATH
+hash_algo = DEFAULT_ALGO
+# rehash only what inotify reports changed, instead of rescanning every 5s
+watch = True
+# also upload chunk lists, for the server's block-level dedup report
+chunks = False
+# report sizes first and hash only files whose size collides fleet-wide
+# (see filededup.two_phase); partial_hash adds a first/last bytes round
+two_phase = False
+partial_hash = False
+# hash in on-disk order ("inode" or "extent") for rotational disks, with
+# per_device reads in flight on each (see filededup.io_scheduler)
+io_order = None
+per_device = DEFAULT_PER_DEVICE
 
-def scan_local() -> Dict[str, Tuple[int, str]]:
-  # walk from root_dir, save results to self.file_map
-  ret: Dict[str, Tuple[int, str]] = {}
-  for dir, _, files in os.walk(root_dir):
-    for fname in files:
-      file_path = os.path.join(dir, fname)
-      try:
-        hashfunc = hashlib.sha256()
-        file_size = 0
-        with open(file_path, 'rb') as f:
-          while chunk := f.read(1024 * 64):
-            hashfunc.update(chunk)
-            file_size += len(chunk)
-        ret[file_path] = (file_size, hashfunc.hexdigest())
-      except Exception:
-        pass
-  return ret
+hash_cache = None
+# created on first use, so the settings above can be changed first
+hash_engine = None
+chunk_client = None
+sync_client = SyncClient(socket.gethostname())
+# one pooled connection for uploads and polling, opened on first use
+http_client = None
+uploader = None
+
+def connect() -> HttpClient:
+  global http_client, uploader
+  if http_client is None:
+    http_client = HttpClient(f"http://{host}:{port}")
+    uploader = SyncUploader(http_client, sync_client)
+  return http_client
+
+def start_engine() -> HashEngine:
+  global hash_engine, chunk_client
+  if hash_engine is None:
+    io = IoScheduler(io_order, per_device) if io_order else None
+    hash_engine = HashEngine(io=io)
+    chunk_client = ChunkClient(sync_client.client_id, hash_engine, hash_algo)
+  return hash_engine
+
+async def scan_local() -> FileStats:
+  # walk from root_dir; unchanged files are served from the hash cache and
+  # the rest are hashed on the engine's pool
+  global hash_cache
+  if hash_cache is None:
+    hash_cache = HashCache(cache_path, hash_algo)
+  return await scan_tree_async(root_dir, start_engine(), hash_cache, hash_algo)
 
 async def rescan():
-  while True:
-    print("started rescan")
-    ret = scan_local()
-    print("finished rescan")
-    url = f"http://{host}:{port}/submit"
+  global hash_cache
+  if hash_cache is None:
+    hash_cache = HashCache(cache_path, hash_algo)
+  http = connect()
+  start_engine()
+  print("started scan")
+  if two_phase:
+    updates = two_phase_updates(
+        root_dir, hash_engine, lambda op, msg: http.post_json(f"/{op}", msg),
+        sync_client.client_id, hash_cache, hash_algo, 5, partial_hash)
+  else:
+    updates = tree_updates(root_dir, hash_engine, hash_cache, hash_algo,
+                           interval=5, watch=watch)
+  async for ret in updates:
+    files = file_keys(ret)
     try:
-      _ = requests.post(url, json=ret)
+      # only entries changed since the last acknowledged sync are sent, in
+      # resumable chunks, without blocking the scan
+      await uploader.push(files)
     except Exception as e:
       print(f"Error from client: {e}")
       pass
-    # sleep for 10 seconds
-    await asyncio.sleep(5)
+    if chunks:
+      try:
+        await chunk_client.push(files, lambda msg: http.post_json("/chunks", msg))
+      except Exception as e:
+        print(f"Error from client: {e}")
 
 async def get_results():
+  http = connect()
+  etag = None
   while True:
-    url = f"http://{host}:{port}/results"
     try:
-      response = requests.get(url)
-      print(response.json())
+      headers = {"If-None-Match": etag} if etag else {}
+      response = await http.request("GET", "/duplicates", headers=headers)
+      if response.status_code == 200:
+        etag = response.headers.get("ETag")
+        print(response.json())
     except Exception as e:
       print(f"Error getting results: {e}")
       pass
     await asyncio.sleep(5)
 
 async def main():
-  tasks = [asyncio.create_task(rescan()), asyncio.create_task(get_results())]
+  tasks = [asyncio.create_task(rescan()), asyncio.create_task(get_results()),
+           asyncio.create_task(metrics.report_status())]
   await asyncio.gather(*tasks)
 
 if __name__ == '__main__':
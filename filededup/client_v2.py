@@ -1,67 +1,123 @@
 import os
-import hashlib
 import asyncio
-import requests
+import socket
 from typing import Dict, Optional
 
-def calc_filehash(fpath) -> Optional[str]:
+from filededup import metrics
+from filededup.chunking import ChunkClient
+from filededup.hash_cache import DEFAULT_CACHE_PATH, HashCache
+from filededup.hash_engine import HashEngine
+from filededup.hashing import DEFAULT_ALGO, file_digest
+from filededup.io_scheduler import DEFAULT_PER_DEVICE, IoScheduler
+from filededup.scanner import file_keys, scan_tree, scan_tree_async
+from filededup.sync import SyncClient
+from filededup.two_phase import two_phase_updates
+from filededup.upload import HttpClient, SyncUploader
+from filededup.watcher import tree_updates
+
+def calc_filehash(fpath, algo: str = DEFAULT_ALGO) -> Optional[str]:
   try:
-    fsize = 0
-    hashfunc = hashlib.sha256()
-    with open(fpath, 'rb') as f:
-      while chunk := f.read(1024*64):
-        hashfunc.update(chunk)
-        fsize += len(chunk)
-    return f"{hashfunc.hexdigest()}_{hex(fsize)}"
-  except:
+    return f"{file_digest(fpath, algo)}_{hex(os.path.getsize(fpath))}"
+  except OSError:
     return None
 
-async def scan_dir(root_dir: str) -> Dict[str, str]:
-  file_stats: Dict[str, str] = {}
-  for dir, _, files in os.walk(root_dir):
-    for fname in files:
-      fpath = os.path.join(dir, fname)
-      file_hash = calc_filehash(fpath)
-      if file_hash:
-        file_stats[fpath] = file_hash
-  return file_stats
+async def scan_dir(root_dir: str, cache: Optional[HashCache] = None,
+                   engine: Optional[HashEngine] = None,
+                   algo: str = DEFAULT_ALGO) -> Dict[str, str]:
+  if engine:
+    file_stats = await scan_tree_async(root_dir, engine, cache, algo)
+  else:
+    file_stats = await asyncio.to_thread(scan_tree, root_dir, cache, None, algo)
+  return file_keys(file_stats)
 
 class FileHash:
-  def __init__(self, root_dir: str, host: str, port: int, update_interval: int):
+  def __init__(self, root_dir: str, host: str, port: int, update_interval: int,
+               cache_path: str = DEFAULT_CACHE_PATH, client_id: Optional[str] = None,
+               engine: Optional[HashEngine] = None, algo: str = DEFAULT_ALGO,
+               watch: bool = True, chunks: bool = False,
+               two_phase: bool = False, partial_hash: bool = False,
+               io_order: Optional[str] = None,
+               per_device: int = DEFAULT_PER_DEVICE):
     self.root_dir = root_dir
     self.update_interval = update_interval
     self.server_url = f"http://{host}:{port}"
     self.finish = asyncio.Event()
     self.update_interval = update_interval
+    self.algo = algo
+    self.watch = watch
+    self.cache = HashCache(cache_path, algo)
+    # without an engine of its own, io_order picks on-disk hashing order
+    # for rotational disks (see filededup.io_scheduler)
+    self.engine = engine or HashEngine(
+        io=IoScheduler(io_order, per_device) if io_order else None)
+    self.sync = SyncClient(client_id or socket.gethostname())
+    # one pooled connection; uploads are chunked, retried and resumable
+    self.http = HttpClient(self.server_url)
+    self.uploader = SyncUploader(self.http, self.sync)
+    # chunk mode: also upload chunk lists for block-level dedup reports
+    self.chunks = (ChunkClient(self.sync.client_id, self.engine, algo)
+                   if chunks else None)
+    # two-phase: hash only files whose size (and, with partial_hash, first
+    # and last bytes) collide fleet-wide; see filededup.two_phase
+    self.two_phase = two_phase
+    self.partial_hash = partial_hash
 
   async def rescan(self):
-    while not self.finish.is_set():
-      file_stats = await scan_dir(self.root_dir)
-      try:
-        _ = requests.post(f"{self.server_url}/post", json=file_stats)
-      except Exception as e:
-        print(f"POST error: {e}")
-      await asyncio.sleep(self.update_interval)
+    # with watch, changes are pushed as inotify reports them and an
+    # unchanged map is re-sent (as an empty delta) every update_interval;
+    # two-phase clients run a report round every update_interval instead
+    if self.two_phase:
+      updates = two_phase_updates(
+          self.root_dir, self.engine,
+          lambda op, msg: self.http.post_json(f"/{op}", msg),
+          self.sync.client_id, self.cache, self.algo, self.update_interval,
+          self.partial_hash)
+    else:
+      updates = tree_updates(self.root_dir, self.engine, self.cache, self.algo,
+                             self.update_interval, self.watch)
+    try:
+      async for file_stats in updates:
+        files = file_keys(file_stats)
+        try:
+          await self.uploader.push(files)
+        except Exception as e:
+          print(f"POST error: {e}")
+        if self.chunks is not None:
+          try:
+            await self.chunks.push(
+                files, lambda msg: self.http.post_json("/chunks", msg))
+          except Exception as e:
+            print(f"POST error: {e}")
+        if self.finish.is_set():
+          break
+    finally:
+      await updates.aclose()
 
   async def get_results(self):
+    etag = None
     while not self.finish.is_set():
       try:
-        response = requests.get(f"{self.server_url}/get")
+        headers = {"If-None-Match": etag} if etag else {}
+        response = await self.http.request("GET", "/duplicates", headers=headers)
         if response.status_code == 200:
+          etag = response.headers.get("ETag")
           print("GET results:")
-          for k, v in response.json().items():
-            print(f"{k}: {v}")
-        else:
+          for group in response.json()["groups"]:
+            print(f"{group['key']}: {group['paths']}")
+        elif response.status_code != 304:
           print(f"GET error: {response.status_code}")
       except Exception as e:
         print(f"{e}")
       await asyncio.sleep(self.update_interval)
 
   async def run(self, server_runtime: int):
-    tasks = [asyncio.create_task(self.rescan()), asyncio.create_task(self.get_results())]
+    tasks = [asyncio.create_task(self.rescan()), asyncio.create_task(self.get_results()),
+             asyncio.create_task(metrics.report_status(
+                 interval=self.update_interval, stop=self.finish.is_set))]
     await asyncio.sleep(server_runtime)
     self.finish.set()
     await asyncio.gather(*tasks)
+    self.http.close()
 
 if __name__ == "__main__":
   client = FileHash(root_dir = "output", host = "localhost", port = 9999, update_interval = 3)
@@ -0,0 +1,203 @@
+"""Out-of-core duplicate grouping, for trees too large to group in RAM.
+
+The same three stages as hashing.staged_duplicates (size, then edge hash,
+then full hash) run on compact fixed-size records instead of dicts:
+
+  (size u64, path id u64)                 16 bytes
+  (size u64, raw digest 32 bytes, path id u64)  48 bytes
+
+Paths are appended once to a file of length-prefixed strings and a path id
+is its offset there. Records are buffered up to the memory ceiling, sorted
+and spilled to run files, then streamed back through a heapq k-way merge
+(big-endian packing makes byte order the same as numeric order). Each
+merged stream is read group by group, so only one group is ever in memory,
+and duplicate groups are yielded as they are found. The groups are exactly
+those of staged_duplicates.
+"""
+import functools
+import heapq
+import os
+import struct
+import tempfile
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from filededup.hash_engine import HashEngine, HashFunc
+from filededup.hashing import (DEFAULT_ALGO, EDGE_SIZE, edge_digest,
+                               full_digest, tag_digest)
+
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+MERGE_FANIN = 128
+READ_BLOCK = 64 * 1024
+# list slot plus bytes object header, per buffered record
+RECORD_OVERHEAD = 41
+
+_size_rec = struct.Struct(">QQ")
+_hash_rec = struct.Struct(">Q32sQ")
+_path_len = struct.Struct(">I")
+
+
+class _Paths:
+  """Append-only store of paths; a path's id is its offset in the file."""
+
+  def __init__(self, work_dir: str):
+    self.f = open(os.path.join(work_dir, "paths"), "w+b")
+    self.offset = 0
+
+  def add(self, path: str) -> int:
+    raw = os.fsencode(path)
+    pid = self.offset
+    self.f.write(_path_len.pack(len(raw)) + raw)
+    self.offset += _path_len.size + len(raw)
+    return pid
+
+  def get(self, pid: int) -> str:
+    fd = self.f.fileno()
+    n, = _path_len.unpack(os.pread(fd, _path_len.size, pid))
+    return os.fsdecode(os.pread(fd, n, pid + _path_len.size))
+
+  def close(self):
+    self.f.close()
+
+
+def _read_run(path: str, rec_size: int) -> Iterator[bytes]:
+  block = READ_BLOCK - READ_BLOCK % rec_size
+  with open(path, "rb") as f:
+    while True:
+      data = f.read(block)
+      if not data:
+        break
+      for i in range(0, len(data), rec_size):
+        yield data[i:i + rec_size]
+  os.remove(path)
+
+
+class _Runs:
+  """Fixed-size records, sorted in memory up to a ceiling and spilled to
+  sorted run files beyond it."""
+
+  def __init__(self, work_dir: str, rec_size: int, max_memory: int):
+    self.work_dir = work_dir
+    self.rec_size = rec_size
+    self.limit = max(max_memory // (rec_size + RECORD_OVERHEAD), 1)
+    self.buf: List[bytes] = []
+    self.files: List[str] = []
+
+  def add(self, rec: bytes):
+    self.buf.append(rec)
+    if len(self.buf) >= self.limit:
+      self._spill(self.buf)
+      self.buf = []
+
+  def _spill(self, recs: Iterable[bytes]):
+    fd, path = tempfile.mkstemp(dir=self.work_dir, suffix=".run")
+    with os.fdopen(fd, "wb") as f:
+      if isinstance(recs, list):
+        recs.sort()
+      f.writelines(recs)
+    self.files.append(path)
+
+  def merged(self) -> Iterator[bytes]:
+    if not self.files:
+      self.buf.sort()
+      yield from self.buf
+      self.buf = []
+      return
+    if self.buf:
+      self._spill(self.buf)
+      self.buf = []
+    # keep the number of open runs (and read buffers) bounded
+    while len(self.files) > MERGE_FANIN:
+      batch, self.files = self.files[:MERGE_FANIN], self.files[MERGE_FANIN:]
+      self._spill(heapq.merge(*(_read_run(p, self.rec_size) for p in batch)))
+    files, self.files = self.files, []
+    yield from heapq.merge(*(_read_run(p, self.rec_size) for p in files))
+
+
+def _collisions(records: Iterator[bytes]) -> Iterator[Tuple[int, int]]:
+  # (size, path id) for sizes held by more than one path
+  held = None
+  last_size = None
+  for rec in records:
+    size, pid = _size_rec.unpack(rec)
+    if size != last_size:
+      last_size, held = size, pid
+      continue
+    if held is not None:
+      yield size, held
+      held = None
+    yield size, pid
+
+
+def _groups(records: Iterator[bytes]) -> Iterator[Tuple[int, bytes, List[int]]]:
+  # (size, raw digest, path ids) for each (size, digest) with 2+ paths
+  key = None
+  pids: List[int] = []
+  for rec in records:
+    size, digest, pid = _hash_rec.unpack(rec)
+    if (size, digest) != key:
+      if len(pids) > 1:
+        yield key[0], key[1], pids
+      key, pids = (size, digest), []
+    pids.append(pid)
+  if len(pids) > 1:
+    yield key[0], key[1], pids
+
+
+def _hash_into(engine: HashEngine, paths: _Paths, jobs: Iterator[Tuple[int, int]],
+               func: HashFunc, out: _Runs):
+  # the engine yields in submission order, so path ids are matched up
+  # through a FIFO instead of being carried in the jobs
+  pids = deque()
+
+  def path_jobs():
+    for size, pid in jobs:
+      pids.append(pid)
+      yield paths.get(pid), size
+
+  for (_, size), digest in engine.imap(func, path_jobs()):
+    pid = pids.popleft()
+    if digest is not None:
+      raw = bytes.fromhex(digest.rpartition(":")[2])
+      out.add(_hash_rec.pack(size, raw, pid))
+
+
+def external_duplicates(files: Iterable[Tuple[str, int]], engine: HashEngine,
+                        algo: str = DEFAULT_ALGO,
+                        max_memory: int = DEFAULT_MAX_MEMORY,
+                        tmp_dir: Optional[str] = None
+                        ) -> Iterator[Tuple[Tuple[int, str], List[str]]]:
+  """Yield ((size, digest), paths) for every duplicate group among the
+  (path, size) pairs in `files`, keeping at most about max_memory bytes of
+  records in memory per stage. Run files go to a scratch directory under
+  tmp_dir, removed when the generator finishes."""
+  with tempfile.TemporaryDirectory(prefix="filededup-", dir=tmp_dir) as work:
+    paths = _Paths(work)
+    try:
+      by_size = _Runs(work, _size_rec.size, max_memory)
+      for path, size in files:
+        by_size.add(_size_rec.pack(size, paths.add(path)))
+      paths.f.flush()
+
+      edges = _Runs(work, _hash_rec.size, max_memory)
+      _hash_into(engine, paths, _collisions(by_size.merged()),
+                 functools.partial(edge_digest, edge=EDGE_SIZE, algo=algo), edges)
+
+      # files no larger than both edges were hashed whole: those groups are
+      # final; the rest go on to a full hash
+      full_jobs = _Runs(work, _size_rec.size, max_memory)
+      for size, digest, pids in _groups(edges.merged()):
+        if size <= 2 * EDGE_SIZE:
+          yield (size, tag_digest(algo, digest.hex())), [paths.get(p) for p in pids]
+        else:
+          for pid in pids:
+            full_jobs.add(_size_rec.pack(size, pid))
+
+      fulls = _Runs(work, _hash_rec.size, max_memory)
+      jobs = (_size_rec.unpack(rec) for rec in full_jobs.merged())
+      _hash_into(engine, paths, jobs,
+                 functools.partial(full_digest, algo=algo), fulls)
+      for size, digest, pids in _groups(fulls.merged()):
+        yield (size, tag_digest(algo, digest.hex())), [paths.get(p) for p in pids]
+    finally:
+      paths.close()
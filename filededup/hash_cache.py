@@ -0,0 +1,97 @@
+"""Persistent digest cache keyed by (device, inode, size, mtime_ns).
+
+A rescan only needs to stat each file: if the stat key matches a cached
+entry for the same hash algorithm the stored digest is reused and no data
+is read. Updates are batched and committed in a single transaction at the
+end of a scan, together with pruning of paths that no longer exist.
+"""
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+from filededup import metrics
+from filededup.hashing import DEFAULT_ALGO
+from filededup.walker import FileEntry
+
+DEFAULT_CACHE_PATH = ".filededup-cache.sqlite"
+SCHEMA_VERSION = 2
+
+
+class HashCache:
+
+  def __init__(self, db_path: str = DEFAULT_CACHE_PATH,
+               algo: str = DEFAULT_ALGO):
+    self.db_path = db_path
+    self.algo = algo
+    self.lock = threading.Lock()
+    self.pending: List[Tuple[str, str, int, int, int, int, str]] = []
+    self.conn = sqlite3.connect(db_path, check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    if self.conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+      # it is only a cache: rebuild rather than migrate
+      with self.conn:
+        self.conn.execute("DROP TABLE IF EXISTS files")
+        self.conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    with self.conn:
+      self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+          path TEXT, algo TEXT, dev INTEGER, ino INTEGER, size INTEGER,
+          mtime_ns INTEGER, digest TEXT, PRIMARY KEY (path, algo))""")
+      self.conn.execute(
+          "CREATE INDEX IF NOT EXISTS files_inode ON files (dev, ino, algo)")
+
+  @staticmethod
+  def stat_key(entry: FileEntry) -> Tuple[int, int, int, int]:
+    return (entry.dev, entry.ino, entry.size, entry.mtime_ns)
+
+  def lookup(self, entry: FileEntry) -> Optional[str]:
+    with self.lock:
+      row = self.conn.execute(
+          "SELECT path, digest FROM files WHERE dev=? AND ino=? AND size=? "
+          "AND mtime_ns=? AND algo=? ORDER BY path=? DESC LIMIT 1",
+          (*self.stat_key(entry), self.algo, entry.path)).fetchone()
+      if row is None:
+        metrics.CACHE_LOOKUPS.inc(result="miss")
+        return None
+      metrics.CACHE_LOOKUPS.inc(result="hit")
+      if row[0] != entry.path:
+        # renamed or hardlinked: remember this path so pruning keeps it
+        self.pending.append(
+            (entry.path, self.algo, *self.stat_key(entry), row[1]))
+    return row[1]
+
+  def store(self, entry: FileEntry, digest: str):
+    with self.lock:
+      self.pending.append(
+          (entry.path, self.algo, *self.stat_key(entry), digest))
+
+  def commit(self, root_dir: Optional[str] = None,
+             seen: Optional[Iterable[str]] = None,
+             gone: Iterable[str] = ()):
+    """Flush stored digests; if `seen` is given, also drop cached paths under
+    `root_dir` that were not seen by the scan. Paths in `gone` (files or
+    whole directories) are dropped too. All of it happens atomically."""
+    with self.lock, self.conn:
+      self.conn.executemany(
+          "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+          self.pending)
+      self.pending = []
+      for path in gone:
+        # everything under path/ sorts between "path/" and "path0"
+        prefix = os.path.join(path, "")
+        self.conn.execute(
+            "DELETE FROM files WHERE algo=? AND (path=? OR (path>=? AND path<?))",
+            (self.algo, path, prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+      if seen is None:
+        return
+      seen = set(seen)
+      prefix = os.path.join(root_dir, "") if root_dir else ""
+      stale = [(path, self.algo) for (path,) in self.conn.execute(
+          "SELECT path FROM files WHERE algo=?", (self.algo,))
+               if path.startswith(prefix) and path not in seen]
+      self.conn.executemany("DELETE FROM files WHERE path=? AND algo=?",
+                            stale)
+
+  def close(self):
+    with self.lock:
+      self.conn.close()
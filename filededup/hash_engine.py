@@ -0,0 +1,190 @@
+"""Bounded concurrent file hashing shared by the dedup scanners.
+
+Hashing runs on a thread pool (hashlib releases the GIL while digesting
+large buffers) or, optionally, a process pool. Submissions are throttled by
+a byte budget so only so many bytes of files are being read at once, and
+results are available both from blocking code (`imap`) and, without
+blocking the event loop, from coroutines (`aimap`, `hash_file`).
+
+With an IoScheduler (see filededup.io_scheduler) jobs are submitted a
+window at a time in on-disk order, for rotational media; results still
+come back in the caller's order.
+"""
+import asyncio
+import functools
+import itertools
+import os
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import (TYPE_CHECKING, AsyncIterator, Callable, Deque, Iterable,
+                    Iterator, List, Optional, Tuple)
+
+from filededup import metrics
+
+if TYPE_CHECKING:
+  from filededup.io_scheduler import IoScheduler
+
+DEFAULT_INFLIGHT_BYTES = 256 * 1024 * 1024
+
+# (path, size); hash functions are called as func(path, size)
+Job = Tuple[str, int]
+HashFunc = Callable[[str, int], str]
+
+
+class ByteBudget:
+  """Counts bytes in flight. A request larger than the whole budget is
+  admitted once nothing else is in flight, so it cannot starve."""
+
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.in_use = 0
+    self.cond = threading.Condition()
+    self.waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future, int]] = deque()
+
+  def _fits(self, n: int) -> bool:
+    return self.in_use == 0 or self.in_use + n <= self.limit
+
+  def acquire(self, n: int):
+    with self.cond:
+      self.cond.wait_for(lambda: not self.waiters and self._fits(n))
+      self.in_use += n
+
+  async def acquire_async(self, n: int):
+    loop = asyncio.get_running_loop()
+    with self.cond:
+      if not self.waiters and self._fits(n):
+        self.in_use += n
+        return
+      fut = loop.create_future()
+      self.waiters.append((loop, fut, n))
+    await fut
+
+  def _grant(self, fut: asyncio.Future, n: int):
+    if fut.done():
+      # the waiter was cancelled after its bytes were reserved
+      self.release(n)
+    else:
+      fut.set_result(None)
+
+  def release(self, n: int):
+    with self.cond:
+      self.in_use -= n
+      while self.waiters and self._fits(self.waiters[0][2]):
+        loop, fut, m = self.waiters.popleft()
+        self.in_use += m
+        loop.call_soon_threadsafe(self._grant, fut, m)
+      self.cond.notify_all()
+
+
+class HashEngine:
+
+  def __init__(self, max_workers: Optional[int] = None,
+               use_processes: bool = False,
+               max_inflight_bytes: int = DEFAULT_INFLIGHT_BYTES,
+               io: Optional["IoScheduler"] = None):
+    if io is not None and use_processes:
+      raise ValueError("I/O scheduling needs a thread pool")
+    self.io = io
+    self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    self.pool: Executor = (ProcessPoolExecutor if use_processes else
+                           ThreadPoolExecutor)(max_workers=self.max_workers)
+    self.budget = ByteBudget(max_inflight_bytes)
+    # results held back for in-order delivery
+    self.max_pending = self.max_workers * 4
+
+  def _submit(self, func: HashFunc, path: str, size: int) -> Future:
+    metrics.HASH_QUEUE.inc()
+    metrics.HASH_INFLIGHT_BYTES.inc(size)
+    fut = self.pool.submit(func, path, size)
+    fut.add_done_callback(lambda _: self._done(size))
+    return fut
+
+  def _done(self, size: int):
+    self.budget.release(size)
+    metrics.HASH_QUEUE.dec()
+    metrics.HASH_INFLIGHT_BYTES.dec(size)
+    metrics.FILES_HASHED.inc()
+    metrics.BYTES_HASHED.inc(size)
+
+  @staticmethod
+  def _result(fut: Future) -> Optional[str]:
+    try:
+      return fut.result()
+    except OSError:
+      return None
+
+  def _windows(self, jobs: Iterable[Job]) -> Iterator[List[Job]]:
+    it = iter(jobs)
+    while window := list(itertools.islice(it, self.io.window)):
+      yield window
+
+  def _submit_planned(self, func: HashFunc, job: Job, dev: int,
+                      next_path: Optional[str]) -> Future:
+    return self._submit(functools.partial(self.io.run, func, dev, next_path),
+                        *job)
+
+  def imap(self, func: HashFunc,
+           jobs: Iterable[Job]) -> Iterator[Tuple[Job, Optional[str]]]:
+    """Hash jobs concurrently, yielding (job, digest) in submission order;
+    digest is None for files that could not be read."""
+    if self.io is not None:
+      for window in self._windows(jobs):
+        futures: List[Optional[Future]] = [None] * len(window)
+        for i, dev, next_path in self.io.plan(window):
+          self.budget.acquire(window[i][1])
+          futures[i] = self._submit_planned(func, window[i], dev, next_path)
+        for job, fut in zip(window, futures):
+          yield job, self._result(fut)
+      return
+    pending: Deque[Tuple[Job, Future]] = deque()
+    for path, size in jobs:
+      self.budget.acquire(size)
+      pending.append(((path, size), self._submit(func, path, size)))
+      while pending and (len(pending) >= self.max_pending or pending[0][1].done()):
+        job, fut = pending.popleft()
+        yield job, self._result(fut)
+    while pending:
+      job, fut = pending.popleft()
+      yield job, self._result(fut)
+
+  async def aimap(self, func: HashFunc,
+                  jobs: Iterable[Job]) -> AsyncIterator[Tuple[Job, Optional[str]]]:
+    """Async counterpart of imap; the event loop is never blocked."""
+    if self.io is not None:
+      for window in self._windows(jobs):
+        futures: List[Optional[asyncio.Future]] = [None] * len(window)
+        for i, dev, next_path in await asyncio.to_thread(self.io.plan, window):
+          await self.budget.acquire_async(window[i][1])
+          futures[i] = asyncio.wrap_future(
+              self._submit_planned(func, window[i], dev, next_path))
+        for job, fut in zip(window, futures):
+          try:
+            yield job, await fut
+          except OSError:
+            yield job, None
+      return
+    pending: Deque[Tuple[Job, asyncio.Future]] = deque()
+
+    async def pop():
+      job, fut = pending.popleft()
+      try:
+        return job, await fut
+      except OSError:
+        return job, None
+
+    for path, size in jobs:
+      await self.budget.acquire_async(size)
+      pending.append(((path, size),
+                      asyncio.wrap_future(self._submit(func, path, size))))
+      while pending and (len(pending) >= self.max_pending or pending[0][1].done()):
+        yield await pop()
+    while pending:
+      yield await pop()
+
+  async def hash_file(self, func: HashFunc, path: str, size: int) -> str:
+    await self.budget.acquire_async(size)
+    return await asyncio.wrap_future(self._submit(func, path, size))
+
+  def shutdown(self):
+    self.pool.shutdown()
@@ -0,0 +1,161 @@
+"""File hashing helpers shared by the dedup scanners.
+
+Files are read with `readinto` into a reusable per-thread buffer, or mapped
+with mmap when large, so hashing allocates nothing per chunk. The hash
+algorithm is selectable; digests of anything but SHA-256 (kept bare for
+compatibility with existing clients and servers) are tagged
+"<algo>:<hex>", so files hashed with different algorithms never compare
+equal across a mixed fleet.
+"""
+import functools
+import hashlib
+import mmap
+import os
+import threading
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+from filededup.hash_engine import HashEngine, HashFunc
+
+CHUNK_SIZE = 1024 * 64
+EDGE_SIZE = 1024 * 64
+MMAP_THRESHOLD = 1024 * 1024 * 4
+
+DEFAULT_ALGO = "sha256"
+# every algorithm produces a 32-byte digest
+ALGORITHMS: Dict[str, Callable[[], "hashlib._Hash"]] = {
+    "sha256": hashlib.sha256,
+    "blake2b": functools.partial(hashlib.blake2b, digest_size=32),
+    "blake2s": hashlib.blake2s,
+}
+
+_buffers = threading.local()
+_has_fadvise = hasattr(os, "posix_fadvise")
+_has_madvise = hasattr(mmap, "MADV_SEQUENTIAL")
+
+
+def new_hash(algo: str = DEFAULT_ALGO):
+  try:
+    return ALGORITHMS[algo]()
+  except KeyError:
+    raise ValueError(f"unsupported hash algorithm: {algo}") from None
+
+
+def tag_digest(algo: str, hexdigest: str) -> str:
+  return hexdigest if algo == DEFAULT_ALGO else f"{algo}:{hexdigest}"
+
+
+def digest_algo(digest: str) -> str:
+  algo, sep, _ = digest.partition(":")
+  return algo if sep else DEFAULT_ALGO
+
+
+def file_key(size: int, digest: str) -> str:
+  # the "<digest>_<hex size>" key used on the wire by clients and servers
+  return f"{digest}_{hex(size)}"
+
+
+def parse_key(key: str) -> Tuple[int, str]:
+  digest, _, size = key.rpartition("_")
+  return int(size, 16), digest
+
+
+def _buffer() -> memoryview:
+  view = getattr(_buffers, "view", None)
+  if view is None:
+    view = _buffers.view = memoryview(bytearray(CHUNK_SIZE))
+  return view
+
+
+def _update(hashfunc, f, limit: int = -1):
+  # feed up to `limit` bytes (all if negative) without allocating
+  view = _buffer()
+  while limit:
+    n = f.readinto(view if limit < 0 else view[:min(limit, len(view))])
+    if not n:
+      break
+    hashfunc.update(view[:n])
+    if limit > 0:
+      limit -= n
+
+
+def file_digest(path: str, algo: str = DEFAULT_ALGO) -> str:
+  hashfunc = new_hash(algo)
+  with open(path, 'rb', buffering=0) as f:
+    size = os.fstat(f.fileno()).st_size
+    if _has_fadvise:
+      # read front to back: a larger readahead window
+      try:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+      except OSError:
+        pass
+    mapped = False
+    if size >= MMAP_THRESHOLD:
+      try:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+          if _has_madvise:
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+          hashfunc.update(mm)
+        mapped = True
+      except (OSError, ValueError):
+        # not mappable (e.g. special filesystems): fall back to reads
+        pass
+    if not mapped:
+      _update(hashfunc, f)
+  return tag_digest(algo, hashfunc.hexdigest())
+
+
+def edge_digest(path: str, size: int, edge: int = EDGE_SIZE,
+                algo: str = DEFAULT_ALGO) -> str:
+  # files no larger than both edges are hashed whole, so the result is
+  # their full digest
+  if size <= 2 * edge:
+    return file_digest(path, algo)
+  hashfunc = new_hash(algo)
+  with open(path, 'rb', buffering=0) as f:
+    _update(hashfunc, f, edge)
+    f.seek(-edge, 2)
+    _update(hashfunc, f, edge)
+  return tag_digest(algo, hashfunc.hexdigest())
+
+
+def full_digest(path: str, size: int, algo: str = DEFAULT_ALGO) -> str:
+  # file_digest with the (path, size) signature used for hash engine jobs
+  return file_digest(path, algo)
+
+
+def _regroup(engine: HashEngine, groups: Iterable[Tuple[int, List[str]]],
+             func: HashFunc) -> Dict[Tuple[int, str], List[str]]:
+  jobs = ((path, size) for size, paths in groups for path in paths)
+  ret: Dict[Tuple[int, str], List[str]] = {}
+  for (path, size), digest in engine.imap(func, jobs):
+    if digest is not None:
+      ret.setdefault((size, digest), []).append(path)
+  return ret
+
+
+def staged_duplicates(by_size: Dict[int, List[str]], engine: HashEngine,
+                      algo: str = DEFAULT_ALGO) -> Dict[Tuple[int, str], Set[str]]:
+  """Find duplicate groups keyed by (size, digest) without hashing every byte.
+
+  Stage 1: sizes seen once are dropped. Stage 2: size collisions are hashed
+  on their first and last EDGE_SIZE bytes. Stage 3: only files still
+  colliding (and larger than both edges) get a full streaming hash.
+  """
+  ret: Dict[Tuple[int, str], Set[str]] = {}
+  candidates = [(size, paths) for size, paths in by_size.items()
+                if len(paths) > 1]
+  partial = _regroup(engine, candidates,
+                     functools.partial(edge_digest, edge=EDGE_SIZE, algo=algo))
+  full_candidates = []
+  for (size, digest), paths in partial.items():
+    if len(paths) < 2:
+      continue
+    if size <= 2 * EDGE_SIZE:
+      ret[(size, digest)] = set(paths)
+    else:
+      full_candidates.append((size, paths))
+  for key, paths in _regroup(engine, full_candidates,
+                             functools.partial(full_digest, algo=algo)).items():
+    if len(paths) > 1:
+      ret[key] = set(paths)
+  return ret
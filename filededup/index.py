@@ -0,0 +1,224 @@
+"""Server-side file index, updated incrementally as clients sync.
+
+Besides key -> members, the index keeps the set of keys held by more than
+one member (the only groups worth reporting), those keys ranked by wasted
+bytes, and a version bumped on every change, which query endpoints use as
+an ETag. Upserts and removals move a key within the ranking (a bisect on a
+sorted list), so a query only builds the groups of the page it returns.
+
+With a SqliteStore, every applied change is persisted first and the index
+is reloaded from it on startup. Versions carry a per-process boot id, so an
+ETag handed out before a restart cannot match the reloaded index.
+
+Limitation: the store makes the index durable, not smaller. Every entry is
+also held in memory (entries and file_map), so memory grows with the total
+number of files across the fleet; sharding by hash prefix (see
+filededup.sharding) is the way to split it across processes.
+"""
+import bisect
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from filededup.hashing import parse_key
+from filededup.storage import SqliteStore
+
+# (client_id, path)
+Member = Tuple[str, str]
+
+
+def format_member(member: Member) -> str:
+  client_id, path = member
+  return f"{client_id}:{path}" if client_id else path
+
+
+class FileIndex:
+
+  def __init__(self, store: Optional[SqliteStore] = None):
+    # client_id -> path -> key
+    self.entries: Dict[str, Dict[str, str]] = {}
+    # client_id -> last acknowledged sync sequence number
+    self.seqs: Dict[str, int] = {}
+    # client_id -> time of its last submission
+    self.last_seen: Dict[str, float] = {}
+    # key -> members holding a file with that key
+    self.file_map: Dict[str, Set[Member]] = {}
+    # keys with more than one member
+    self.dup_keys: Set[str] = set()
+    # (-wasted bytes, key) of every duplicate key, sorted
+    self._ranked: List[Tuple[int, str]] = []
+    # versions are "<boot>.<changes>": an ETag from before a restart never
+    # matches, even once as many changes have been applied again
+    self.boot = uuid.uuid4().hex[:12]
+    self.changes = 0
+    self.lock = threading.RLock()
+    self.store = store
+    if store is not None:
+      self._load(store)
+
+  @property
+  def version(self) -> str:
+    return f"{self.boot}.{self.changes}"
+
+  def _load(self, store: SqliteStore):
+    for client_id, seq, last_seen in store.clients():
+      if seq is not None:
+        self.seqs[client_id] = seq
+      self.last_seen[client_id] = last_seen
+    for client_id, path, key in store.entries():
+      self.entries.setdefault(client_id, {})[path] = key
+      self.file_map.setdefault(key, set()).add((client_id, path))
+    # ranked with one sort rather than an insertion per entry
+    self.dup_keys = {k for k, v in self.file_map.items() if len(v) > 1}
+    self._ranked = sorted(self._rank(k, len(self.file_map[k]))
+                          for k in self.dup_keys)
+
+  @staticmethod
+  def _rank(key: str, count: int) -> Tuple[int, str]:
+    return -parse_key(key)[0] * (count - 1), key
+
+  def _rerank(self, key: str, old_count: int, new_count: int):
+    if old_count > 1:
+      i = bisect.bisect_left(self._ranked, self._rank(key, old_count))
+      del self._ranked[i]
+    if new_count > 1:
+      bisect.insort(self._ranked, self._rank(key, new_count))
+
+  def upsert(self, client_id: str, path: str, key: str):
+    files = self.entries.setdefault(client_id, {})
+    old = files.get(path)
+    if old == key:
+      return
+    if old is not None:
+      self._unlink(old, (client_id, path))
+    files[path] = key
+    members = self.file_map.setdefault(key, set())
+    members.add((client_id, path))
+    self._rerank(key, len(members) - 1, len(members))
+    if len(members) == 2:
+      self.dup_keys.add(key)
+    self.changes += 1
+
+  def remove(self, client_id: str, path: str):
+    old = self.entries.get(client_id, {}).pop(path, None)
+    if old is not None:
+      self._unlink(old, (client_id, path))
+
+  def _unlink(self, key: str, member: Member):
+    members = self.file_map.get(key)
+    if members is None:
+      return
+    if member not in members:
+      return
+    members.discard(member)
+    self._rerank(key, len(members) + 1, len(members))
+    if len(members) < 2:
+      self.dup_keys.discard(key)
+    if not members:
+      del self.file_map[key]
+    self.changes += 1
+
+  def apply(self, client_id: str, seq: Optional[int], upserts: Dict[str, str],
+            removed: Iterable[str], full: bool = False):
+    """Apply one client's changes; a full update replaces everything held
+    for that client. A seq of None leaves the client's sequence alone.
+    Raises ValueError, before anything is applied, on a malformed key."""
+    if not isinstance(upserts, dict):
+      raise ValueError("upserts must map paths to keys")
+    for key in upserts.values():
+      if not isinstance(key, str):
+        raise ValueError(f"malformed key {key!r}")
+      parse_key(key)
+    with self.lock:
+      if full:
+        removed = [p for p in self.entries.get(client_id, {})
+                   if p not in upserts]
+      else:
+        removed = list(removed)
+      now = time.time()
+      if self.store is not None:
+        self.store.save(client_id, seq, upserts, removed, now)
+      for path in removed:
+        self.remove(client_id, path)
+      for path, key in upserts.items():
+        self.upsert(client_id, path, key)
+      if seq is not None:
+        self.seqs[client_id] = seq
+      self.last_seen[client_id] = now
+
+  def expire_stale(self, max_age: float) -> List[str]:
+    """Forget clients that have not submitted for max_age seconds, so the
+    index only holds live machines. They resync in full if they return."""
+    with self.lock:
+      cutoff = time.time() - max_age
+      stale = [c for c, t in self.last_seen.items() if t < cutoff]
+      if not stale:
+        return stale
+      if self.store is not None:
+        self.store.drop_clients(stale)
+      for client_id in stale:
+        for path in list(self.entries.get(client_id, {})):
+          self.remove(client_id, path)
+        self.entries.pop(client_id, None)
+        self.seqs.pop(client_id, None)
+        self.last_seen.pop(client_id, None)
+      return stale
+
+  def invalidate_seq(self, client_id: str):
+    # while a streamed sync is in flight, its base no longer holds; if the
+    # session dies half way the client is made to resync in full
+    with self.lock:
+      if self.store is not None:
+        self.store.set_seq(client_id, None)
+      self.seqs.pop(client_id, None)
+
+  def paths(self, client_id: str) -> List[str]:
+    with self.lock:
+      return list(self.entries.get(client_id, {}))
+
+  def seq(self, client_id: str) -> Optional[int]:
+    with self.lock:
+      return self.seqs.get(client_id)
+
+  def results(self) -> Dict[str, List[str]]:
+    with self.lock:
+      return {k: [format_member(m) for m in v]
+              for k, v in self.file_map.items()}
+
+  def group(self, key: str) -> Optional[dict]:
+    with self.lock:
+      members = self.file_map.get(key)
+      if not members:
+        return None
+      size, _ = parse_key(key)
+      return {
+          "key": key,
+          "size": size,
+          "count": len(members),
+          "wasted": size * (len(members) - 1),
+          "paths": sorted(format_member(m) for m in members),
+      }
+
+  def duplicates(self, offset: int = 0,
+                 limit: Optional[int] = None) -> List[dict]:
+    """Duplicate groups, most wasted bytes first, from `offset` on (up to
+    `limit` of them); len(dup_keys) is the total."""
+    with self.lock:
+      end = None if limit is None else offset + max(limit, 0)
+      return [self.group(k) for _, k in self._ranked[offset:end]]
+
+  def _groups_for(self, keys: Iterable[str]) -> List[dict]:
+    groups = [self.group(k) for k in set(keys) if k in self.dup_keys]
+    return sorted(groups, key=lambda g: (-g["wasted"], g["key"]))
+
+  def lookup_path(self, path: str,
+                  client_id: Optional[str] = None) -> List[dict]:
+    with self.lock:
+      clients = [client_id] if client_id is not None else self.entries
+      return self._groups_for(self.entries[c][path] for c in clients
+                              if path in self.entries.get(c, {}))
+
+  def lookup_client(self, client_id: str) -> List[dict]:
+    with self.lock:
+      return self._groups_for(self.entries.get(client_id, {}).values())
@@ -0,0 +1,154 @@
+"""Seek-aware ordering of hash jobs, for spinning disks.
+
+Scanners hand jobs to the hash engine in walk order, which on a rotational
+disk means a seek for nearly every file. With an IoScheduler the engine
+takes jobs a window at a time and submits each window sorted by device,
+then by where the data sits:
+
+  order="inode"   inode number, which on most filesystems follows the
+                  on-disk layout of inode tables and roughly of data
+  order="extent"  physical offset of the file's first extent (FIEMAP
+                  ioctl), falling back to the inode number where the
+                  filesystem does not support it
+
+Devices are interleaved and each keeps at most `per_device` reads in
+flight, so two disks stream in parallel instead of thrashing one. Results
+are still delivered in the caller's order (see HashEngine.imap).
+
+Kernel hints, where posix_fadvise exists: the first `prefetch` bytes of
+the next file on the same device are requested with WILLNEED as a read
+finishes, so the disk does not idle between files. Optionally, files of at
+least `drop_min` bytes (DONTNEED_MIN is a sensible threshold) are dropped
+from the page cache with DONTNEED once hashed, so a scan streaming through
+large files does not evict everything else cached. That is off by default:
+the drop also evicts pages that were cached before the scan, which hurts
+when the large files are ones in active use. hashing.file_digest marks
+every read SEQUENTIAL by itself.
+
+Every scanner takes the same two settings: io_order (None for walk order)
+and per_device, e.g. reclaim --io-order, FileDuplication(io_order=...),
+client_v2.FileHash(io_order=...) and FileDedup(io_order=...).
+"""
+import fcntl
+import os
+import struct
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from filededup.hash_engine import HashFunc, Job
+
+DEFAULT_WINDOW = 4096
+DEFAULT_PER_DEVICE = 2
+PREFETCH_BYTES = 1024 * 1024
+DONTNEED_MIN = 8 * 1024 * 1024
+ORDERS = ("inode", "extent")
+
+# _IOWR('f', 11, struct fiemap) from linux/fs.h
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap with room for one struct fiemap_extent
+_fiemap = struct.Struct("=QQIIII")
+_FIEMAP_EXTENT_SIZE = 56
+
+_has_fadvise = hasattr(os, "posix_fadvise")
+
+
+def _advise(path: str, offset: int, length: int, advice: int):
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.posix_fadvise(fd, offset, length, advice)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+
+def first_extent(path: str) -> Optional[int]:
+  """Physical byte offset of the file's first extent, if the filesystem
+  reports one."""
+  buf = bytearray(_fiemap.pack(0, 2 ** 64 - 1, 0, 0, 1, 0)
+                  + bytes(_FIEMAP_EXTENT_SIZE))
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return None
+  try:
+    fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+  except OSError:
+    return None
+  finally:
+    os.close(fd)
+  mapped = _fiemap.unpack_from(buf)[3]
+  if not mapped:
+    return None
+  # fe_physical follows fe_logical in the first extent
+  return struct.unpack_from("=Q", buf, _fiemap.size + 8)[0]
+
+
+class IoScheduler:
+
+  def __init__(self, order: str = "inode", per_device: int = DEFAULT_PER_DEVICE,
+               window: int = DEFAULT_WINDOW, prefetch: int = PREFETCH_BYTES,
+               drop_min: Optional[int] = None):
+    if order not in ORDERS:
+      raise ValueError(f"unknown order {order}, expected one of {ORDERS}")
+    self.order = order
+    self.per_device = max(per_device, 1)
+    self.window = max(window, 1)
+    self.prefetch = prefetch
+    self.drop_min = drop_min
+    self.semaphores: Dict[int, threading.Semaphore] = {}
+    self.lock = threading.Lock()
+
+  def _position(self, path: str) -> Tuple[int, int]:
+    # (device, position on it); unreadable files sort first and fail fast
+    try:
+      st = os.stat(path)
+    except OSError:
+      return -1, 0
+    if self.order == "extent":
+      physical = first_extent(path)
+      if physical is not None:
+        return st.st_dev, physical
+    return st.st_dev, st.st_ino
+
+  def plan(self, jobs: List[Job]) -> List[Tuple[int, int, Optional[str]]]:
+    """Submission order for a window of jobs: (index into jobs, device,
+    path of the next job on the same device)."""
+    by_dev: Dict[int, List[Tuple[int, int]]] = {}
+    for i, (path, _) in enumerate(jobs):
+      dev, pos = self._position(path)
+      by_dev.setdefault(dev, []).append((pos, i))
+    queues = []
+    for dev, items in by_dev.items():
+      items.sort()
+      order = [i for _, i in items]
+      nexts = [jobs[j][0] for j in order[1:]] + [None]
+      queues.append([(i, dev, n) for i, n in zip(order, nexts)])
+    # round robin over devices
+    ret = []
+    for k in range(max((len(q) for q in queues), default=0)):
+      ret.extend(q[k] for q in queues if k < len(q))
+    return ret
+
+  def _semaphore(self, dev: int) -> threading.Semaphore:
+    with self.lock:
+      sem = self.semaphores.get(dev)
+      if sem is None:
+        sem = self.semaphores[dev] = threading.Semaphore(self.per_device)
+      return sem
+
+  def run(self, func: HashFunc, dev: int, next_path: Optional[str],
+          path: str, size: int) -> str:
+    # in a worker thread: one of the device's read slots for the job
+    with self._semaphore(dev):
+      try:
+        return func(path, size)
+      finally:
+        if _has_fadvise:
+          if self.drop_min is not None and size >= self.drop_min:
+            _advise(path, 0, 0, os.POSIX_FADV_DONTNEED)
+          if next_path is not None and self.prefetch:
+            _advise(next_path, 0, self.prefetch, os.POSIX_FADV_WILLNEED)
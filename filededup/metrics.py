@@ -0,0 +1,454 @@
+"""Process-wide metrics for the dedup clients and servers.
+
+Counters, gauges and histograms are registered once per process and
+updated from wherever the work happens: the walker counts files found, the
+hash cache its hits and misses, the hash engine its queue and the bytes it
+hashed, and the servers what each client sends and how long each request
+takes. render() writes them in the Prometheus text format, served at
+/metrics by the Flask servers (see filededup.query) and by serve_http()
+for the asyncio ones:
+
+  dedup_files_discovered_total 120345
+  dedup_request_seconds_bucket{route="/sync",le="0.05"} 17
+
+Labels are kept to small fixed sets (route, lookup result). Per-client
+ingest is a TopClients metric: the TOP_CLIENTS busiest clients get their
+own series and the rest are summed under client="other", so the series
+count stays fixed however large the fleet grows:
+
+  dedup_client_ingest_bytes{client="m17"} 73400320
+  dedup_client_ingest_bytes{client="other"} 1048576
+
+StatusLine condenses the same numbers into one line with rates since the
+previous line, for periodic logging:
+
+  files 120345 (+2210/s) hashed 80211 (+1503/s, 61.2 MB/s) cache 92% hit
+  queue 14 | index 98001 files 2304 groups 3 clients ingest 812/s 0.4 MB/s
+"""
+import abc
+import asyncio
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+STATUS_INTERVAL = 5.0
+# clients given their own series by a TopClients metric, and the most it
+# counts apart before folding the smaller ones into "other"
+TOP_CLIENTS = 10
+TRACKED_CLIENTS = 1000
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str],
+                   extra: str = "") -> str:
+  pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+  return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_value(value: float) -> str:
+  return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric(abc.ABC):
+  kind = ""
+
+  def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labels)
+    self.lock = threading.Lock()
+
+  def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+    if set(labels) != set(self.labelnames):
+      raise ValueError(f"{self.name} takes labels {self.labelnames}, "
+                       f"got {tuple(labels)}")
+    return tuple(str(labels[n]) for n in self.labelnames)
+
+  @abc.abstractmethod
+  def samples(self) -> List[Tuple[str, str, float]]:
+    # (name suffix, formatted labels, value)
+    pass
+
+  def render(self) -> str:
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+    for suffix, labels, value in self.samples():
+      lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+  kind = "counter"
+
+  def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+    super().__init__(name, help, labels)
+    self.values: Dict[Tuple[str, ...], float] = {}
+
+  def inc(self, amount: float = 1, **labels):
+    key = self._key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def get(self, **labels) -> float:
+    with self.lock:
+      return self.values.get(self._key(labels), 0)
+
+  def total(self) -> float:
+    with self.lock:
+      return sum(self.values.values())
+
+  def samples(self):
+    with self.lock:
+      items = sorted(self.values.items())
+    if not items and not self.labelnames:
+      items = [((), 0)]
+    return [("", _format_labels(self.labelnames, k), v) for k, v in items]
+
+
+class Gauge(Counter):
+  kind = "gauge"
+
+  def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+    super().__init__(name, help, labels)
+    self.function: Optional[Callable[[], float]] = None
+
+  def set(self, value: float, **labels):
+    key = self._key(labels)
+    with self.lock:
+      self.values[key] = value
+
+  def dec(self, amount: float = 1, **labels):
+    self.inc(-amount, **labels)
+
+  def set_function(self, function: Optional[Callable[[], float]]):
+    """Report function() instead of the stored value; unlabeled gauges
+    only."""
+    self.function = function
+
+  def get(self, **labels) -> float:
+    if self.function is not None:
+      return self.function()
+    return super().get(**labels)
+
+  def samples(self):
+    if self.function is not None:
+      return [("", "", self.function())]
+    return super().samples()
+
+
+class Histogram(_Metric):
+  kind = "histogram"
+
+  def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+               buckets: Sequence[float] = LATENCY_BUCKETS):
+    super().__init__(name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+    # labels -> (count per bucket, +Inf last), sum
+    self.values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+  def observe(self, value: float, **labels):
+    key = self._key(labels)
+    with self.lock:
+      counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+          break
+      else:
+        counts[-1] += 1
+      self.values[key] = (counts, total + value)
+
+  def time(self, **labels) -> "_Timer":
+    return _Timer(self, labels)
+
+  def totals(self) -> Tuple[int, float]:
+    # (observations, sum) over all labels
+    with self.lock:
+      return (sum(sum(c) for c, _ in self.values.values()),
+              sum(s for _, s in self.values.values()))
+
+  def samples(self):
+    ret = []
+    with self.lock:
+      items = sorted((k, (list(c), s)) for k, (c, s) in self.values.items())
+    for key, (counts, total) in items:
+      cumulative = 0
+      for bound, n in zip(self.buckets + (float("inf"),), counts):
+        cumulative += n
+        le = "+Inf" if bound == float("inf") else _format_value(bound)
+        ret.append(("_bucket",
+                    _format_labels(self.labelnames, key, f'le="{le}"'),
+                    cumulative))
+      ret.append(("_sum", _format_labels(self.labelnames, key), total))
+      ret.append(("_count", _format_labels(self.labelnames, key), cumulative))
+    return ret
+
+
+class TopClients(_Metric):
+  """Per-client totals, rendered for the `top` largest clients plus one
+  "other" series for the rest. At most `tracked` clients are counted
+  apart; past that the smaller half are folded into "other" for good."""
+  kind = "gauge"
+
+  def __init__(self, name: str, help: str, top: int = TOP_CLIENTS,
+               tracked: int = TRACKED_CLIENTS):
+    super().__init__(name, help, ["client"])
+    self.top = top
+    self.tracked = max(tracked, top)
+    self.values: Dict[str, float] = {}
+    self.other = 0.0
+
+  def inc(self, client: str, amount: float = 1):
+    with self.lock:
+      if client not in self.values and len(self.values) >= self.tracked:
+        ranked = sorted(self.values, key=self.values.get)
+        for folded in ranked[:len(ranked) // 2]:
+          self.other += self.values.pop(folded)
+      self.values[client] = self.values.get(client, 0) + amount
+
+  def get(self, client: str) -> float:
+    with self.lock:
+      return self.values.get(client, 0)
+
+  def samples(self):
+    with self.lock:
+      ranked = sorted(self.values.items(), key=lambda kv: (-kv[1], kv[0]))
+      other = self.other + sum(v for _, v in ranked[self.top:])
+    ret = [("", _format_labels(self.labelnames, (c,)), v)
+           for c, v in ranked[:self.top]]
+    ret.append(("", _format_labels(self.labelnames, ("other",)), other))
+    return ret
+
+
+class _Timer:
+
+  def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+
+  def __init__(self):
+    self.metrics: Dict[str, _Metric] = {}
+    self.lock = threading.Lock()
+
+  def _get(self, cls, name: str, *args, **kwargs):
+    # the same name always returns the same metric
+    with self.lock:
+      metric = self.metrics.get(name)
+      if metric is None:
+        metric = self.metrics[name] = cls(name, *args, **kwargs)
+      elif not isinstance(metric, cls):
+        raise ValueError(f"{name} is already a {metric.kind}")
+      return metric
+
+  def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+    return self._get(Counter, name, help, labels)
+
+  def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+    return self._get(Gauge, name, help, labels)
+
+  def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return self._get(Histogram, name, help, labels, buckets)
+
+  def top_clients(self, name: str, help: str,
+                  top: int = TOP_CLIENTS) -> TopClients:
+    return self._get(TopClients, name, help, top)
+
+  def render(self) -> str:
+    with self.lock:
+      metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+    return "".join(m.render() for m in metrics)
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# scanning
+FILES_DISCOVERED = REGISTRY.counter(
+    "dedup_files_discovered_total", "Regular files found by the walker.")
+BYTES_DISCOVERED = REGISTRY.counter(
+    "dedup_bytes_discovered_total", "Size of the files found by the walker.")
+WALK_QUEUE = REGISTRY.gauge(
+    "dedup_walk_queue_batches", "Directory batches waiting for the consumer.")
+CACHE_LOOKUPS = REGISTRY.counter(
+    "dedup_cache_lookups_total", "Hash cache lookups.", ["result"])
+FILES_HASHED = REGISTRY.counter(
+    "dedup_files_hashed_total", "Jobs completed by the hash engine.")
+BYTES_HASHED = REGISTRY.counter(
+    "dedup_bytes_hashed_total", "Size of the files of completed hash jobs.")
+HASH_QUEUE = REGISTRY.gauge(
+    "dedup_hash_queue_jobs", "Hash jobs submitted and not yet finished.")
+HASH_INFLIGHT_BYTES = REGISTRY.gauge(
+    "dedup_hash_inflight_bytes", "Size of the files being hashed.")
+
+# serving
+INGEST_ENTRIES = REGISTRY.counter(
+    "dedup_ingest_entries_total", "Upserts and removals applied.")
+INGEST_BYTES = REGISTRY.counter(
+    "dedup_ingest_bytes_total", "Sync payload bytes applied.")
+INGEST_PAYLOAD = REGISTRY.histogram(
+    "dedup_ingest_payload_bytes", "Size of each sync payload.",
+    buckets=SIZE_BUCKETS)
+INDEX_FILES = REGISTRY.gauge("dedup_index_files", "Files in the index.")
+INDEX_GROUPS = REGISTRY.gauge("dedup_index_groups", "Duplicate groups in the index.")
+INDEX_CLIENTS = REGISTRY.gauge("dedup_index_clients", "Clients in the index.")
+CLIENT_INGEST_ENTRIES = REGISTRY.top_clients(
+    "dedup_client_ingest_entries",
+    "Upserts and removals applied, for the busiest clients.")
+CLIENT_INGEST_BYTES = REGISTRY.top_clients(
+    "dedup_client_ingest_bytes",
+    "Sync payload bytes applied, for the busiest clients.")
+REQUEST_SECONDS = REGISTRY.histogram(
+    "dedup_request_seconds", "Server request latency.", ["route"])
+
+
+def render() -> str:
+  return REGISTRY.render()
+
+
+def record_ingest(entries: int, payload_bytes: int,
+                  client_id: Optional[str] = None):
+  # call once the sync data has been applied, not for rejected messages
+  INGEST_ENTRIES.inc(entries)
+  if client_id is not None:
+    CLIENT_INGEST_ENTRIES.inc(client_id, entries)
+  if payload_bytes:
+    INGEST_BYTES.inc(payload_bytes)
+    INGEST_PAYLOAD.observe(payload_bytes)
+    if client_id is not None:
+      CLIENT_INGEST_BYTES.inc(client_id, payload_bytes)
+
+
+_tracked_index = None
+_track_lock = threading.Lock()
+
+
+def track_index(index) -> None:
+  """Report the size of a FileIndex in the index gauges. A process serves
+  one index: tracking the same one again is a no-op, tracking another
+  raises ValueError."""
+  global _tracked_index
+  with _track_lock:
+    if _tracked_index is index:
+      return
+    if _tracked_index is not None:
+      raise ValueError("the index gauges already track another index")
+    _tracked_index = index
+
+  def read(func: Callable[[], float]) -> Callable[[], float]:
+    def locked() -> float:
+      with index.lock:
+        return func()
+    return locked
+
+  INDEX_FILES.set_function(read(lambda: sum(len(f) for f in index.entries.values())))
+  INDEX_GROUPS.set_function(read(lambda: len(index.dup_keys)))
+  INDEX_CLIENTS.set_function(read(lambda: len(index.entries)))
+
+
+class StatusLine:
+  """One-line summaries of the metrics; rates cover the time since the
+  previous line()."""
+
+  def __init__(self):
+    self.last = self._snapshot()
+
+  @staticmethod
+  def _snapshot() -> dict:
+    requests, request_seconds = REQUEST_SECONDS.totals()
+    return {
+        "time": time.monotonic(),
+        "found": FILES_DISCOVERED.total(),
+        "hashed": FILES_HASHED.total(),
+        "hashed_bytes": BYTES_HASHED.total(),
+        "hits": CACHE_LOOKUPS.get(result="hit"),
+        "misses": CACHE_LOOKUPS.get(result="miss"),
+        "ingest": INGEST_ENTRIES.total(),
+        "ingest_bytes": INGEST_BYTES.total(),
+        "requests": requests,
+        "request_seconds": request_seconds,
+    }
+
+  def line(self) -> str:
+    now = self._snapshot()
+    last, self.last = self.last, now
+    elapsed = max(now["time"] - last["time"], 1e-9)
+
+    def rate(name: str) -> float:
+      return (now[name] - last[name]) / elapsed
+
+    parts = []
+    if now["found"] or now["hashed"]:
+      scan = (f'files {now["found"]:.0f} (+{rate("found"):.0f}/s) '
+              f'hashed {now["hashed"]:.0f} (+{rate("hashed"):.0f}/s, '
+              f'{rate("hashed_bytes") / 1e6:.1f} MB/s)')
+      lookups = now["hits"] + now["misses"]
+      if lookups:
+        scan += f' cache {100 * now["hits"] / lookups:.0f}% hit'
+      scan += f" queue {HASH_QUEUE.get():.0f}"
+      parts.append(scan)
+    if INDEX_FILES.function is not None:
+      serve = (f"index {INDEX_FILES.get():.0f} files "
+               f"{INDEX_GROUPS.get():.0f} groups {INDEX_CLIENTS.get():.0f} clients "
+               f'ingest {rate("ingest"):.0f}/s {rate("ingest_bytes") / 1e6:.1f} MB/s')
+      requests = now["requests"] - last["requests"]
+      if requests:
+        mean = (now["request_seconds"] - last["request_seconds"]) / requests
+        serve += f" requests {requests / elapsed:.1f}/s mean {mean * 1e3:.1f} ms"
+      parts.append(serve)
+    return " | ".join(parts) or "idle"
+
+
+async def report_status(prefix: str = "", interval: float = STATUS_INTERVAL,
+                        stop: Optional[Callable[[], bool]] = None):
+  """Print a status line every interval seconds until stop() is true."""
+  status = StatusLine()
+  while stop is None or not stop():
+    await asyncio.sleep(interval)
+    print(f"{prefix}{status.line()}")
+
+
+async def _handle_http(reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter):
+  try:
+    request = await reader.readline()
+    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+      pass
+    parts = request.split()
+    if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+      status, body, ctype = "200 OK", render().encode(), CONTENT_TYPE
+    else:
+      status, body, ctype = "404 Not Found", b"not found\n", "text/plain"
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+                 .encode() + body)
+    await writer.drain()
+  except ConnectionError:
+    pass
+  finally:
+    writer.close()
+
+
+async def serve_http(host: str, port: int):
+  """Serve GET /metrics over plain HTTP, for the asyncio servers."""
+  server = await asyncio.start_server(_handle_http, host, port)
+  print(f"metrics on http://{host}:{port}/metrics")
+  async with server:
+    await server.serve_forever()
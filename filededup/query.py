@@ -0,0 +1,205 @@
+"""Duplicates-only query routes for the Flask dedup servers.
+
+  GET /duplicates?offset=0&limit=100[&format=ndjson]
+  GET /duplicates/hash/<key>
+  GET /duplicates/path?path=...[&client=...]
+  GET /duplicates/machine/<client_id>
+
+Groups are ranked by wasted bytes. Every response carries the index
+version as its ETag, so a poller sending If-None-Match gets an empty 304
+until something changes.
+
+The optional chunk-level routes (see filededup.chunking):
+
+  POST /chunks   {"client_id": ..., "base_seq": n, "seq": n + 1, "full": ...,
+                  "upserts": {path: [[digest, length], ...]},
+                  "removed": [path, ...]}    -> {"status": "ok"|"resync", ...}
+  GET  /chunks/report?limit=10
+  GET  /chunks/path?path=...[&client=...]
+
+The chunked sync upload routes (see filededup.upload):
+
+  POST /sync/begin
+  PUT  /sync/<id>/<n>
+  GET  /sync/<id>
+
+The two-phase size/edge reports (see filededup.two_phase):
+
+  POST /sizes    {"client_id": ..., "sizes": [[size, count], ...]}
+  POST /edges    {"client_id": ..., "edges": [[size, digest, count], ...]}
+
+And GET /metrics, the process metrics in the Prometheus text format (see
+filededup.metrics), with every request's latency recorded by route.
+"""
+import json
+import time
+import zlib
+from typing import Callable, Optional
+
+from flask import Blueprint, Response, abort, g, jsonify, request
+
+from filededup import metrics, wire
+from filededup.chunking import ChunkIndex
+from filededup.index import FileIndex
+from filededup.sync import SyncUploads
+from filededup.two_phase import SizeIndex
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 10000
+
+
+def conditional(index: FileIndex, build: Callable[[], Response]) -> Response:
+  # ETag is the index version; unchanged results cost an empty 304
+  etag = str(index.version)
+  if etag in request.if_none_match:
+    response = Response(status=304)
+  else:
+    response = build()
+  response.set_etag(etag)
+  return response
+
+
+def query_blueprint(index: FileIndex) -> Blueprint:
+  bp = Blueprint("query", __name__)
+  metrics.track_index(index)
+
+  @bp.route("/duplicates", methods=["GET"])
+  def duplicates():
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), 0),
+                MAX_PAGE_SIZE)
+    ndjson = request.args.get("format") == "ndjson"
+
+    def build():
+      with index.lock:
+        total = len(index.dup_keys)
+        page = index.duplicates(offset, limit)
+      if ndjson:
+        return Response((json.dumps(g) + "\n" for g in page),
+                        mimetype="application/x-ndjson")
+      return jsonify({"total": total, "offset": offset, "groups": page})
+
+    return conditional(index, build)
+
+  @bp.route("/duplicates/hash/<key>", methods=["GET"])
+  def by_hash(key: str):
+    group = index.group(key)
+    if group is None:
+      abort(404)
+    return conditional(index, lambda: jsonify(group))
+
+  @bp.route("/duplicates/path", methods=["GET"])
+  def by_path():
+    path = request.args.get("path")
+    if not path:
+      abort(400)
+    client_id = request.args.get("client")
+    return conditional(
+        index, lambda: jsonify({"groups": index.lookup_path(path, client_id)}))
+
+  @bp.route("/duplicates/machine/<client_id>", methods=["GET"])
+  def by_machine(client_id: str):
+    return conditional(
+        index, lambda: jsonify({"groups": index.lookup_client(client_id)}))
+
+  return bp
+
+
+def chunk_blueprint(chunks: ChunkIndex) -> Blueprint:
+  bp = Blueprint("chunks", __name__)
+
+  @bp.route("/chunks", methods=["POST"])
+  def submit_chunks():
+    try:
+      return jsonify(chunks.submit(request.get_json()))
+    except (KeyError, TypeError, ValueError) as e:
+      return jsonify({"status": "error", "error": repr(e)}), 400
+
+  @bp.route("/chunks/report", methods=["GET"])
+  def chunk_report():
+    limit = min(request.args.get("limit", 10, type=int), MAX_PAGE_SIZE)
+    return jsonify(chunks.report() | {"top_files": chunks.top_shared(limit)})
+
+  @bp.route("/chunks/path", methods=["GET"])
+  def shared_with():
+    path = request.args.get("path")
+    if not path:
+      abort(400)
+    member = (request.args.get("client", ""), path)
+    return jsonify({"shared": chunks.shared(member)})
+
+  return bp
+
+
+def upload_blueprint(uploads: SyncUploads,
+                     stale_after: Optional[float] = None) -> Blueprint:
+  bp = Blueprint("upload", __name__)
+
+  @bp.route("/sync/begin", methods=["POST"])
+  def begin_upload():
+    try:
+      return jsonify(uploads.begin(request.get_json()))
+    except (KeyError, TypeError, ValueError) as e:
+      return jsonify({"status": "error", "error": repr(e)}), 400
+
+  @bp.route("/sync/<upload_id>/<int:n>", methods=["PUT"])
+  def upload_frame(upload_id: str, n: int):
+    try:
+      reply = uploads.chunk(upload_id, n, request.get_data())
+    except (wire.ProtocolError, ValueError, IndexError, zlib.error) as e:
+      return jsonify({"status": "error", "error": str(e)}), 400
+    if "seq" in reply and stale_after is not None:
+      uploads.index.expire_stale(stale_after)
+    return jsonify(reply)
+
+  @bp.route("/sync/<upload_id>", methods=["GET"])
+  def upload_status(upload_id: str):
+    return jsonify(uploads.status(upload_id))
+
+  return bp
+
+
+def two_phase_blueprint(sizes: SizeIndex,
+                        stale_after: Optional[float] = None) -> Blueprint:
+  bp = Blueprint("two_phase", __name__)
+
+  def report(op: str):
+    if stale_after is not None:
+      sizes.expire(stale_after)
+    try:
+      reply = sizes.handle(op, request.get_json())
+    except (KeyError, TypeError, ValueError) as e:
+      return jsonify({"status": "error", "error": repr(e)}), 400
+    return jsonify(reply), (200 if reply["status"] == "ok" else 400)
+
+  @bp.route("/sizes", methods=["POST"])
+  def report_sizes():
+    return report("sizes")
+
+  @bp.route("/edges", methods=["POST"])
+  def report_edges():
+    return report("edges")
+
+  return bp
+
+
+def metrics_blueprint() -> Blueprint:
+  bp = Blueprint("metrics", __name__)
+
+  @bp.before_app_request
+  def start_timer():
+    g.request_start = time.perf_counter()
+
+  @bp.after_app_request
+  def observe(response: Response) -> Response:
+    start = g.pop("request_start", None)
+    if start is not None:
+      route = request.url_rule.rule if request.url_rule else "unmatched"
+      metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+    return response
+
+  @bp.route("/metrics", methods=["GET"])
+  def metrics_text():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+  return bp
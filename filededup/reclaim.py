@@ -0,0 +1,232 @@
+"""Reclaim the space held by duplicate files.
+
+  python -m filededup.reclaim ROOT [--mode hardlink|reflink] [--dry-run]
+                              [--log reclaim-undo.jsonl]
+                              [--io-order inode|extent] [--per-device 2]
+                              [--drop-hashed]
+  python -m filededup.reclaim --undo reclaim-undo.jsonl
+
+In each duplicate group the first path (in sort order) on each device is
+kept, and every other copy on that device is replaced by a hardlink to it
+or by a reflink (a copy-on-write clone via the FICLONE ioctl, on btrfs,
+XFS and other filesystems that support it). Paths that are already
+hardlinked are one file and are left alone. Only a copy with no other
+links is counted as reclaimed space: links outside the group keep its data
+alive. On spinning disks,
+--io-order hashes files in on-disk order (see filededup.io_scheduler).
+
+Before a copy is replaced it is compared with the kept file byte for byte,
+and both files' stats are checked again just before the swap, so a pair
+modified in the meantime is skipped. The replacement is built under a temporary name in
+the same directory and renamed over the copy, so the path always names a
+complete file.
+
+Every replacement is first appended to the undo log (path, kept file,
+permissions, owner, times); --undo turns each logged path back into an
+independent copy with its original metadata. A hardlink shares the kept
+file's metadata and data: a later write through either path changes both.
+A reflink keeps its own metadata and stays independent.
+"""
+import argparse
+import fcntl
+import filecmp
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from filededup.hash_engine import HashEngine
+from filededup.hashing import ALGORITHMS, DEFAULT_ALGO, staged_duplicates
+from filededup.io_scheduler import (DEFAULT_PER_DEVICE, DONTNEED_MIN, ORDERS,
+                                    IoScheduler)
+from filededup.walker import DEFAULT_THREADS, FileEntry, walk
+
+DEFAULT_LOG = "reclaim-undo.jsonl"
+MODES = ("hardlink", "reflink")
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+
+def find_groups(root_dir: str, engine: HashEngine,
+                algo: str = DEFAULT_ALGO) -> List[List[FileEntry]]:
+  """Duplicate groups under root_dir, one entry per inode, each sorted by
+  path and the groups sorted by bytes they waste."""
+  sizes: Dict[int, List[str]] = {}
+  entries: Dict[str, FileEntry] = {}
+  inodes = set()
+  for entry in walk(root_dir):
+    if entry.nlink > 1:
+      if (entry.dev, entry.ino) in inodes:
+        continue
+      inodes.add((entry.dev, entry.ino))
+    entries[entry.path] = entry
+    sizes.setdefault(entry.size, []).append(entry.path)
+  groups = [sorted(entries[p] for p in paths)
+            for paths in staged_duplicates(sizes, engine, algo).values()]
+  groups.sort(key=lambda g: -g[0].size * (len(g) - 1))
+  return groups
+
+
+def _clone(source: str, target: str):
+  with open(source, "rb") as src, open(target, "xb") as dst:
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _signature(st: os.stat_result) -> Tuple[int, int, int, int]:
+  return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _temp_name(path: str) -> str:
+  dir, name = os.path.split(path)
+  return os.path.join(dir, f".{name}.reclaim-{os.getpid()}")
+
+
+def replace(source: FileEntry, copy: FileEntry, mode: str,
+            log: Optional[TextIO] = None) -> bool:
+  """Replace `copy` by a link or clone of `source`. Returns False, leaving
+  `copy` untouched, if the two differ or either changed since it was
+  scanned."""
+  scanned = (source.dev, source.ino, source.size, source.mtime_ns)
+  st = os.lstat(copy.path)
+  if _signature(st) != (copy.dev, copy.ino, copy.size, copy.mtime_ns):
+    return False
+  if _signature(os.lstat(source.path)) != scanned:
+    return False
+  if not filecmp.cmp(source.path, copy.path, shallow=False):
+    return False
+  if log is not None:
+    # write ahead: undoing an entry whose swap never happened is harmless
+    log.write(json.dumps({
+        "path": copy.path, "source": source.path, "mode": mode,
+        "st_mode": st.st_mode, "uid": st.st_uid, "gid": st.st_gid,
+        "atime_ns": st.st_atime_ns, "mtime_ns": st.st_mtime_ns}) + "\n")
+    log.flush()
+    os.fsync(log.fileno())
+  tmp = _temp_name(copy.path)
+  try:
+    if mode == "hardlink":
+      os.link(source.path, tmp)
+    else:
+      _clone(source.path, tmp)
+      shutil.copystat(copy.path, tmp)
+      try:
+        os.chown(tmp, st.st_uid, st.st_gid)
+      except PermissionError:
+        pass
+    # a hardlink must point at the inode that was compared
+    linked = mode != "hardlink" or os.lstat(tmp).st_ino == source.ino
+    if (not linked or _signature(os.lstat(copy.path)) != _signature(st)
+        or _signature(os.lstat(source.path)) != scanned):
+      os.unlink(tmp)
+      return False
+    os.replace(tmp, copy.path)
+  except BaseException:
+    if os.path.lexists(tmp):
+      os.unlink(tmp)
+    raise
+  return True
+
+
+def reclaim(groups: List[List[FileEntry]], mode: str = "hardlink",
+            dry_run: bool = False, log_path: str = DEFAULT_LOG) -> Tuple[int, int]:
+  """Returns (files replaced, bytes reclaimed), or what they would be."""
+  replaced = reclaimed = 0
+  log = None if dry_run else open(log_path, "a")
+  try:
+    for group in groups:
+      by_dev: Dict[int, List[FileEntry]] = {}
+      for entry in group:
+        by_dev.setdefault(entry.dev, []).append(entry)
+      for source, *copies in by_dev.values():
+        for copy in copies:
+          if dry_run:
+            print(f"would {mode} {copy.path} -> {source.path}")
+            ok = True
+          else:
+            try:
+              ok = replace(source, copy, mode, log)
+            except OSError as e:
+              print(f"skipped {copy.path}: {e}")
+              continue
+            if not ok:
+              print(f"skipped {copy.path}: changed or not identical")
+          if ok:
+            replaced += 1
+            if copy.nlink == 1:
+              reclaimed += copy.size
+  finally:
+    if log is not None:
+      log.close()
+  return replaced, reclaimed
+
+
+def undo(log_path: str) -> int:
+  """Give every path in the undo log its own copy of the data again, with
+  its original metadata. Returns the number of paths restored."""
+  with open(log_path) as f:
+    records = [json.loads(line) for line in f if line.strip()]
+  restored = 0
+  for rec in reversed(records):
+    path = rec["path"]
+    if not os.path.isfile(path):
+      print(f"not restored, missing: {path}")
+      continue
+    tmp = _temp_name(path)
+    try:
+      shutil.copyfile(path, tmp)
+      os.chmod(tmp, rec["st_mode"] & 0o7777)
+      try:
+        os.chown(tmp, rec["uid"], rec["gid"])
+      except PermissionError:
+        pass
+      os.utime(tmp, ns=(rec["atime_ns"], rec["mtime_ns"]))
+      os.replace(tmp, path)
+    except OSError as e:
+      if os.path.lexists(tmp):
+        os.unlink(tmp)
+      print(f"not restored, {e}: {path}")
+      continue
+    restored += 1
+  return restored
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="replace duplicate files by hardlinks or reflinks")
+  parser.add_argument("root", nargs="?", help="directory to deduplicate")
+  parser.add_argument("--mode", choices=MODES, default="hardlink")
+  parser.add_argument("--dry-run", action="store_true",
+                      help="only report what would be replaced")
+  parser.add_argument("--log", default=DEFAULT_LOG, help="undo log to append to")
+  parser.add_argument("--undo", metavar="LOG",
+                      help="restore the paths recorded in an undo log")
+  parser.add_argument("--algo", choices=sorted(ALGORITHMS), default=DEFAULT_ALGO)
+  parser.add_argument("--workers", type=int, default=DEFAULT_THREADS)
+  parser.add_argument("--io-order", choices=ORDERS,
+                      help="hash in on-disk order, for rotational disks")
+  parser.add_argument("--per-device", type=int, default=DEFAULT_PER_DEVICE,
+                      help="reads in flight per device with --io-order")
+  parser.add_argument("--drop-hashed", action="store_true",
+                      help="with --io-order, drop large hashed files from the "
+                      "page cache, even if they were cached before")
+  args = parser.parse_args()
+  if args.undo:
+    print(f"restored {undo(args.undo)} files")
+    return
+  if not args.root:
+    parser.error("a root directory is required")
+  io = (IoScheduler(args.io_order, args.per_device,
+                    drop_min=DONTNEED_MIN if args.drop_hashed else None)
+        if args.io_order else None)
+  engine = HashEngine(args.workers, io=io)
+  try:
+    groups = find_groups(args.root, engine, args.algo)
+  finally:
+    engine.shutdown()
+  replaced, reclaimed = reclaim(groups, args.mode, args.dry_run, args.log)
+  verb = "would reclaim" if args.dry_run else "reclaimed"
+  print(f"{verb} {reclaimed} bytes in {replaced} files")
+
+
+if __name__ == "__main__":
+  main()
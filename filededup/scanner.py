@@ -0,0 +1,158 @@
+"""Tree scanner shared by the dedup clients.
+
+Hardlinks are hashed once per (device, inode), and file_keys() lists each
+inode under a single path, so links are never reported as duplicates: they
+take no extra space.
+"""
+import asyncio
+import functools
+import os
+import stat
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from filededup.hash_cache import HashCache
+from filededup.hash_engine import HashEngine
+from filededup.hashing import DEFAULT_ALGO, file_key, full_digest
+from filededup.walker import FileEntry, walk
+
+# (device, inode)
+Inode = Tuple[int, int]
+# path -> (size, digest, inode)
+FileStats = Dict[str, Tuple[int, str, Inode]]
+
+
+def file_keys(files: FileStats) -> Dict[str, str]:
+  """Wire keys (see filededup.hashing.file_key) for a file map, with each
+  inode listed once, under its first path in sort order."""
+  first: Dict[Inode, str] = {}
+  for path, (_, _, inode) in files.items():
+    other = first.get(inode)
+    if other is None or path < other:
+      first[inode] = path
+  return {path: file_key(*files[path][:2]) for path in first.values()}
+
+
+def _split(root_dir: str, cache: Optional[HashCache]
+          ) -> Tuple[FileStats, List[FileEntry]]:
+  # walk from root_dir; files whose stat key is cached need no reading
+  hits: FileStats = {}
+  misses: List[FileEntry] = []
+  for entry in walk(root_dir):
+    digest = cache.lookup(entry) if cache else None
+    if digest is None:
+      misses.append(entry)
+    else:
+      hits[entry.path] = (entry.size, digest, (entry.dev, entry.ino))
+  return hits, misses
+
+
+def _jobs(misses: List[FileEntry]
+         ) -> Tuple[List[Tuple[str, int]], Dict[str, List[FileEntry]]]:
+  # one hash job per inode; its hardlinks share the digest
+  inodes: Dict[Inode, List[FileEntry]] = {}
+  for entry in misses:
+    inodes.setdefault((entry.dev, entry.ino), []).append(entry)
+  links = {entries[0].path: entries for entries in inodes.values()}
+  return [(path, entries[0].size) for path, entries in links.items()], links
+
+
+def _record(ret: FileStats, cache: Optional[HashCache],
+            entries: List[FileEntry], digest: Optional[str]):
+  if digest is None:
+    return
+  for entry in entries:
+    ret[entry.path] = (entry.size, digest, (entry.dev, entry.ino))
+    if cache:
+      cache.store(entry, digest)
+
+
+def scan_tree(root_dir: str, cache: Optional[HashCache] = None,
+              engine: Optional[HashEngine] = None,
+              algo: str = DEFAULT_ALGO) -> FileStats:
+  # a cache must have been opened for the same algorithm
+  ret, misses = _split(root_dir, cache)
+  jobs, links = _jobs(misses)
+  if engine:
+    func = functools.partial(full_digest, algo=algo)
+    for (file_path, _), digest in engine.imap(func, jobs):
+      _record(ret, cache, links[file_path], digest)
+  else:
+    for file_path, size in jobs:
+      try:
+        digest = full_digest(file_path, size, algo)
+      except OSError:
+        continue
+      _record(ret, cache, links[file_path], digest)
+  if cache:
+    cache.commit(root_dir, ret)
+  return ret
+
+
+async def scan_tree_async(root_dir: str, engine: HashEngine,
+                          cache: Optional[HashCache] = None,
+                          algo: str = DEFAULT_ALGO) -> FileStats:
+  # like scan_tree, but the walk, cache I/O and hashing all run off the loop
+  ret, misses = await asyncio.to_thread(_split, root_dir, cache)
+  jobs, links = _jobs(misses)
+  func = functools.partial(full_digest, algo=algo)
+  async for (file_path, _), digest in engine.aimap(func, jobs):
+    _record(ret, cache, links[file_path], digest)
+  if cache:
+    await asyncio.to_thread(cache.commit, root_dir, ret)
+  return ret
+
+
+def _split_paths(paths: Iterable[str], cache: Optional[HashCache]
+                ) -> Tuple[List[str], FileStats, List[FileEntry]]:
+  # classify changed paths: gone, cached, or in need of hashing; a changed
+  # directory (created or moved in) is walked whole
+  gone: List[str] = []
+  hits: FileStats = {}
+  misses: List[FileEntry] = []
+  for path in paths:
+    try:
+      st = os.lstat(path)
+    except OSError:
+      gone.append(path)
+      continue
+    if stat.S_ISDIR(st.st_mode):
+      dir_hits, dir_misses = _split(path, cache)
+      hits.update(dir_hits)
+      misses.extend(dir_misses)
+    elif stat.S_ISREG(st.st_mode):
+      entry = FileEntry.from_stat(path, st)
+      digest = cache.lookup(entry) if cache else None
+      if digest is None:
+        misses.append(entry)
+      else:
+        hits[path] = (entry.size, digest, (entry.dev, entry.ino))
+    else:
+      gone.append(path)
+  return gone, hits, misses
+
+
+async def update_paths(files: FileStats, paths: Iterable[str],
+                       engine: HashEngine, cache: Optional[HashCache] = None,
+                       algo: str = DEFAULT_ALGO):
+  """Refresh `files` in place for just the given changed paths."""
+  gone, hits, misses = await asyncio.to_thread(_split_paths, list(paths), cache)
+  for path in gone:
+    files.pop(path, None)
+    prefix = os.path.join(path, "")
+    for file_path in [p for p in files if p.startswith(prefix)]:
+      del files[file_path]
+  files.update(hits)
+  jobs, links = _jobs(misses)
+  func = functools.partial(full_digest, algo=algo)
+  async for (file_path, _), digest in engine.aimap(func, jobs):
+    _record(files, cache, links[file_path], digest)
+  # a write through one link changes every other link to the same inode,
+  # but inotify only names the path that was written
+  linked = {(e.dev, e.ino): e for e in misses if e.nlink > 1}
+  if linked:
+    for path, (_, _, inode) in files.items():
+      entry = linked.get(inode)
+      if entry is not None and entry.path in files:
+        files[path] = files[entry.path]
+  if cache:
+    await asyncio.to_thread(cache.commit, gone=gone)
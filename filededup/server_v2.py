@@ -1,20 +1,56 @@
 from flask import Flask, jsonify, request
-from typing import Dict, Set
+
+from filededup.index import FileIndex
+from filededup.chunking import ChunkIndex
+from filededup.query import (chunk_blueprint, conditional, metrics_blueprint,
+                             query_blueprint, two_phase_blueprint,
+                             upload_blueprint)
+from filededup.storage import SqliteStore
+from filededup.sync import SyncUploads, apply_sync
+from filededup.two_phase import SizeIndex
 
 app = Flask(__name__)
 
-file_map: Dict[str, Set[str]] = {}
+db_path = "dedup_server_v2.sqlite"
+# entries of clients silent for this long are dropped
+stale_after = 7 * 24 * 3600
+
+index = FileIndex(SqliteStore(db_path))
+app.register_blueprint(query_blueprint(index))
+# chunk lists, for clients running in chunk mode (kept in memory only)
+chunks = ChunkIndex()
+app.register_blueprint(chunk_blueprint(chunks))
+app.register_blueprint(metrics_blueprint())
+# chunked, resumable /sync uploads (see filededup.upload)
+app.register_blueprint(upload_blueprint(SyncUploads(index), stale_after))
+# size/edge reports of two-phase clients (see filededup.two_phase); the
+# size counts are kept in the same database
+app.register_blueprint(two_phase_blueprint(SizeIndex(SqliteStore(db_path)),
+                                           stale_after))
 
 @app.route("/post", methods=["POST"])
 def post():
+  # legacy full-map submission; paths are not namespaced by client
   data = request.get_json()
-  for fname, hash_val in data.items():
-    file_map.setdefault(hash_val, set()).add(fname)
+  try:
+    index.apply("", None, data, [])
+  except (TypeError, ValueError) as e:
+    return jsonify({"status": "error", "error": str(e)}), 400
   return jsonify({"status": "succeed"})
 
+@app.route("/sync", methods=["POST"])
+def sync():
+  try:
+    reply = apply_sync(index, request.get_json(), request.content_length or 0)
+  except (KeyError, TypeError, ValueError) as e:
+    return jsonify({"status": "error", "error": repr(e)}), 400
+  index.expire_stale(stale_after)
+  return jsonify(reply)
+
 @app.route("/get", methods=["GET"])
 def get():
-  return jsonify({k: list(v) for k, v in file_map.items()})
+  # the whole map; pollers should prefer /duplicates
+  return conditional(index, lambda: jsonify(index.results()))
 
 if __name__ == "__main__":
   app.run(host = "0.0.0.0", port = 9999)
@@ -0,0 +1,246 @@
+"""Hash-prefix sharding of the dedup index across stream server processes.
+
+Every entry lives on shard int(digest[:8], 16) % N, so all members of a
+duplicate group land on the same shard and each shard ranks complete
+groups. Shards are plain StreamServers, each in its own process with its
+own index, lock and (optionally) SQLite file.
+
+ShardedClient splits a client's file map by shard and keeps one
+SyncClient per shard. A file whose digest changes simply leaves one shard's
+map and enters another's, so deltas and resyncs work per shard unchanged.
+
+ShardRouter answers the QUERY frames of filededup.wire by fanning out to
+every shard and merging the ranked groups (hash lookups go to the owning
+shard only). The combined version is the shards' versions joined by ".".
+
+Run N shards and a router on localhost:
+
+  python -m filededup.sharding --shards 4 --port 8765 [--db-prefix shard]
+
+The router listens on --port and shard i on --port + 1 + i. Every shard
+expires clients that have not synced for --stale-after seconds; a
+ShardedClient syncs with every shard on each push, so a live client stays
+known to all of them.
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import multiprocessing
+import signal
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from filededup import wire
+from filededup.hashing import parse_key
+from filededup.index import FileIndex
+from filededup.storage import SqliteStore
+from filededup.stream_server import StreamServer
+from filededup.sync import SyncClient
+
+# (host, port)
+Addr = Tuple[str, int]
+
+
+def shard_of(key: str, num_shards: int) -> int:
+  _, digest = parse_key(key)
+  return int(digest.rpartition(":")[2][:8], 16) % num_shards
+
+
+def parse_addrs(spec: str) -> List[Addr]:
+  # "host:port,host:port,..."
+  addrs = []
+  for item in spec.split(","):
+    host, _, port = item.strip().rpartition(":")
+    addrs.append((host or "localhost", int(port)))
+  return addrs
+
+
+def _rank(group: dict) -> Tuple[int, str]:
+  return (-group["wasted"], group["key"])
+
+
+class _Conn:
+  """A lazily (re)opened connection to one shard, used by one request at a
+  time."""
+
+  def __init__(self, addr: Addr):
+    self.addr = addr
+    self.reader: Optional[asyncio.StreamReader] = None
+    self.writer: Optional[asyncio.StreamWriter] = None
+    self.lock = asyncio.Lock()
+
+  async def open(self):
+    if self.writer is None:
+      self.reader, self.writer = await asyncio.open_connection(*self.addr)
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+    self.reader = self.writer = None
+
+
+class ShardedClient:
+
+  def __init__(self, client_id: str, addrs: List[Addr],
+               compression: Optional[str] = "gzip"):
+    self.conns = [_Conn(addr) for addr in addrs]
+    self.syncs = [SyncClient(client_id) for _ in addrs]
+    self.compression = compression
+
+  def split(self, files: Dict[str, str]) -> List[Dict[str, str]]:
+    parts: List[Dict[str, str]] = [{} for _ in self.conns]
+    for path, key in files.items():
+      parts[shard_of(key, len(parts))][path] = key
+    return parts
+
+  async def _push(self, i: int, files: Dict[str, str]) -> dict:
+    conn, sync = self.conns[i], self.syncs[i]
+    async with conn.lock:
+      try:
+        await conn.open()
+        for _ in range(2):
+          msg = sync.delta(files)
+          reply = await wire.send_sync(conn.reader, conn.writer, msg,
+                                       self.compression)
+          if sync.handle_reply(reply):
+            break
+        return reply
+      except (OSError, asyncio.IncompleteReadError, wire.ProtocolError):
+        # the shard dropped its seq when the session began, so the next
+        # push resyncs in full
+        conn.close()
+        raise
+
+  async def push(self, files: Dict[str, str]) -> List[dict]:
+    """Sync every shard concurrently; a shard that failed is reported as
+    {"status": "error", "error": ...} and retried on the next push."""
+    replies = await asyncio.gather(
+        *(self._push(i, part) for i, part in enumerate(self.split(files))),
+        return_exceptions=True)
+    return [r if isinstance(r, dict) else {"status": "error", "error": repr(r)}
+            for r in replies]
+
+  def close(self):
+    for conn in self.conns:
+      conn.close()
+
+
+class ShardRouter:
+
+  def __init__(self, addrs: List[Addr]):
+    self.conns = [_Conn(addr) for addr in addrs]
+
+  async def _ask(self, i: int, request: dict) -> dict:
+    conn = self.conns[i]
+    async with conn.lock:
+      try:
+        await conn.open()
+        return await wire.query(conn.reader, conn.writer, request)
+      except (OSError, asyncio.IncompleteReadError, wire.ProtocolError):
+        conn.close()
+        raise
+
+  async def query(self, request: dict) -> dict:
+    op = request.get("op")
+    if op == "hash":
+      try:
+        return await self._ask(shard_of(request["key"], len(self.conns)),
+                               request)
+      except (OSError, asyncio.IncompleteReadError, wire.ProtocolError) as e:
+        return {"status": "error", "error": f"shard unavailable: {e!r}"}
+    sub = {k: v for k, v in request.items() if k != "if_version"}
+    offset = limit = 0
+    if op == "duplicates":
+      offset = max(int(request.get("offset", 0)), 0)
+      limit = max(int(request.get("limit", 100)), 0)
+      # any shard may hold the whole requested page
+      sub.update(offset=0, limit=offset + limit)
+    try:
+      replies = await asyncio.gather(
+          *(self._ask(i, sub) for i in range(len(self.conns))))
+    except (OSError, asyncio.IncompleteReadError, wire.ProtocolError) as e:
+      return {"status": "error", "error": f"shard unavailable: {e!r}"}
+    for reply in replies:
+      if reply.get("status") != "ok":
+        return reply
+    version = ".".join(str(r["version"]) for r in replies)
+    if request.get("if_version") == version:
+      return {"status": "not_modified", "version": version}
+    groups = list(heapq.merge(*(r["groups"] for r in replies), key=_rank))
+    if op == "duplicates":
+      ret = {"total": sum(r["total"] for r in replies), "offset": offset,
+             "groups": groups[offset:offset + limit]}
+    else:
+      ret = {"groups": groups}
+    return {"status": "ok", "version": version, **ret}
+
+  async def handle(self, reader: asyncio.StreamReader,
+                   writer: asyncio.StreamWriter):
+    try:
+      while True:
+        try:
+          ftype, payload = await wire.read_frame(reader)
+        except asyncio.IncompleteReadError:
+          break
+        if ftype != wire.QUERY:
+          raise wire.ProtocolError(
+              f"the router only answers queries, got frame type {ftype}")
+        reply = await self.query(json.loads(payload))
+        writer.write(wire.encode_json(wire.REPLY, reply))
+        await writer.drain()
+    except (wire.ProtocolError, ConnectionError, ValueError, KeyError) as e:
+      print(f"router connection dropped: {e!r}")
+    finally:
+      writer.close()
+
+  async def serve(self, host: str, port: int):
+    server = await asyncio.start_server(self.handle, host, port)
+    print(f"shard router listening on {host}:{port}")
+    async with server:
+      await server.serve_forever()
+
+
+def run_shard(host: str, port: int, db_path: Optional[str] = None,
+              stale_after: Optional[float] = None):
+  index = FileIndex(SqliteStore(db_path) if db_path else None)
+  try:
+    asyncio.run(StreamServer(index, host, port, stale_after=stale_after).serve())
+  except KeyboardInterrupt:
+    pass
+
+
+def main():
+  parser = argparse.ArgumentParser(description="sharded dedup stream servers")
+  parser.add_argument("--shards", type=int, default=4)
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=8765,
+                      help="router port; shard i listens on port + 1 + i")
+  parser.add_argument("--db-prefix",
+                      help="shard i keeps its index in <prefix>-<i>.sqlite")
+  parser.add_argument("--stale-after", type=float, default=7 * 24 * 3600,
+                      help="shards expire clients silent for this many seconds")
+  args = parser.parse_args()
+  addrs = [("localhost", args.port + 1 + i) for i in range(args.shards)]
+  procs = []
+  for i, (_, port) in enumerate(addrs):
+    db = f"{args.db_prefix}-{i}.sqlite" if args.db_prefix else None
+    proc = multiprocessing.Process(
+        target=run_shard, args=(args.host, port, db, args.stale_after),
+        daemon=True)
+    proc.start()
+    procs.append(proc)
+  print("shards: " + ",".join(f"{h}:{p}" for h, p in addrs))
+  # exit normally on SIGTERM too, so the shards are taken down with us
+  signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+  try:
+    asyncio.run(ShardRouter(addrs).serve(args.host, args.port))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for proc in procs:
+      proc.terminate()
+
+
+if __name__ == "__main__":
+  main()
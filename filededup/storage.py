@@ -0,0 +1,102 @@
+"""Durable storage for the dedup server's FileIndex.
+
+SQLite in WAL mode: each applied sync message is written as one
+transaction, before the in-memory index is touched, so a crash never leaves
+the two out of step. On startup the index is rebuilt from a single scan of
+the entries table and clients resume with deltas instead of full resends.
+Queries are still served from the in-memory index (see filededup.index).
+The per-client size counts of two-phase clients (see filededup.two_phase)
+are kept in the same file.
+"""
+import sqlite3
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class SqliteStore:
+
+  def __init__(self, db_path: str):
+    self.db_path = db_path
+    # callers serialize access (FileIndex holds its lock around every call)
+    self.conn = sqlite3.connect(db_path, check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("PRAGMA synchronous=NORMAL")
+    with self.conn:
+      self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+          client_id TEXT, path TEXT, key TEXT, PRIMARY KEY (client_id, path))""")
+      self.conn.execute(
+          "CREATE INDEX IF NOT EXISTS entries_key ON entries (key)")
+      self.conn.execute(
+          "CREATE INDEX IF NOT EXISTS entries_path ON entries (path)")
+      self.conn.execute("""CREATE TABLE IF NOT EXISTS clients (
+          client_id TEXT PRIMARY KEY, seq INTEGER, last_seen REAL)""")
+      self.conn.execute("""CREATE TABLE IF NOT EXISTS sizes (
+          client_id TEXT, size INTEGER, count INTEGER,
+          PRIMARY KEY (client_id, size))""")
+      self.conn.execute("""CREATE TABLE IF NOT EXISTS size_clients (
+          client_id TEXT PRIMARY KEY, last_seen REAL)""")
+
+  def save(self, client_id: str, seq: Optional[int], upserts: Dict[str, str],
+           removed: Iterable[str], now: Optional[float] = None):
+    with self.conn:
+      self.conn.executemany(
+          "DELETE FROM entries WHERE client_id=? AND path=?",
+          ((client_id, p) for p in removed))
+      self.conn.executemany(
+          "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+          ((client_id, p, k) for p, k in upserts.items()))
+      self.conn.execute(
+          "INSERT INTO clients VALUES (?, ?, ?) ON CONFLICT (client_id) DO "
+          "UPDATE SET seq=coalesce(excluded.seq, seq), "
+          "last_seen=excluded.last_seen",
+          (client_id, seq, now if now is not None else time.time()))
+
+  def set_seq(self, client_id: str, seq: Optional[int]):
+    with self.conn:
+      self.conn.execute(
+          "INSERT INTO clients VALUES (?, ?, ?) ON CONFLICT (client_id) DO "
+          "UPDATE SET seq=excluded.seq", (client_id, seq, time.time()))
+
+  def drop_clients(self, client_ids: List[str]):
+    with self.conn:
+      for client_id in client_ids:
+        self.conn.execute("DELETE FROM entries WHERE client_id=?", (client_id,))
+        self.conn.execute("DELETE FROM clients WHERE client_id=?", (client_id,))
+
+  def clients(self) -> List[Tuple[str, Optional[int], float]]:
+    return self.conn.execute(
+        "SELECT client_id, seq, last_seen FROM clients").fetchall()
+
+  def entries(self) -> Iterator[Tuple[str, str, str]]:
+    return self.conn.execute("SELECT client_id, path, key FROM entries")
+
+  def save_sizes(self, client_id: str, changed: Dict[int, int],
+                 now: Optional[float] = None):
+    # changed: size -> new count, 0 to forget the size
+    with self.conn:
+      self.conn.executemany(
+          "DELETE FROM sizes WHERE client_id=? AND size=?",
+          ((client_id, s) for s, n in changed.items() if not n))
+      self.conn.executemany(
+          "INSERT OR REPLACE INTO sizes VALUES (?, ?, ?)",
+          ((client_id, s, n) for s, n in changed.items() if n))
+      self.conn.execute(
+          "INSERT OR REPLACE INTO size_clients VALUES (?, ?)",
+          (client_id, now if now is not None else time.time()))
+
+  def drop_size_clients(self, client_ids: List[str]):
+    with self.conn:
+      for client_id in client_ids:
+        self.conn.execute("DELETE FROM sizes WHERE client_id=?", (client_id,))
+        self.conn.execute("DELETE FROM size_clients WHERE client_id=?",
+                          (client_id,))
+
+  def size_clients(self) -> List[Tuple[str, float]]:
+    return self.conn.execute(
+        "SELECT client_id, last_seen FROM size_clients").fetchall()
+
+  def size_counts(self) -> Iterator[Tuple[str, int, int]]:
+    return self.conn.execute("SELECT client_id, size, count FROM sizes")
+
+  def close(self):
+    self.conn.close()
@@ -0,0 +1,192 @@
+"""Production dedup server on asyncio streams, speaking filededup.wire.
+
+Each ENTRIES/REMOVED frame is decoded and applied to the index as it
+arrives, so a submission is never materialized whole; index writes run in
+a worker thread to keep the loop free for other clients.
+
+Sync sessions and queries are timed and counted in filededup.metrics;
+--metrics-port serves them at /metrics and a status line is printed every
+--status-interval seconds.
+
+With a stale_after (--stale-after, in seconds), clients that have not
+synced for that long are expired after each completed sync.
+
+QUERY frames with op "sizes" or "edges" are the size/edge reports of
+two-phase clients (see filededup.two_phase).
+
+  python -m filededup.stream_server --port 8765 --db dedup_stream.sqlite \
+      [--metrics-port 9100]
+"""
+import argparse
+import asyncio
+import json
+from typing import Optional, Set
+
+from filededup import metrics, wire
+from filededup.hashing import ALGORITHMS
+from filededup.index import FileIndex
+from filededup.storage import SqliteStore
+from filededup.two_phase import SizeIndex
+
+# query ops, each timed under its own route label; anything else is
+# "query unknown", so clients cannot grow the label set
+QUERY_OPS = ("duplicates", "hash", "path", "machine", "sizes", "edges")
+
+
+class StreamServer:
+
+  def __init__(self, index: FileIndex, host: str = "0.0.0.0", port: int = 8765,
+               sizes: Optional[SizeIndex] = None,
+               stale_after: Optional[float] = None):
+    self.index = index
+    self.sizes = sizes if sizes is not None else SizeIndex()
+    self.stale_after = stale_after
+    self.host = host
+    self.port = port
+    metrics.track_index(index)
+
+  async def handle(self, reader: asyncio.StreamReader,
+                   writer: asyncio.StreamWriter):
+    peer = writer.get_extra_info("peername")
+    try:
+      while True:
+        try:
+          ftype, payload = await wire.read_frame(reader)
+        except asyncio.IncompleteReadError:
+          break
+        if ftype == wire.BEGIN:
+          with metrics.REQUEST_SECONDS.time(route="sync"):
+            await self._sync(json.loads(payload), reader, writer)
+        elif ftype == wire.QUERY:
+          request = json.loads(payload)
+          if not isinstance(request, dict):
+            raise wire.ProtocolError("query is not an object")
+          op = request.get("op")
+          route = f"query {op if op in QUERY_OPS else 'unknown'}"
+          with metrics.REQUEST_SECONDS.time(route=route):
+            if op in ("sizes", "edges"):
+              # size reports write to the store
+              reply = await asyncio.to_thread(self.query, request)
+            else:
+              reply = self.query(request)
+            writer.write(wire.encode_json(wire.REPLY, reply))
+            await writer.drain()
+        else:
+          raise wire.ProtocolError(f"unexpected frame type {ftype}")
+    except (wire.ProtocolError, asyncio.IncompleteReadError, ConnectionError,
+            ValueError, KeyError, TypeError) as e:
+      print(f"connection {peer} dropped: {e!r}")
+    finally:
+      writer.close()
+
+  async def _reply(self, writer: asyncio.StreamWriter, reply: dict):
+    writer.write(wire.encode_json(wire.REPLY, reply))
+    await writer.drain()
+
+  async def _sync(self, header: dict, reader: asyncio.StreamReader,
+                  writer: asyncio.StreamWriter):
+    client_id = str(header["client_id"])
+    full = bool(header["full"])
+    algo = header["algo"]
+    if algo not in ALGORITHMS:
+      await self._reply(writer, {"status": "error", "error": f"unknown algorithm {algo}"})
+      return
+    if not full and self.index.seq(client_id) != header["base_seq"]:
+      await self._reply(writer, {"status": "resync", "seq": self.index.seq(client_id)})
+      return
+    await asyncio.to_thread(self.index.invalidate_seq, client_id)
+    await self._reply(writer, {"status": "ok"})
+
+    seen: Optional[Set[str]] = set() if full else None
+    entries = payload_bytes = 0
+    while True:
+      ftype, payload = await wire.read_frame(reader)
+      payload_bytes += len(payload)
+      if ftype == wire.ENTRIES:
+        upserts = wire.decode_entries(payload, algo)
+        entries += len(upserts)
+        if seen is not None:
+          seen.update(upserts)
+        await asyncio.to_thread(self.index.apply, client_id, None, upserts, [])
+      elif ftype == wire.REMOVED:
+        removed = wire.decode_removed(payload)
+        entries += len(removed)
+        await asyncio.to_thread(self.index.apply, client_id, None, {}, removed)
+      elif ftype == wire.END:
+        removed = ([p for p in self.index.paths(client_id) if p not in seen]
+                   if seen is not None else [])
+        await asyncio.to_thread(self.index.apply, client_id, header["seq"], {},
+                                removed)
+        metrics.record_ingest(entries, payload_bytes, client_id)
+        await self._reply(writer, {"status": "ok", "seq": header["seq"]})
+        if self.stale_after is not None:
+          await asyncio.to_thread(self.index.expire_stale, self.stale_after)
+          await asyncio.to_thread(self.sizes.expire, self.stale_after)
+        return
+      else:
+        raise wire.ProtocolError(f"unexpected frame type {ftype} in sync")
+
+  def query(self, request: dict) -> dict:
+    op = request.get("op")
+    if op in ("sizes", "edges"):
+      return self.sizes.handle(op, request)
+    # "if_version" plays the role of an ETag
+    version = self.index.version
+    if request.get("if_version") == version:
+      return {"status": "not_modified", "version": version}
+    if op == "duplicates":
+      offset = max(int(request.get("offset", 0)), 0)
+      limit = max(int(request.get("limit", 100)), 0)
+      with self.index.lock:
+        ret = {"total": len(self.index.dup_keys), "offset": offset,
+               "groups": self.index.duplicates(offset, limit)}
+    elif op == "hash":
+      group = self.index.group(request["key"])
+      ret = {"groups": [group] if group else []}
+    elif op == "path":
+      ret = {"groups": self.index.lookup_path(request["path"], request.get("client"))}
+    elif op == "machine":
+      ret = {"groups": self.index.lookup_client(request["client_id"])}
+    else:
+      return {"status": "error", "error": f"unknown query {op}"}
+    return {"status": "ok", "version": version, **ret}
+
+  async def serve(self, metrics_port: Optional[int] = None,
+                  status_interval: Optional[float] = None):
+    server = await asyncio.start_server(self.handle, self.host, self.port)
+    print(f"stream server listening on {self.host}:{self.port}")
+    tasks = []
+    if metrics_port:
+      tasks.append(asyncio.create_task(metrics.serve_http(self.host, metrics_port)))
+    if status_interval:
+      tasks.append(asyncio.create_task(metrics.report_status(interval=status_interval)))
+    try:
+      async with server:
+        await server.serve_forever()
+    finally:
+      for task in tasks:
+        task.cancel()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="dedup stream server")
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--db", help="SQLite file for durable storage")
+  parser.add_argument("--stale-after", type=float, default=7 * 24 * 3600,
+                      help="expire clients silent for this many seconds")
+  parser.add_argument("--metrics-port", type=int,
+                      help="serve GET /metrics on this port")
+  parser.add_argument("--status-interval", type=float,
+                      default=metrics.STATUS_INTERVAL,
+                      help="seconds between status lines (0: none)")
+  args = parser.parse_args()
+  index = FileIndex(SqliteStore(args.db) if args.db else None)
+  sizes = SizeIndex(SqliteStore(args.db) if args.db else None)
+  asyncio.run(StreamServer(index, args.host, args.port, sizes=sizes,
+                           stale_after=args.stale_after).serve(
+      args.metrics_port, args.status_interval))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,175 @@
+"""Delta sync protocol between dedup clients and servers.
+
+A client sends only the entries that changed since the last snapshot the
+server acknowledged:
+
+  {"client_id": "...", "base_seq": n, "seq": n + 1, "full": false,
+   "upserts": {path: key, ...}, "removed": [path, ...]}
+
+The server applies it if `base_seq` is the sequence number it last
+acknowledged for that client and replies {"status": "ok", "seq": n + 1}.
+Otherwise (first contact, a server restart, a lost reply) it replies
+{"status": "resync"} and the client falls back to sending its whole file
+map with "full": true, which replaces everything held for it.
+
+SyncUploads is the server side of the same message uploaded as its
+filededup.wire frames, one HTTP request per frame (see filededup.upload):
+frames are applied as they arrive, and a retried or resumed frame that was
+already applied is only acknowledged again.
+"""
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+from filededup import metrics, wire
+from filededup.hashing import ALGORITHMS
+from filededup.index import FileIndex
+
+# unfinished (or finished but unacknowledged) uploads are kept this long
+UPLOAD_TTL = 3600
+
+
+class SyncClient:
+
+  def __init__(self, client_id: str):
+    self.client_id = client_id
+    self.seq = 0
+    self.acked: Dict[str, str] = {}
+    self.full = True
+    self.pending: Optional[Dict[str, str]] = None
+
+  def delta(self, files: Dict[str, str]) -> dict:
+    if self.full:
+      upserts, removed = dict(files), []
+    else:
+      upserts = {p: k for p, k in files.items() if self.acked.get(p) != k}
+      removed = [p for p in self.acked if p not in files]
+    self.pending = dict(files)
+    return {
+        "client_id": self.client_id,
+        "base_seq": self.seq,
+        "seq": self.seq + 1,
+        "full": self.full,
+        "upserts": upserts,
+        "removed": removed,
+    }
+
+  def handle_reply(self, reply: dict) -> bool:
+    # returns True if the last delta was acknowledged
+    if reply.get("status") == "ok" and self.pending is not None:
+      self.seq = reply["seq"]
+      self.acked = self.pending
+      self.pending = None
+      self.full = False
+      return True
+    self.full = True
+    return False
+
+  def push(self, files: Dict[str, str], send: Callable[[dict], dict]) -> bool:
+    # send a delta, falling back to a full resync if the server asks for one
+    for _ in range(2):
+      if self.handle_reply(send(self.delta(files))):
+        return True
+    return False
+
+
+def apply_sync(index: FileIndex, msg: dict, payload_bytes: int = 0) -> dict:
+  """Apply one sync message. A malformed one raises KeyError, TypeError or
+  ValueError before anything is applied."""
+  client_id = str(msg["client_id"])
+  seq = int(msg["seq"])
+  upserts = msg.get("upserts", {})
+  removed = msg.get("removed", [])
+  if not isinstance(removed, list):
+    raise ValueError("removed must be a list of paths")
+  with index.lock:
+    full = bool(msg.get("full"))
+    if not full and index.seq(client_id) != msg["base_seq"]:
+      return {"status": "resync", "seq": index.seq(client_id)}
+    index.apply(client_id, seq, upserts, removed, full)
+  metrics.record_ingest(len(upserts) + len(removed), payload_bytes, client_id)
+  return {"status": "ok", "seq": seq}
+
+
+class SyncUploads:
+
+  def __init__(self, index: FileIndex, ttl: float = UPLOAD_TTL):
+    self.index = index
+    self.ttl = ttl
+    # upload id -> session state
+    self.uploads: Dict[str, dict] = {}
+    self.lock = threading.Lock()
+
+  def begin(self, header: dict) -> dict:
+    """Start an upload of the message described by header (a
+    wire.begin_header()); a malformed header raises KeyError, TypeError or
+    ValueError."""
+    client_id = str(header["client_id"])
+    seq = int(header["seq"])
+    full = bool(header["full"])
+    if not isinstance(header["algo"], str) or header["algo"] not in ALGORITHMS:
+      return {"status": "error", "error": f"unknown algorithm {header['algo']}"}
+    with self.index.lock:
+      if not full and self.index.seq(client_id) != header["base_seq"]:
+        return {"status": "resync", "seq": self.index.seq(client_id)}
+      self.index.invalidate_seq(client_id)
+    upload_id = uuid.uuid4().hex
+    now = time.time()
+    with self.lock:
+      for stale in [k for k, u in self.uploads.items() if now - u["time"] > self.ttl]:
+        del self.uploads[stale]
+      self.uploads[upload_id] = {
+          "client_id": client_id, "seq": seq, "algo": header["algo"],
+          "seen": set() if full else None, "acked": -1,
+          "reply": None, "time": now, "lock": threading.Lock()}
+    return {"status": "ok", "upload": upload_id}
+
+  def status(self, upload_id: str) -> dict:
+    with self.lock:
+      upload = self.uploads.get(upload_id)
+    if upload is None:
+      return {"status": "resync"}
+    return {"status": "ok", "acked": upload["acked"]}
+
+  def chunk(self, upload_id: str, n: int, frame: bytes) -> dict:
+    """Apply frame n of an upload; replies {"status": "ok", "acked": m}
+    with m the last frame applied, plus "seq" once END is applied."""
+    with self.lock:
+      upload = self.uploads.get(upload_id)
+    if upload is None:
+      # expired, or the server restarted
+      return {"status": "resync"}
+    with upload["lock"]:
+      upload["time"] = time.time()
+      if n == upload["acked"] and upload["reply"] is not None:
+        return upload["reply"]
+      if n != upload["acked"] + 1:
+        return {"status": "ok", "acked": upload["acked"]}
+      client_id = upload["client_id"]
+      seen = upload["seen"]
+      ftype, payload = wire.decode_frame(frame)
+      reply = {"status": "ok", "acked": n}
+      if ftype == wire.ENTRIES:
+        upserts = wire.decode_entries(payload, upload["algo"])
+        entries = len(upserts)
+        if seen is not None:
+          seen.update(upserts)
+        self.index.apply(client_id, None, upserts, [])
+      elif ftype == wire.REMOVED:
+        removed = wire.decode_removed(payload)
+        entries = len(removed)
+        self.index.apply(client_id, None, {}, removed)
+      elif ftype == wire.END:
+        removed = ([p for p in self.index.paths(client_id) if p not in seen]
+                   if seen is not None else [])
+        entries = 0
+        self.index.apply(client_id, upload["seq"], {}, removed)
+        upload["seen"] = None
+        reply["seq"] = upload["seq"]
+      else:
+        raise wire.ProtocolError(f"unexpected frame type {ftype} in upload")
+      metrics.record_ingest(entries, len(frame), client_id)
+      upload["acked"] = n
+      upload["reply"] = reply
+      return reply
@@ -0,0 +1,239 @@
+"""Two-phase distributed dedup: sizes first, hashes only on collision.
+
+Most file sizes are unique across a fleet, and a file with a unique size
+cannot have a duplicate. So instead of hashing everything, a client:
+
+  1. walks its tree (stat only) and reports how many files it holds of
+     each size; the server replies with the reported sizes that are held
+     more than once fleet-wide;
+  2. optionally hashes the first and last EDGE_SIZE bytes of those files
+     and reports (size, edge digest) counts; the server again replies with
+     the pairs held more than once;
+  3. fully hashes only the files still colliding (the hash cache serves
+     unchanged ones) and syncs just those, as usual.
+
+Messages (HTTP POST /sizes and /edges, or QUERY frames with op "sizes" and
+"edges" on the stream server):
+
+  {"client_id": c, "sizes": [[size, count], ...]}
+      -> {"sizes": [size, ...]}
+  {"client_id": c, "edges": [[size, edge digest, count], ...]}
+      -> {"edges": [[size, edge digest], ...]}
+
+Each report replaces the client's previous one; a sizes report also
+clears the client's edges until it reports them again. A client that
+does not run the edges round (or has not yet) could hold a duplicate of
+any edge digest, so a pair counts as colliding if some other such client
+holds files of that size. Files of at most 2 * EDGE_SIZE bytes skip step
+2, since their edges would cover the whole file, and are hashed in full
+in step 3. When another machine later adds a file of the same size, the
+next round reports the size as colliding and it is hashed then, so
+results converge one round after the data does.
+
+With a SqliteStore (the one the FileIndex persists to), the size counts
+survive a server restart. Otherwise the first round after a restart would
+see every other client's sizes as unknown, and its sync would drop the
+entries the index had kept. Edge counts are not stored: until a client
+reports them again, its sizes count as colliding for every edge digest.
+"""
+import asyncio
+import functools
+import threading
+import time
+from collections import Counter
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, List,
+                    Optional, Set, Tuple)
+
+from filededup.hash_cache import HashCache
+from filededup.hash_engine import HashEngine
+from filededup.hashing import DEFAULT_ALGO, EDGE_SIZE, edge_digest, full_digest
+from filededup.scanner import FileStats, Inode, _record
+from filededup.storage import SqliteStore
+from filededup.walker import FileEntry, walk
+
+# ask(op, msg) sends a report and returns the server's reply
+Ask = Callable[[str, dict], Awaitable[dict]]
+# (dev, ino, size, mtime_ns) -> edge digest, kept across rounds
+EdgeCache = Dict[Tuple[int, int, int, int], str]
+
+
+class SizeIndex:
+  """Server side: per-client size (and edge digest) counts, and which of
+  them are held more than once across all clients."""
+
+  def __init__(self, store: Optional[SqliteStore] = None):
+    # client_id -> size -> count
+    self.sizes: Dict[str, Counter] = {}
+    self.size_totals: Counter = Counter()
+    # client_id -> (size, edge digest) -> count
+    self.edges: Dict[str, Counter] = {}
+    self.edge_totals: Counter = Counter()
+    # clients whose latest sizes report was followed by an edges report
+    self.edge_clients: Set[str] = set()
+    self.last_seen: Dict[str, float] = {}
+    self.lock = threading.Lock()
+    self.store = store
+    if store is not None:
+      for client_id, last_seen in store.size_clients():
+        self.last_seen[client_id] = last_seen
+      for client_id, size, n in store.size_counts():
+        self.sizes.setdefault(client_id, Counter())[size] = n
+      for held in self.sizes.values():
+        self.size_totals.update(held)
+
+  @staticmethod
+  def _replace(held: Dict[str, Counter], totals: Counter, client_id: str,
+               new: Counter):
+    for key, n in held.pop(client_id, Counter()).items():
+      totals[key] -= n
+      if totals[key] <= 0:
+        del totals[key]
+    totals.update(new)
+    if new:
+      held[client_id] = new
+
+  def report_sizes(self, client_id: str, sizes: List[List[int]]) -> List[int]:
+    new = Counter({int(size): int(n) for size, n in sizes if int(n) > 0})
+    now = time.time()
+    with self.lock:
+      if self.store is not None:
+        # only the counts that changed since the last report
+        old = self.sizes.get(client_id, Counter())
+        changed = {s: new[s] for s in old.keys() | new.keys()
+                   if old[s] != new[s]}
+        self.store.save_sizes(client_id, changed, now)
+      self._replace(self.sizes, self.size_totals, client_id, new)
+      self._replace(self.edges, self.edge_totals, client_id, Counter())
+      self.edge_clients.discard(client_id)
+      self.last_seen[client_id] = now
+      return sorted(s for s in new if self.size_totals[s] > 1)
+
+  def report_edges(self, client_id: str,
+                   edges: List[List[Any]]) -> List[Tuple[int, str]]:
+    new = Counter({(int(size), str(digest)): int(n)
+                   for size, digest, n in edges if int(n) > 0})
+    with self.lock:
+      self._replace(self.edges, self.edge_totals, client_id, new)
+      self.edge_clients.add(client_id)
+      self.last_seen[client_id] = time.time()
+      others = [held for c, held in self.sizes.items()
+                if c != client_id and c not in self.edge_clients]
+      return sorted(k for k in new if self.edge_totals[k] > 1
+                    or any(k[0] in held for held in others))
+
+  def handle(self, op: str, msg: dict) -> dict:
+    """Answer a "sizes" or "edges" report; a malformed one raises KeyError,
+    TypeError or ValueError before anything is recorded."""
+    client_id = str(msg["client_id"])
+    if op in ("sizes", "edges") and not isinstance(msg[op], list):
+      raise ValueError(f"{op} must be a list")
+    if op == "sizes":
+      return {"status": "ok", "sizes": self.report_sizes(client_id, msg["sizes"])}
+    if op == "edges":
+      return {"status": "ok", "edges": self.report_edges(client_id, msg["edges"])}
+    return {"status": "error", "error": f"unknown report {op}"}
+
+  def expire(self, max_age: float) -> List[str]:
+    """Forget clients that have not reported for max_age seconds."""
+    cutoff = time.time() - max_age
+    with self.lock:
+      stale = [c for c, t in self.last_seen.items() if t < cutoff]
+      if stale and self.store is not None:
+        self.store.drop_size_clients(stale)
+      for client_id in stale:
+        self._replace(self.sizes, self.size_totals, client_id, Counter())
+        self._replace(self.edges, self.edge_totals, client_id, Counter())
+        self.edge_clients.discard(client_id)
+        del self.last_seen[client_id]
+    return stale
+
+
+def _edge_key(entry: FileEntry) -> Tuple[int, int, int, int]:
+  return (entry.dev, entry.ino, entry.size, entry.mtime_ns)
+
+
+def _lookup(cache: Optional[HashCache], entries: List[FileEntry]
+           ) -> Tuple[Dict[Inode, str], List[FileEntry]]:
+  # cached full digests, and the entries left to hash
+  hits: Dict[Inode, str] = {}
+  misses: List[FileEntry] = []
+  for entry in entries:
+    digest = cache.lookup(entry) if cache else None
+    if digest is None:
+      misses.append(entry)
+    else:
+      hits[(entry.dev, entry.ino)] = digest
+  return hits, misses
+
+
+async def two_phase_scan(root_dir: str, engine: HashEngine, ask: Ask,
+                         client_id: str, cache: Optional[HashCache] = None,
+                         algo: str = DEFAULT_ALGO, partial: bool = False,
+                         edge_cache: Optional[EdgeCache] = None) -> FileStats:
+  """One round of the protocol; returns the file map of just the files
+  whose size (and edges, with partial) collide somewhere in the fleet."""
+  entries = await asyncio.to_thread(lambda: list(walk(root_dir)))
+  links: Dict[Inode, List[FileEntry]] = {}
+  for entry in entries:
+    links.setdefault((entry.dev, entry.ino), []).append(entry)
+  counts = Counter(group[0].size for group in links.values())
+  reply = await ask("sizes", {"client_id": client_id,
+                              "sizes": sorted(counts.items())})
+  colliding = set(reply["sizes"])
+  # one entry per inode; the links get the digest when it is recorded
+  candidates = [group[0] for group in links.values()
+                if group[0].size in colliding]
+  hits, misses = await asyncio.to_thread(_lookup, cache, candidates)
+
+  if partial:
+    edge_cache = edge_cache if edge_cache is not None else {}
+    big = [e for e in candidates if e.size > 2 * EDGE_SIZE]
+    todo = [(e.path, e.size) for e in big if _edge_key(e) not in edge_cache]
+    func = functools.partial(edge_digest, edge=EDGE_SIZE, algo=algo)
+    by_path = {e.path: e for e in big}
+    async for (path, _), digest in engine.aimap(func, todo):
+      if digest is not None:
+        edge_cache[_edge_key(by_path[path])] = digest
+    live = {_edge_key(e) for e in big}
+    for key in [k for k in edge_cache if k not in live]:
+      del edge_cache[key]
+    edge_counts = Counter((e.size, edge_cache[_edge_key(e)]) for e in big
+                          if _edge_key(e) in edge_cache)
+    reply = await ask("edges", {"client_id": client_id,
+                                "edges": [[s, d, n] for (s, d), n in
+                                          sorted(edge_counts.items())]})
+    keep = {(s, d) for s, d in reply["edges"]}
+    misses = [e for e in misses if e.size <= 2 * EDGE_SIZE
+              or (e.size, edge_cache.get(_edge_key(e))) in keep]
+    candidates = [e for e in candidates if e.size <= 2 * EDGE_SIZE
+                  or (e.size, edge_cache.get(_edge_key(e))) in keep]
+
+  ret: FileStats = {}
+  for entry in candidates:
+    digest = hits.get((entry.dev, entry.ino))
+    if digest is not None:
+      for link in links[(entry.dev, entry.ino)]:
+        ret[link.path] = (link.size, digest, (link.dev, link.ino))
+  first = {e.path: links[(e.dev, e.ino)] for e in misses}
+  func = functools.partial(full_digest, algo=algo)
+  async for (path, _), digest in engine.aimap(func, [(e.path, e.size) for e in misses]):
+    _record(ret, cache, first[path], digest)
+  if cache:
+    await asyncio.to_thread(cache.commit, root_dir, [e.path for e in entries])
+  return ret
+
+
+async def two_phase_updates(root_dir: str, engine: HashEngine, ask: Ask,
+                            client_id: str, cache: Optional[HashCache] = None,
+                            algo: str = DEFAULT_ALGO, interval: float = 20,
+                            partial: bool = False) -> AsyncIterator[FileStats]:
+  """A round every interval seconds, yielding each round's file map (see
+  watcher.tree_updates for the full-hash equivalent)."""
+  edge_cache: EdgeCache = {}
+  while True:
+    try:
+      yield await two_phase_scan(root_dir, engine, ask, client_id, cache,
+                                 algo, partial, edge_cache)
+    except Exception as e:
+      print(f"two-phase round failed: {e!r}")
+    await asyncio.sleep(interval)
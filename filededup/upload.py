@@ -0,0 +1,177 @@
+"""Non-blocking, resumable sync uploads for the HTTP dedup clients.
+
+A sync message (see filededup.sync) is sent as its filededup.wire frames,
+so no request body is ever larger than one compressed batch of
+wire.BATCH_SIZE entries:
+
+  POST /sync/begin           wire.begin_header(msg)
+                             -> {"status": "ok", "upload": id} or resync
+  PUT  /sync/<id>/<n>        frame n: ENTRIES or REMOVED batches, then END
+                             -> {"status": "ok", "acked": n} (+ "seq" on END)
+  GET  /sync/<id>            -> {"status": "ok", "acked": n}
+
+Requests go through one requests.Session (so one pooled keep-alive
+connection) on a worker thread, so the event loop keeps scanning while an
+upload is in flight. A failed request (connection error, timeout, 429 or
+5xx) is retried after a jittered exponential backoff. Every frame is
+acknowledged, and a retried frame the server already applied is only
+acknowledged again, so an upload continues after the last acknowledged
+frame. If the retries run out, the next push first resumes the unfinished
+upload from the last frame the server acknowledged, then sends the new
+delta. An upload the server rejects outright (any other 4xx or 5xx, or a
+reply that is not JSON), or one still failing after MAX_RESUMES resumes, is
+abandoned: the next delta is a full resync.
+"""
+import asyncio
+import random
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from filededup import wire
+from filededup.sync import SyncClient
+
+REQUEST_TIMEOUT = 30.0
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+RETRY_STATUS = frozenset((429, 500, 502, 503, 504))
+MAX_RESUMES = 3
+
+
+class UploadError(Exception):
+  pass
+
+
+class HttpClient:
+  """Blocking requests on one pooled session, run off the event loop and
+  retried with backoff."""
+
+  def __init__(self, base_url: str, timeout: float = REQUEST_TIMEOUT,
+               max_attempts: int = MAX_ATTEMPTS, backoff: float = BACKOFF_BASE,
+               max_backoff: float = BACKOFF_MAX):
+    self.base_url = base_url.rstrip("/")
+    self.timeout = timeout
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.session = requests.Session()
+
+  def delay(self, attempt: int) -> float:
+    # "full jitter": uniform up to the exponential bound
+    return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+  async def request(self, method: str, path: str, **kwargs) -> requests.Response:
+    error = None
+    for attempt in range(self.max_attempts):
+      if attempt:
+        await asyncio.sleep(self.delay(attempt - 1))
+      try:
+        response = await asyncio.to_thread(
+            self.session.request, method, self.base_url + path,
+            timeout=self.timeout, **kwargs)
+      except (requests.ConnectionError, requests.Timeout) as e:
+        error = repr(e)
+        continue
+      if response.status_code not in RETRY_STATUS:
+        return response
+      error = f"HTTP {response.status_code}"
+    raise UploadError(f"{method} {path} failed {self.max_attempts} times: {error}")
+
+  async def post_json(self, path: str, msg: dict) -> dict:
+    response = await self.request("POST", path, json=msg)
+    response.raise_for_status()
+    return response.json()
+
+  def close(self):
+    self.session.close()
+
+
+class SyncUploader:
+  """Async counterpart of SyncClient.push over chunked uploads."""
+
+  def __init__(self, client: HttpClient, sync: SyncClient,
+               compression: Optional[str] = "gzip"):
+    self.client = client
+    self.sync = sync
+    self.compression = compression
+    # (message, algo, upload id) of an upload whose retries ran out
+    self.unfinished: Optional[Tuple[dict, str, str]] = None
+    self.resumes = 0
+
+  async def _put(self, upload_id: str, n: int, frame: bytes) -> dict:
+    response = await self.client.request(
+        "PUT", f"/sync/{upload_id}/{n}", data=frame,
+        headers={"Content-Type": "application/octet-stream"})
+    response.raise_for_status()
+    return response.json()
+
+  async def _send(self, msg: dict, algo: str, upload_id: str,
+                  start: int = 0) -> dict:
+    # frames from `start` on; returns the reply to END, or the first reply
+    # that is not an acknowledgement
+    self.unfinished = (msg, algo, upload_id)
+    reply: dict = {"status": "error", "error": "empty upload"}
+    frames = wire.encode_sync(msg, algo, self.compression)
+    for n, frame in enumerate(frames):
+      if n < start:
+        continue
+      reply = await self._put(upload_id, n, frame)
+      if reply.get("status") != "ok":
+        break
+      if reply["acked"] < n:
+        # the server is missing earlier frames
+        return await self._send(msg, algo, upload_id, reply["acked"] + 1)
+    self.unfinished = None
+    return reply
+
+  async def _upload(self, msg: dict) -> dict:
+    self.resumes = 0
+    header = wire.begin_header(msg)
+    reply = await self.client.post_json("/sync/begin", header)
+    if reply.get("status") != "ok":
+      return reply
+    return await self._send(msg, header["algo"], reply["upload"])
+
+  async def _resume(self):
+    msg, algo, upload_id = self.unfinished
+    response = await self.client.request("GET", f"/sync/{upload_id}")
+    response.raise_for_status()
+    reply = response.json()
+    if reply.get("status") == "ok":
+      # the last acknowledged frame again: its reply may be the one lost
+      reply = await self._send(msg, algo, upload_id, max(reply["acked"], 0))
+    self.unfinished = None
+    self.resumes = 0
+    # a lost session makes the next delta a full resync
+    self.sync.handle_reply(reply)
+
+  def _abandon(self):
+    # retrying cannot help; the server's copy is rebuilt by a full resync
+    self.unfinished = None
+    self.resumes = 0
+    self.sync.handle_reply({"status": "error"})
+
+  async def push(self, files: Dict[str, str]) -> bool:
+    """Send what changed since the last acknowledged sync; raises
+    UploadError when the server stays unreachable or rejects the upload."""
+    if self.unfinished is not None:
+      try:
+        await self._resume()
+      except (requests.HTTPError, ValueError):
+        self._abandon()
+      except UploadError:
+        self.resumes += 1
+        if self.resumes >= MAX_RESUMES:
+          self._abandon()
+        raise
+    for _ in range(2):
+      try:
+        reply = await self._upload(self.sync.delta(files))
+      except (requests.HTTPError, ValueError) as e:
+        self._abandon()
+        raise UploadError(f"upload rejected: {e!r}") from e
+      if self.sync.handle_reply(reply):
+        return True
+    return False
+
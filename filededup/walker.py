@@ -0,0 +1,144 @@
+"""Parallel directory walker shared by the dedup scanners.
+
+Built on os.scandir: the file type comes from the directory entry itself,
+so a regular file costs one lstat (for size, inode and mtime) and a
+directory none, where listdir + isdir + isfile + getsize costs three or
+four stats per entry.
+
+Each thread owns a deque of directories. It pushes subdirectories onto
+and pops work from the right end of its own deque, and when that is empty
+steals from the left end of another thread's deque. Single deque appends
+and pops are atomic, so no lock is ever taken. A thread marks itself busy
+before it looks for work; the walk is over once every deque is empty and
+no thread is busy.
+
+Records are handed to the consumer in per-directory batches through a
+bounded queue, so memory stays flat on trees of any size. Symlinks are
+skipped: a link to a file takes no space of its own.
+"""
+import collections
+import os
+import queue
+import random
+import threading
+import time
+from typing import Deque, Iterator, List, NamedTuple, Optional
+
+from filededup import metrics
+
+DEFAULT_THREADS = 8
+QUEUE_BATCHES = 256
+IDLE_SLEEP = 0.001
+
+
+class FileEntry(NamedTuple):
+  path: str
+  size: int
+  dev: int
+  ino: int
+  mtime_ns: int
+  nlink: int
+
+  @classmethod
+  def from_stat(cls, path: str, st: os.stat_result) -> "FileEntry":
+    return cls(path, st.st_size, st.st_dev, st.st_ino, st.st_mtime_ns,
+               st.st_nlink)
+
+
+class _Walk:
+
+  def __init__(self, roots: List[str], num_threads: int):
+    self.deques: List[Deque[str]] = [collections.deque()
+                                     for _ in range(num_threads)]
+    self.deques[0].extend(roots)
+    self.busy = [True] * num_threads
+    self.out: "queue.Queue[Optional[List[FileEntry]]]" = queue.Queue(QUEUE_BATCHES)
+    self.stopped = False
+
+  def _next_dir(self, i: int) -> Optional[str]:
+    # own deque first (depth first, good locality), then steal breadth first
+    try:
+      return self.deques[i].pop()
+    except IndexError:
+      pass
+    others = list(range(len(self.deques)))
+    random.shuffle(others)
+    for j in others:
+      try:
+        return self.deques[j].popleft()
+      except IndexError:
+        continue
+    return None
+
+  def _done(self) -> bool:
+    # deques before busy flags: a thief sets its flag before it steals
+    return (not any(self.deques)) and not any(self.busy)
+
+  def _put(self, batch: Optional[List[FileEntry]]):
+    while not self.stopped:
+      try:
+        self.out.put(batch, timeout=0.1)
+        return
+      except queue.Full:
+        continue
+
+  def _scan(self, i: int, dir: str):
+    batch: List[FileEntry] = []
+    try:
+      with os.scandir(dir) as it:
+        for entry in it:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              self.deques[i].append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+              batch.append(FileEntry.from_stat(
+                  entry.path, entry.stat(follow_symlinks=False)))
+          except OSError:
+            continue
+    except OSError:
+      pass
+    if batch:
+      self._put(batch)
+
+  def worker(self, i: int):
+    try:
+      while not self.stopped:
+        self.busy[i] = True
+        dir = self._next_dir(i)
+        if dir is not None:
+          self._scan(i, dir)
+          continue
+        self.busy[i] = False
+        if self._done():
+          break
+        time.sleep(IDLE_SLEEP)
+    finally:
+      self.busy[i] = False
+      self._put(None)
+
+
+def walk(root_dir: str, num_threads: int = DEFAULT_THREADS) -> Iterator[FileEntry]:
+  """Yield a FileEntry for every regular file under root_dir, in no
+  particular order."""
+  num_threads = max(num_threads, 1)
+  state = _Walk([root_dir], num_threads)
+  threads = [threading.Thread(target=state.worker, args=(i,), daemon=True)
+             for i in range(num_threads)]
+  for t in threads:
+    t.start()
+  try:
+    running = num_threads
+    while running:
+      batch = state.out.get()
+      if batch is None:
+        running -= 1
+        continue
+      metrics.FILES_DISCOVERED.inc(len(batch))
+      metrics.BYTES_DISCOVERED.inc(sum(e.size for e in batch))
+      metrics.WALK_QUEUE.set(state.out.qsize())
+      yield from batch
+  finally:
+    state.stopped = True
+    for t in threads:
+      t.join()
+    metrics.WALK_QUEUE.set(0)
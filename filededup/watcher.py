@@ -0,0 +1,261 @@
+"""Change tracking for the dedup clients via Linux inotify.
+
+After one full scan a client only needs to rehash what changed. TreeWatcher
+puts an inotify watch on every directory under the root (through ctypes, so
+there is no extra dependency) and collects the paths named by events into a
+dirty set. Bursts are coalesced: a batch is handed out once the tree has
+been quiet for `debounce` seconds, or after `max_delay` at the latest.
+Directories created or moved in are queued and watched, on a worker thread,
+before the batch naming them is handed out, so a large tree appearing never
+stalls the event loop.
+
+Where inotify is unusable (not Linux, or the per-user watch limit in
+fs.inotify.max_user_watches is exhausted) WatchUnavailable is raised and
+tree_updates() falls back to periodic full rescans. A queue overflow
+(events lost) forces one full rescan.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+import time
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from filededup.hash_cache import HashCache
+from filededup.hash_engine import HashEngine
+from filededup.hashing import DEFAULT_ALGO
+from filededup.scanner import FileStats, scan_tree_async, update_paths
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+DEFAULT_DEBOUNCE = 0.5
+DEFAULT_MAX_DELAY = 5.0
+READ_SIZE = 64 * 1024
+
+_event = struct.Struct("iIII")
+
+
+class WatchUnavailable(Exception):
+  pass
+
+
+def _libc():
+  if not sys.platform.startswith("linux"):
+    raise WatchUnavailable(f"inotify is not available on {sys.platform}")
+  libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                     use_errno=True)
+  libc.inotify_init1.argtypes = [ctypes.c_int]
+  libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                     ctypes.c_uint32]
+  libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+  return libc
+
+
+class TreeWatcher:
+
+  def __init__(self, root_dir: str, debounce: float = DEFAULT_DEBOUNCE,
+               max_delay: float = DEFAULT_MAX_DELAY):
+    self.root_dir = root_dir
+    self.debounce = debounce
+    self.max_delay = max_delay
+    self.libc = _libc()
+    self.fd = -1
+    # watch descriptor -> directory it watches
+    self.dirs: Dict[int, str] = {}
+    self.dirty: Set[str] = set()
+    # directories created or moved in, still to be watched
+    self.new_dirs: List[str] = []
+    self.overflowed = False
+    self.error: Optional[WatchUnavailable] = None
+    self.last_event = 0.0
+    self.wakeup = asyncio.Event()
+
+  def _add_watch(self, path: str) -> Optional[int]:
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      if err == errno.ENOSPC:
+        raise WatchUnavailable(
+            "inotify watch limit reached (fs.inotify.max_user_watches)")
+      if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+        # gone or unreadable before we got to it
+        return None
+      raise WatchUnavailable(f"inotify_add_watch {path}: {os.strerror(err)}")
+    return wd
+
+  def _watch_tree(self, root: str) -> List[Tuple[int, str]]:
+    # on a worker thread: watch root and every directory below it; the
+    # caller records the (wd, path) pairs on the loop
+    ret = []
+
+    def watch(dir: str):
+      wd = self._add_watch(dir)
+      if wd is not None:
+        ret.append((wd, dir))
+
+    # each directory is watched before os.walk lists it
+    watch(root)
+    for dir, subdirs, _ in os.walk(root):
+      for name in subdirs:
+        watch(os.path.join(dir, name))
+    return ret
+
+  def _remove_tree(self, root: str):
+    prefix = os.path.join(root, "")
+    for wd, dir in list(self.dirs.items()):
+      if dir == root or dir.startswith(prefix):
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.dirs[wd]
+
+  async def start(self):
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise WatchUnavailable(
+          f"inotify_init1: {os.strerror(ctypes.get_errno())}")
+    try:
+      # watch first, so nothing changing during the walk is missed
+      self.dirs.update(await asyncio.to_thread(self._watch_tree, self.root_dir))
+    except WatchUnavailable:
+      self.close()
+      raise
+    asyncio.get_running_loop().add_reader(self.fd, self._on_readable)
+
+  def _on_readable(self):
+    try:
+      while True:
+        try:
+          data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+          break
+        self._parse(data)
+    except WatchUnavailable as e:
+      self.error = e
+    self.last_event = time.monotonic()
+    self.wakeup.set()
+
+  def _parse(self, data: bytes):
+    pos = 0
+    while pos < len(data):
+      wd, mask, _, length = _event.unpack_from(data, pos)
+      pos += _event.size
+      name = data[pos:pos + length].rstrip(b"\0")
+      pos += length
+      if mask & IN_Q_OVERFLOW:
+        self.overflowed = True
+        continue
+      dir = self.dirs.get(wd)
+      if dir is None:
+        continue
+      if mask & IN_IGNORED:
+        del self.dirs[wd]
+        continue
+      if not name:
+        # the watched directory itself went away; its parent reports it
+        continue
+      path = os.path.join(dir, os.fsdecode(name))
+      self.dirty.add(path)
+      if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+        # watches follow the inode, so would keep reporting the old name
+        self._remove_tree(path)
+      if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+        # files created before the new watch lands are found when the
+        # directory itself is rescanned
+        self.new_dirs.append(path)
+
+  async def changes(self, timeout: Optional[float] = None) -> Optional[Set[str]]:
+    """Wait for the next coalesced batch of changed paths. Returns an empty
+    set on timeout and None if events were lost and a full rescan is due."""
+    if not self.dirty and not self.overflowed and self.error is None:
+      try:
+        await asyncio.wait_for(self.wakeup.wait(), timeout)
+      except asyncio.TimeoutError:
+        return set()
+    deadline = time.monotonic() + self.max_delay
+    while self.error is None:
+      quiet = time.monotonic() - self.last_event
+      if quiet >= self.debounce or time.monotonic() >= deadline:
+        break
+      await asyncio.sleep(self.debounce - quiet)
+    self.wakeup.clear()
+    if self.error is not None:
+      raise self.error
+    while self.new_dirs:
+      new, self.new_dirs = self.new_dirs, []
+      for path in new:
+        self.dirs.update(await asyncio.to_thread(self._watch_tree, path))
+    dirty, self.dirty = self.dirty, set()
+    if self.overflowed:
+      self.overflowed = False
+      return None
+    return dirty
+
+  def close(self):
+    if self.fd >= 0:
+      try:
+        asyncio.get_running_loop().remove_reader(self.fd)
+      except RuntimeError:
+        pass
+      os.close(self.fd)
+      self.fd = -1
+    self.dirs.clear()
+
+
+async def tree_updates(root_dir: str, engine: HashEngine,
+                       cache: Optional[HashCache] = None,
+                       algo: str = DEFAULT_ALGO, interval: float = 20,
+                       watch: bool = True) -> AsyncIterator[FileStats]:
+  """Yield the file map of root_dir after an initial full scan and then
+  after each change. With watch, only changed paths are rehashed and an
+  unchanged map is re-yielded every `interval` seconds; without it (or
+  once inotify gives out) the whole tree is rescanned every `interval`."""
+  watcher = None
+  if watch:
+    try:
+      watcher = TreeWatcher(root_dir)
+      await watcher.start()
+    except WatchUnavailable as e:
+      print(f"watch mode unavailable, rescanning every {interval}s: {e}")
+      watcher = None
+  files = await scan_tree_async(root_dir, engine, cache, algo)
+  try:
+    while True:
+      yield files
+      if watcher is None:
+        await asyncio.sleep(interval)
+        files = await scan_tree_async(root_dir, engine, cache, algo)
+        continue
+      try:
+        paths = await watcher.changes(interval)
+      except WatchUnavailable as e:
+        print(f"watch mode stopped, rescanning every {interval}s: {e}")
+        watcher.close()
+        watcher = None
+        paths = None
+      if paths is None:
+        files = await scan_tree_async(root_dir, engine, cache, algo)
+      elif paths:
+        await update_paths(files, paths, engine, cache, algo)
+  finally:
+    if watcher is not None:
+      watcher.close()
@@ -0,0 +1,252 @@
+"""Compact binary framing for the dedup stream protocol.
+
+Every frame is
+
+  u32 length (big endian, covers the rest) | u8 type | u8 flags | payload
+
+where flags say whether the payload is gzip- or zstd-compressed (zlib
+streams are accepted under the gzip flag too, as sent by older peers). BEGIN,
+REPLY and QUERY payloads are small JSON objects. ENTRIES and REMOVED
+payloads are batches of at most BATCH_SIZE records, sorted by path, with
+each path stored as (shared prefix length with the previous path, suffix):
+
+  ENTRIES: varint count, then per entry
+           varint prefix | varint suffix_len | suffix | varint size | digest[32]
+  REMOVED: varint count, then per path  varint prefix | varint suffix_len | suffix
+
+Digests travel as their 32 raw bytes; the algorithm is named once, in
+BEGIN. A sync session is BEGIN -> REPLY, then ENTRIES/REMOVED frames, then
+END -> REPLY (see filededup.sync for the sequence-number rules). Truncated
+or corrupt payloads raise ProtocolError.
+"""
+import asyncio
+import json
+import struct
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from filededup.hashing import (DEFAULT_ALGO, digest_algo, file_key, parse_key,
+                               tag_digest)
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+BEGIN, ENTRIES, REMOVED, END, REPLY, QUERY = range(1, 7)
+FLAG_GZIP = 1
+FLAG_ZSTD = 2
+
+DIGEST_SIZE = 32
+BATCH_SIZE = 4096
+COMPRESS_MIN = 1024
+MAX_FRAME = 64 * 1024 * 1024
+
+_header = struct.Struct(">IBB")
+# zlib window bits: write gzip, read gzip or zlib
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_AUTO_WBITS = 32 + zlib.MAX_WBITS
+
+
+class ProtocolError(Exception):
+  pass
+
+
+def _varint(n: int, out: bytearray):
+  while n >= 0x80:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+
+
+def _read_varint(buf: memoryview, pos: int) -> Tuple[int, int]:
+  n = shift = 0
+  while True:
+    if pos >= len(buf) or shift > 63:
+      raise ProtocolError("truncated or overlong varint")
+    byte = buf[pos]
+    pos += 1
+    n |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return n, pos
+    shift += 7
+
+
+def _encode_path(path: str, prev: bytes, out: bytearray) -> bytes:
+  raw = path.encode("utf-8", "surrogateescape")
+  prefix = 0
+  limit = min(len(raw), len(prev))
+  while prefix < limit and raw[prefix] == prev[prefix]:
+    prefix += 1
+  _varint(prefix, out)
+  _varint(len(raw) - prefix, out)
+  out += raw[prefix:]
+  return raw
+
+
+def _decode_path(buf: memoryview, pos: int, prev: bytes) -> Tuple[bytes, int]:
+  prefix, pos = _read_varint(buf, pos)
+  length, pos = _read_varint(buf, pos)
+  if prefix > len(prev) or pos + length > len(buf):
+    raise ProtocolError("truncated path")
+  raw = prev[:prefix] + bytes(buf[pos:pos + length])
+  return raw, pos + length
+
+
+def encode_frame(ftype: int, payload: bytes, compression: Optional[str] = None) -> bytes:
+  flags = 0
+  if compression and len(payload) >= COMPRESS_MIN:
+    if compression == "zstd" and zstandard is not None:
+      payload = zstandard.ZstdCompressor().compress(payload)
+      flags = FLAG_ZSTD
+    elif compression in ("gzip", "zstd"):
+      deflater = zlib.compressobj(6, wbits=_GZIP_WBITS)
+      payload = deflater.compress(payload) + deflater.flush()
+      flags = FLAG_GZIP
+  return _header.pack(len(payload) + 2, ftype, flags) + payload
+
+
+def encode_json(ftype: int, obj: dict) -> bytes:
+  return encode_frame(ftype, json.dumps(obj).encode())
+
+
+def encode_entries(entries: List[Tuple[str, str]], algo: str,
+                   compression: Optional[str] = None) -> bytes:
+  # entries: (path, key) pairs, all keys hashed with algo
+  out = bytearray()
+  _varint(len(entries), out)
+  prev = b""
+  for path, key in entries:
+    size, digest = parse_key(key)
+    if digest_algo(digest) != algo:
+      raise ProtocolError(f"{path} is not hashed with {algo}")
+    prev = _encode_path(path, prev, out)
+    _varint(size, out)
+    raw = bytes.fromhex(digest.rpartition(":")[2])
+    if len(raw) != DIGEST_SIZE:
+      raise ProtocolError(f"unexpected digest length for {path}")
+    out += raw
+  return encode_frame(ENTRIES, bytes(out), compression)
+
+
+def encode_removed(paths: List[str], compression: Optional[str] = None) -> bytes:
+  out = bytearray()
+  _varint(len(paths), out)
+  prev = b""
+  for path in paths:
+    prev = _encode_path(path, prev, out)
+  return encode_frame(REMOVED, bytes(out), compression)
+
+
+def encode_sync(msg: dict, algo: str,
+                compression: Optional[str] = None) -> Iterator[bytes]:
+  """Frames for one sync message (see filededup.sync), after its BEGIN."""
+  upserts = sorted(msg["upserts"].items())
+  for i in range(0, len(upserts), BATCH_SIZE):
+    yield encode_entries(upserts[i:i + BATCH_SIZE], algo, compression)
+  removed = sorted(msg["removed"])
+  for i in range(0, len(removed), BATCH_SIZE):
+    yield encode_removed(removed[i:i + BATCH_SIZE], compression)
+  yield encode_frame(END, b"")
+
+
+def begin_header(msg: dict) -> dict:
+  keys = iter(msg["upserts"].values())
+  first = next(keys, None)
+  algo = digest_algo(parse_key(first)[1]) if first else DEFAULT_ALGO
+  return {k: msg[k] for k in ("client_id", "base_seq", "seq", "full")} | {"algo": algo}
+
+
+def decode_entries(payload: bytes, algo: str) -> Dict[str, str]:
+  buf = memoryview(payload)
+  count, pos = _read_varint(buf, 0)
+  ret: Dict[str, str] = {}
+  prev = b""
+  for _ in range(count):
+    prev, pos = _decode_path(buf, pos, prev)
+    size, pos = _read_varint(buf, pos)
+    if pos + DIGEST_SIZE > len(buf):
+      raise ProtocolError("truncated digest")
+    digest = bytes(buf[pos:pos + DIGEST_SIZE]).hex()
+    pos += DIGEST_SIZE
+    ret[prev.decode("utf-8", "surrogateescape")] = file_key(size, tag_digest(algo, digest))
+  return ret
+
+
+def decode_removed(payload: bytes) -> List[str]:
+  buf = memoryview(payload)
+  count, pos = _read_varint(buf, 0)
+  ret: List[str] = []
+  prev = b""
+  for _ in range(count):
+    prev, pos = _decode_path(buf, pos, prev)
+    ret.append(prev.decode("utf-8", "surrogateescape"))
+  return ret
+
+
+def _inflate(flags: int, payload: bytes) -> bytes:
+  if flags & FLAG_ZSTD:
+    if zstandard is None:
+      raise ProtocolError("zstd frame received but zstandard is not installed")
+    try:
+      payload = zstandard.ZstdDecompressor().decompress(
+          payload, max_output_size=MAX_FRAME)
+    except zstandard.ZstdError as e:
+      raise ProtocolError(f"bad zstd payload: {e}") from e
+  elif flags & FLAG_GZIP:
+    inflater = zlib.decompressobj(_AUTO_WBITS)
+    try:
+      payload = inflater.decompress(payload, MAX_FRAME)
+    except zlib.error as e:
+      raise ProtocolError(f"bad gzip payload: {e}") from e
+    if inflater.unconsumed_tail:
+      raise ProtocolError("decompressed frame too large")
+    if not inflater.eof:
+      raise ProtocolError("truncated gzip payload")
+  return payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+  length, ftype, flags = _header.unpack(await reader.readexactly(_header.size))
+  if length < 2 or length - 2 > MAX_FRAME:
+    raise ProtocolError(f"bad frame length {length}")
+  return ftype, _inflate(flags, await reader.readexactly(length - 2))
+
+
+def decode_frame(data: bytes) -> Tuple[int, bytes]:
+  # one whole frame held in memory, as uploaded by filededup.upload
+  if len(data) < _header.size:
+    raise ProtocolError("truncated frame")
+  length, ftype, flags = _header.unpack_from(data)
+  if length < 2 or length - 2 > MAX_FRAME or len(data) != length + 4:
+    raise ProtocolError(f"bad frame length {length}")
+  return ftype, _inflate(flags, data[_header.size:])
+
+
+async def read_json(reader: asyncio.StreamReader, expected: int = REPLY) -> dict:
+  ftype, payload = await read_frame(reader)
+  if ftype != expected:
+    raise ProtocolError(f"expected frame type {expected}, got {ftype}")
+  return json.loads(payload)
+
+
+async def send_sync(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    msg: dict, compression: Optional[str] = None) -> dict:
+  """Run one sync session; returns the server's final reply."""
+  header = begin_header(msg)
+  writer.write(encode_json(BEGIN, header))
+  await writer.drain()
+  reply = await read_json(reader)
+  if reply.get("status") != "ok":
+    return reply
+  for frame in encode_sync(msg, header["algo"], compression):
+    writer.write(frame)
+    await writer.drain()
+  return await read_json(reader)
+
+
+async def query(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                request: dict) -> dict:
+  writer.write(encode_json(QUERY, request))
+  await writer.drain()
+  return await read_json(reader)
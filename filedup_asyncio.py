@@ -1,94 +1,190 @@
 import asyncio
-import os
-from typing import Dict, Set, Tuple
-import hashlib
-import json
+from typing import Dict, List, Optional
+
+from filededup.hash_cache import DEFAULT_CACHE_PATH, HashCache
+from filededup.hash_engine import HashEngine
+from filededup.hashing import DEFAULT_ALGO
+from filededup.index import FileIndex
+from filededup.io_scheduler import DEFAULT_PER_DEVICE, IoScheduler
+from filededup.scanner import FileStats, file_keys, scan_tree_async
+from filededup.sharding import Addr, ShardedClient
+from filededup.storage import SqliteStore
+from filededup.stream_server import StreamServer
+from filededup.sync import SyncClient
+from filededup.two_phase import SizeIndex, two_phase_updates
+from filededup.watcher import tree_updates
+from filededup import metrics, wire
 
 class FileDedup:
 
   def __init__(self, root_dir: str, is_server: bool, host: str, port: int,
-               machine_id: int):
+               machine_id: int, cache_path: str = DEFAULT_CACHE_PATH,
+               algo: str = DEFAULT_ALGO, db_path: Optional[str] = None,
+               stale_after: float = 7 * 24 * 3600,
+               compression: Optional[str] = "gzip", watch: bool = True,
+               shards: Optional[List[Addr]] = None,
+               metrics_port: Optional[int] = None, two_phase: bool = False,
+               partial_hash: bool = False, io_order: Optional[str] = None,
+               per_device: int = DEFAULT_PER_DEVICE):
     self.root_dir = root_dir
     self.host = host
     self.port = port
     self.machine_id = machine_id
     self.is_server = is_server
     self.is_running = False
-
-    # storage
-    self.file_map: Dict[Tuple[int, str], Set[str]] = {}
+    self.cache_path = cache_path
+    self.algo = algo
+    self.hash_cache = None
+    self.hash_engine = None
+    # hash in on-disk order, for rotational disks (see filededup.io_scheduler)
+    self.io_order = io_order
+    self.per_device = per_device
+
+    # storage: the server's index (durable if db_path is given), the
+    # client's latest scan
+    self.index = FileIndex(SqliteStore(db_path) if db_path else None)
+    self.stale_after = stale_after
+    self.compression = compression
+    self.watch = watch
+    # client side: shard servers to route entries to, instead of host:port
+    self.shards = shards
+    # serve GET /metrics on this port (see filededup.metrics)
+    self.metrics_port = metrics_port
+    # client side: hash only files whose size (and, with partial_hash, first
+    # and last bytes) collide fleet-wide (see filededup.two_phase); server
+    # side: the size reports
+    if two_phase and shards:
+      raise ValueError("two-phase reports are not supported with shards")
+    self.two_phase = two_phase
+    self.partial_hash = partial_hash
+    self.sizes = SizeIndex(SqliteStore(db_path) if db_path else None)
+    self.local_files: Dict[str, str] = {}
+    self.sync = SyncClient(str(machine_id))
     self.map_lock = asyncio.Lock()
-
-  async def scan_local(self) -> Dict[str, Tuple[int, str]]:
-    # walk from root_dir, save results to self.file_map
-    ret: Dict[str, Tuple[int, str]] = {}
-    for dir, _, files in os.walk(self.root_dir):
-      for fname in files:
-        file_path = os.path.join(dir, fname)
-        try:
-          hashfunc = hashlib.sha256()
-          file_size = 0
-          with open(file_path, 'rb') as f:
-            while chunk := f.read(1024 * 64):
-              hashfunc.update(chunk)
-              file_size += len(chunk)
-          ret[file_path] = (file_size, hashfunc.hexdigest())
-        except Exception as e:
-          pass
-    return ret
-
-  async def client_send_msg(self, writer: asyncio.StreamWriter):
-    # send results to server
-    while self.is_running:
-      try:
-        print(f'{self.machine_id} connected, write message')
+    # set once the first scan has filled local_files; a push before that
+    # would be a full sync of nothing, dropping the server's entries
+    self.scanned = asyncio.Event()
+
+  def _new_engine(self) -> HashEngine:
+    io = IoScheduler(self.io_order, self.per_device) if self.io_order else None
+    return HashEngine(io=io)
+
+  async def scan_local(self) -> FileStats:
+    # walk from root_dir; unchanged files are served from the hash cache and
+    # the rest are hashed off the event loop
+    if self.hash_cache is None:
+      self.hash_cache = HashCache(self.cache_path, self.algo)
+      self.hash_engine = self._new_engine()
+    return await scan_tree_async(self.root_dir, self.hash_engine,
+                                 self.hash_cache, self.algo)
+
+  async def client_send_msg(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter):
+    # send changes since the last acknowledged sync as binary frames
+    try:
+      await self.scanned.wait()
+      while self.is_running:
         async with self.map_lock:
-          msg = json.dumps(self.file_map).encode() + b'\n'
-          writer.write(msg)
-          await writer.drain()
-          print(f'{self.machine_id} sent message')
-      except (ConnectionResetError, ConnectionRefusedError) as e:
-        print(f'{self.machine_id} connection error')
-        pass
-      except Exception as e:
-        print(f'{self.machine_id} error: {e}')
-        pass
-      finally:
-        writer.close()
-        await writer.wait_closed()
+          files = self.local_files
+        for _ in range(2):
+          msg = self.sync.delta(files)
+          reply = await wire.send_sync(reader, writer, msg, self.compression)
+          if self.sync.handle_reply(reply):
+            break
+        print(f'{self.machine_id} sent {len(msg["upserts"])} upserts, '
+              f'{len(msg["removed"])} removals')
         await asyncio.sleep(10)
+    except (ConnectionResetError, ConnectionRefusedError,
+            asyncio.IncompleteReadError) as e:
+      print(f'{self.machine_id} connection error')
+    except Exception as e:
+      print(f'{self.machine_id} error: {e}')
+    finally:
+      writer.close()
+      await writer.wait_closed()
+
+  async def client_send_sharded(self):
+    # each entry goes to the shard owning its hash prefix
+    client = ShardedClient(str(self.machine_id), self.shards, self.compression)
+    try:
+      await self.scanned.wait()
+      while self.is_running:
+        async with self.map_lock:
+          files = self.local_files
+        for i, reply in enumerate(await client.push(files)):
+          if reply.get("status") != "ok":
+            print(f'{self.machine_id} shard {i} error: {reply}')
+        print(f'{self.machine_id} synced {len(files)} files to '
+              f'{len(self.shards)} shards')
+        await asyncio.sleep(10)
+    finally:
+      client.close()
 
   async def client_proc(self):
     self.is_running = True
-    _, writer = await asyncio.open_connection(self.host, self.port)
-    print(f'{self.machine_id} connected to server {self.host}:{self.port}')
+    if self.shards:
+      sender = self.client_send_sharded()
+    else:
+      reader, writer = await asyncio.open_connection(self.host, self.port)
+      print(f'{self.machine_id} connected to server {self.host}:{self.port}')
+      sender = self.client_send_msg(reader, writer)
 
     async def rescan():
-      while self.is_running:
-        print(f"started rescan for {self.machine_id}")
-        await self.scan_local()
-        print(f"finished rescan for {self.machine_id}")
-        await asyncio.sleep(20)
+      # full scan once, then only the paths inotify reports changed (or a
+      # full rescan every 20s where watching is unavailable); two-phase
+      # clients run a report round every 20s instead
+      if self.hash_cache is None:
+        self.hash_cache = HashCache(self.cache_path, self.algo)
+        self.hash_engine = self._new_engine()
+      print(f"started scan for {self.machine_id}")
+      if self.two_phase:
+        # reports get their own connection; the sender owns the first one
+        r, w = await asyncio.open_connection(self.host, self.port)
+        lock = asyncio.Lock()
+
+        async def ask(op: str, msg: dict) -> dict:
+          async with lock:
+            return await wire.query(r, w, {"op": op, **msg})
+
+        updates = two_phase_updates(self.root_dir, self.hash_engine,
+                                    ask, str(self.machine_id),
+                                    self.hash_cache, self.algo, 20,
+                                    self.partial_hash)
+      else:
+        w = None
+        updates = tree_updates(self.root_dir, self.hash_engine, self.hash_cache,
+                               self.algo, 20, self.watch)
+      try:
+        async for ret in updates:
+          async with self.map_lock:
+            self.local_files = file_keys(ret)
+          self.scanned.set()
+          print(f"updated file map for {self.machine_id}")
+          if not self.is_running:
+            break
+      finally:
+        await updates.aclose()
+        if w is not None:
+          w.close()
 
     try:
       tasks = [
           asyncio.create_task(rescan()),
-          asyncio.create_task(self.client_send_msg(writer))
+          asyncio.create_task(sender),
+          asyncio.create_task(metrics.report_status(
+              f"{self.machine_id} ", 5, lambda: not self.is_running))
       ]
-      asyncio.gather(*tasks)
+      if self.metrics_port:
+        tasks.append(asyncio.create_task(
+            metrics.serve_http(self.host, self.metrics_port)))
+      await asyncio.gather(*tasks)
     except asyncio.CancelledError:
       pass
 
   async def server_reduce(self, reader: asyncio.StreamReader,
                           writer: asyncio.StreamWriter):
     print("server received data")
-    while self.is_running:
-      data = await reader.readline()
-      data = json.loads(data.decode())
-      async with self.map_lock:
-        for fname, stats in data.items():
-          self.file_map.setdefault(stats, set()).add(fname)
-      await asyncio.sleep(10)
+    await StreamServer(self.index, sizes=self.sizes).handle(reader, writer)
 
   async def server_proc(self):
     self.is_running = True
@@ -96,21 +192,28 @@ class FileDedup:
     server = await asyncio.start_server(self.server_reduce, self.host,
                                         self.port)
     print(f"Server started, listening on {self.host}:{self.port}")
+    metrics.track_index(self.index)
     async with server:
 
       async def print_result():
+        # a compact status line; the groups themselves are served to queries
+        status = metrics.StatusLine()
         while self.is_running:
-          print("server aggregating results.")
-          async with self.map_lock:
-            for k, v in self.file_map.items():
-              print(f'{k}: {v}')
+          self.index.expire_stale(self.stale_after)
+          self.sizes.expire(self.stale_after)
+          print(f"server {status.line()}")
           await asyncio.sleep(5)
 
       server_task = asyncio.create_task(print_result())
-    try:
-      await server.serve_forever()
-    except Exception:
-      server_task.cancel()
+      metrics_task = (asyncio.create_task(
+          metrics.serve_http(self.host, self.metrics_port))
+                      if self.metrics_port else None)
+      try:
+        await server.serve_forever()
+      except Exception:
+        server_task.cancel()
+        if metrics_task is not None:
+          metrics_task.cancel()
 
   def stop(self):
     self.is_running = False
@@ -0,0 +1,56 @@
+import asyncio
+import random
+
+import pytest
+
+from filededup import chunking
+from filededup.hash_engine import HashEngine
+from filededup.hashing import file_key, full_digest
+
+
+def _buffers():
+  rng = random.Random(7)
+  yield b""
+  yield rng.randbytes(chunking.MIN_SIZE - 1)
+  yield rng.randbytes(300 * 1024)
+  # no boundary matches in constant data: every chunk is MAX_SIZE
+  yield bytes(3 * chunking.MAX_SIZE + 100)
+  # low-entropy text, mostly repeated lines
+  lines = [f"line {rng.randrange(50)}\n".encode() for _ in range(40000)]
+  yield b"".join(lines)
+
+
+@pytest.mark.parametrize("final", [True, False])
+def test_cut_points_match_numpy(final):
+  pytest.importorskip("numpy")
+  for buf in _buffers():
+    assert chunking._cuts_py(buf, final) == chunking._cuts_numpy(buf, final)
+
+
+def test_chunk_file_matches_numpy(tmp_path, monkeypatch):
+  pytest.importorskip("numpy")
+  path = tmp_path / "data"
+  # spans several reads, so cut points carry over between buffers
+  path.write_bytes(random.Random(3).randbytes(2 * chunking.READ_SIZE + 12345))
+  with_numpy = chunking.chunk_file(str(path))
+  monkeypatch.setattr(chunking, "_cut_points", chunking._cuts_py)
+  assert chunking.chunk_file(str(path)) == with_numpy
+  assert sum(n for _, n in with_numpy) == path.stat().st_size
+
+
+def test_client_resends_after_server_restart(tmp_path):
+  path = tmp_path / "a"
+  path.write_bytes(random.Random(5).randbytes(50000))
+  files = {str(path): file_key(50000, full_digest(str(path), 50000))}
+  engine = HashEngine(1)
+  client = chunking.ChunkClient("c", engine)
+  index = chunking.ChunkIndex()
+  try:
+    assert asyncio.run(client.push(files, index.submit))
+    assert index.report()["files"] == 1
+    # a restarted server has lost everything and does not know the client
+    index = chunking.ChunkIndex()
+    assert asyncio.run(client.push(files, index.submit))
+    assert index.report()["files"] == 1
+  finally:
+    engine.shutdown()
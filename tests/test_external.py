@@ -0,0 +1,79 @@
+import os
+import random
+
+import pytest
+
+from file_duplication import FileDuplication
+from filededup import external
+from filededup.hash_engine import HashEngine
+from filededup.hashing import EDGE_SIZE, staged_duplicates
+
+
+def _make_tree(root):
+  rng = random.Random(11)
+  blobs = [rng.randbytes(n) for n in
+           (0, 1, 100, 100, 4096, 2 * EDGE_SIZE, 3 * EDGE_SIZE)]
+  big = bytearray(rng.randbytes(3 * EDGE_SIZE))
+  files = {}
+  for i in range(120):
+    data = blobs[i % len(blobs)]
+    if i % 5 == 0:
+      data = rng.randbytes(rng.randrange(50, 200))
+    elif i % 7 == 0:
+      # same size and edges as `big`, differing only in the middle
+      big[len(big) // 2] = i
+      data = bytes(big)
+    files[os.path.join(root, f"d{i % 4}", f"f{i}")] = data
+  for path, data in files.items():
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+      f.write(data)
+  return {path: len(data) for path, data in files.items()}
+
+
+@pytest.mark.parametrize("max_memory", [1, 500, 1 << 20])
+def test_external_matches_staged(tmp_path, monkeypatch, max_memory):
+  # a fan-in of 2 makes the many small runs merge over several levels
+  monkeypatch.setattr(external, "MERGE_FANIN", 2)
+  files = _make_tree(str(tmp_path / "tree"))
+  by_size = {}
+  for path, size in files.items():
+    by_size.setdefault(size, []).append(path)
+  engine = HashEngine(2)
+  try:
+    expected = staged_duplicates(by_size, engine)
+    got = {key: set(paths) for key, paths in external.external_duplicates(
+        files.items(), engine, max_memory=max_memory,
+        tmp_dir=str(tmp_path))}
+  finally:
+    engine.shutdown()
+  assert got == expected
+  assert len(expected) > 3
+  # the scratch directory is removed
+  assert sorted(os.listdir(tmp_path)) == ["tree"]
+
+
+def test_file_duplication_external_matches_in_memory(tmp_path):
+  root = str(tmp_path / "tree")
+  _make_tree(root)
+  os.link(os.path.join(root, "d1", "f1"), os.path.join(root, "link"))
+  in_memory = FileDuplication(root)
+  expected = in_memory.run(2)
+  out_of_core = FileDuplication(root)
+  groups = list(out_of_core.iter_groups(2, max_memory=64,
+                                        tmp_dir=str(tmp_path)))
+  assert {key: paths for key, paths, _ in groups} == expected
+  assert {key: wasted for key, _, wasted in groups} == in_memory.wasted
+  assert out_of_core.wasted == {} and out_of_core.sizes == {}
+
+
+def test_run_twice(tmp_path):
+  for name in ("a", "b"):
+    (tmp_path / name).write_bytes(b"same")
+  os.link(tmp_path / "b", tmp_path / "b2")
+  fd = FileDuplication(str(tmp_path))
+  first = fd.run(1)
+  sizes = {size: sorted(paths) for size, paths in fd.sizes.items()}
+  assert fd.run(1) == first
+  assert list(first.values()) == [{str(tmp_path / n) for n in ("a", "b", "b2")}]
+  assert {size: sorted(paths) for size, paths in fd.sizes.items()} == sizes
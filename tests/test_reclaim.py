@@ -0,0 +1,137 @@
+import filecmp
+import os
+
+import pytest
+
+from filededup import reclaim
+from filededup.hash_engine import HashEngine
+
+DATA = b"duplicate contents\n" * 100
+
+
+@pytest.fixture
+def tree(tmp_path):
+  # the undo log and outside links go next to it, in tmp_path
+  (tmp_path / "tree").mkdir()
+  return tmp_path / "tree"
+
+
+@pytest.fixture
+def engine():
+  engine = HashEngine(2)
+  yield engine
+  engine.shutdown()
+
+
+def _write(path, data=DATA, mode=0o644, mtime_ns=None):
+  with open(path, "wb") as f:
+    f.write(data)
+  os.chmod(path, mode)
+  if mtime_ns is not None:
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def _snapshot(root):
+  ret = {}
+  for dirpath, _, names in os.walk(root):
+    for name in names:
+      path = os.path.join(dirpath, name)
+      st = os.lstat(path)
+      with open(path, "rb") as f:
+        ret[path] = (st.st_ino, st.st_mode, st.st_mtime_ns, f.read())
+  return ret
+
+
+def _groups(root, engine):
+  filecmp.clear_cache()
+  return reclaim.find_groups(str(root), engine)
+
+
+def test_replaces_copies_by_hardlinks(tree, engine):
+  for name in ("a", "b", "c"):
+    _write(tree / name)
+  _write(tree / "other", b"something else")
+  log = tree.parent / "undo.jsonl"
+  groups = _groups(tree, engine)
+  assert reclaim.reclaim(groups, log_path=str(log)) == (2, 2 * len(DATA))
+  inodes = {os.lstat(tree / n).st_ino for n in ("a", "b", "c")}
+  assert len(inodes) == 1
+  assert (tree / "b").read_bytes() == DATA
+  # no temporary names are left behind
+  assert sorted(os.listdir(tree)) == ["a", "b", "c", "other"]
+
+
+def test_content_mismatch_aborts_before_swap(tree, engine):
+  _write(tree / "a")
+  _write(tree / "b")
+  groups = _groups(tree, engine)
+  copy = groups[0][1]
+  # same size, inode and mtime as scanned, different bytes: only the byte
+  # for byte comparison can tell
+  changed = bytearray(DATA)
+  changed[len(DATA) // 2] ^= 1
+  _write(copy.path, bytes(changed), mtime_ns=copy.mtime_ns)
+  before = _snapshot(tree)
+  assert not reclaim.replace(groups[0][0], copy, "hardlink")
+  assert _snapshot(tree) == before
+
+
+@pytest.mark.parametrize("changed", ["copy", "source"])
+def test_skips_files_changed_since_scan(tree, engine, changed):
+  _write(tree / "a")
+  _write(tree / "b")
+  groups = _groups(tree, engine)
+  source, copy = groups[0]
+  with open(copy.path if changed == "copy" else source.path, "ab") as f:
+    f.write(b"appended after the scan")
+  before = _snapshot(tree)
+  log = tree.parent / "undo.jsonl"
+  assert reclaim.reclaim(groups, log_path=str(log)) == (0, 0)
+  assert _snapshot(tree) == before
+
+
+def test_copies_with_other_links_reclaim_nothing(tree, engine):
+  _write(tree / "a")
+  _write(tree / "b")
+  _write(tree / "c")
+  # b's data stays alive through its other link
+  os.link(tree / "b", tree.parent / "b-elsewhere")
+  groups = _groups(tree, engine)
+  log = tree.parent / "undo.jsonl"
+  assert reclaim.reclaim(groups, log_path=str(log)) == (2, len(DATA))
+  assert os.lstat(tree.parent / "b-elsewhere").st_nlink == 1
+
+
+def test_dry_run_leaves_tree_untouched(tree, engine):
+  for name in ("a", "b", "c"):
+    _write(tree / name)
+  before = _snapshot(tree)
+  log = tree.parent / "undo.jsonl"
+  groups = _groups(tree, engine)
+  assert reclaim.reclaim(groups, dry_run=True, log_path=str(log)) == (
+      2, 2 * len(DATA))
+  assert _snapshot(tree) == before
+  assert not log.exists()
+
+
+def test_undo_restores_independent_copies(tree, engine):
+  _write(tree / "a", mode=0o644, mtime_ns=1_600_000_000_000_000_000)
+  _write(tree / "b", mode=0o600, mtime_ns=1_500_000_000_123_456_789)
+  before = _snapshot(tree)
+  log = tree.parent / "undo.jsonl"
+  assert reclaim.reclaim(_groups(tree, engine),
+                         log_path=str(log)) == (1, len(DATA))
+  assert os.lstat(tree / "a").st_ino == os.lstat(tree / "b").st_ino
+
+  assert reclaim.undo(str(log)) == 1
+  after = _snapshot(tree)
+  a, b = str(tree / "a"), str(tree / "b")
+  assert after[a] == before[a]
+  # its own inode again, with the original permissions, times and data
+  assert after[b][0] != after[a][0]
+  assert after[b][1:] == before[b][1:]
+  assert os.lstat(b).st_nlink == 1
+  # writes through one path no longer show through the other
+  with open(b, "ab") as f:
+    f.write(b"more")
+  assert (tree / "a").read_bytes() == DATA
@@ -0,0 +1,132 @@
+import hashlib
+
+import pytest
+
+from filededup.hashing import file_key
+from filededup.index import FileIndex
+from filededup.storage import SqliteStore
+from filededup.sync import SyncClient, apply_sync
+
+
+def _key(data: bytes) -> str:
+  return file_key(len(data), hashlib.sha256(data).hexdigest())
+
+
+A, B, C = _key(b"a"), _key(b"bb"), _key(b"ccc")
+
+
+class Recorder:
+  # sends to an index, keeping every message and reply
+
+  def __init__(self, index: FileIndex):
+    self.index = index
+    self.sent = []
+    self.replies = []
+
+  def __call__(self, msg: dict) -> dict:
+    self.sent.append(msg)
+    self.replies.append(apply_sync(self.index, msg))
+    return self.replies[-1]
+
+
+def test_first_push_is_full_then_incremental():
+  index = FileIndex()
+  send = Recorder(index)
+  client = SyncClient("m1")
+  assert client.push({"/x": A, "/y": B}, send)
+  first = send.sent[-1]
+  assert first["full"] and first["upserts"] == {"/x": A, "/y": B}
+  assert (first["base_seq"], first["seq"]) == (0, 1)
+
+  assert client.push({"/x": A, "/y": C, "/z": A}, send)
+  second = send.sent[-1]
+  assert not second["full"]
+  assert second["upserts"] == {"/y": C, "/z": A}
+  assert second["removed"] == []
+  assert (second["base_seq"], second["seq"]) == (1, 2)
+
+  assert client.push({"/x": A}, send)
+  assert sorted(send.sent[-1]["removed"]) == ["/y", "/z"]
+  assert send.sent[-1]["upserts"] == {}
+  assert index.paths("m1") == ["/x"]
+  assert index.seq("m1") == 3
+
+
+def test_full_push_replaces_everything_held():
+  index = FileIndex()
+  index.apply("m1", 5, {"/old": A, "/x": B}, [])
+  reply = apply_sync(index, {"client_id": "m1", "base_seq": 0, "seq": 1,
+                             "full": True, "upserts": {"/x": C},
+                             "removed": []})
+  assert reply == {"status": "ok", "seq": 1}
+  assert index.paths("m1") == ["/x"]
+  assert index.entries["m1"]["/x"] == C
+
+
+def test_seq_gap_asks_for_resync():
+  index = FileIndex()
+  send = Recorder(index)
+  client = SyncClient("m1")
+  assert client.push({"/x": A}, send)
+  # a delta built on a snapshot the server never acknowledged
+  reply = apply_sync(index, {"client_id": "m1", "base_seq": 7, "seq": 8,
+                             "full": False, "upserts": {"/y": B},
+                             "removed": ["/x"]})
+  assert reply == {"status": "resync", "seq": 1}
+  assert index.paths("m1") == ["/x"]
+
+  # a lost reply: the client still holds base 1, the server moved on to 2
+  index.apply("m1", 2, {}, [])
+  assert client.push({"/x": A, "/y": B}, send)
+  assert [r["status"] for r in send.replies[-2:]] == ["resync", "ok"]
+  assert send.sent[-1]["full"]
+  assert sorted(index.paths("m1")) == ["/x", "/y"]
+
+
+def test_resync_after_server_restart():
+  index = FileIndex()
+  client = SyncClient("m1")
+  assert client.push({"/x": A, "/y": B}, Recorder(index))
+  # a restarted in-memory server has lost the client and its entries
+  index = FileIndex()
+  send = Recorder(index)
+  assert client.push({"/x": A, "/y": B}, send)
+  assert [m["full"] for m in send.sent] == [False, True]
+  assert sorted(index.paths("m1")) == ["/x", "/y"]
+  assert index.seq("m1") == client.seq
+
+
+def test_restart_with_store_stays_incremental(tmp_path):
+  db = str(tmp_path / "index.sqlite")
+  client = SyncClient("m1")
+  assert client.push({"/x": A, "/y": B}, Recorder(FileIndex(SqliteStore(db))))
+  send = Recorder(FileIndex(SqliteStore(db)))
+  assert client.push({"/x": A}, send)
+  assert len(send.sent) == 1 and not send.sent[0]["full"]
+  assert send.index.paths("m1") == ["/x"]
+
+
+def test_unacknowledged_push_is_resent_in_full():
+  client = SyncClient("m1")
+  assert not client.push({"/x": A}, lambda msg: {"status": "error"})
+  index = FileIndex()
+  send = Recorder(index)
+  assert client.push({"/x": A}, send)
+  assert send.sent[0]["full"]
+  assert index.paths("m1") == ["/x"]
+
+
+@pytest.mark.parametrize("msg", [
+    {"seq": 1, "full": True},
+    {"client_id": "m1", "full": True},
+    {"client_id": "m1", "seq": 1, "full": False},
+    {"client_id": "m1", "seq": 1, "full": True, "upserts": {"/x": "zz"}},
+    {"client_id": "m1", "seq": 1, "full": True, "upserts": [["/x", A]]},
+    {"client_id": "m1", "seq": 1, "full": True, "removed": "/x"},
+])
+def test_malformed_message_is_rejected_before_applying(msg):
+  index = FileIndex()
+  index.apply("m1", 1, {"/kept": A}, [])
+  with pytest.raises((KeyError, TypeError, ValueError)):
+    apply_sync(index, msg)
+  assert index.paths("m1") == ["/kept"] and index.seq("m1") == 1
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import struct
+import zlib
+
+import pytest
+
+from filededup import wire
+from filededup.hashing import file_key, tag_digest
+
+PATHS = ["/data/a.txt", "/data/a.txt.bak", "/data/b/c", "/data/été",
+         "/data/raw-\udcff", "/other"]
+
+
+def _entries(algo="sha256"):
+  return sorted(
+      (path, file_key(i * 1000, tag_digest(algo, hashlib.sha256(
+          path.encode("utf-8", "surrogateescape")).hexdigest())))
+      for i, path in enumerate(PATHS))
+
+
+def _read(frame: bytes):
+  async def read():
+    reader = asyncio.StreamReader()
+    reader.feed_data(frame)
+    reader.feed_eof()
+    return await wire.read_frame(reader)
+  return asyncio.run(read())
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+@pytest.mark.parametrize("algo", ["sha256", "blake2b"])
+def test_entries_round_trip(compression, algo):
+  entries = _entries(algo)
+  frame = wire.encode_entries(entries, algo, compression)
+  for ftype, payload in (wire.decode_frame(frame), _read(frame)):
+    assert ftype == wire.ENTRIES
+    assert wire.decode_entries(payload, algo) == dict(entries)
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_removed_round_trip(compression):
+  paths = sorted(PATHS + [f"/many/{i:05d}" for i in range(500)])
+  frame = wire.encode_removed(paths, compression)
+  if compression:
+    assert frame[5] == wire.FLAG_GZIP
+  ftype, payload = wire.decode_frame(frame)
+  assert ftype == wire.REMOVED
+  assert wire.decode_removed(payload) == paths
+
+
+def test_sync_frames_round_trip():
+  upserts = {f"/f/{i}": key for i, (_, key) in
+             enumerate(_entries() * (wire.BATCH_SIZE // 3))}
+  msg = {"client_id": "m1", "base_seq": 2, "seq": 3, "full": False,
+         "upserts": upserts, "removed": ["/gone", "/also-gone"]}
+  header = wire.begin_header(msg)
+  assert header == {"client_id": "m1", "base_seq": 2, "seq": 3,
+                    "full": False, "algo": "sha256"}
+  got_upserts, got_removed, types = {}, [], []
+  for frame in wire.encode_sync(msg, header["algo"], "gzip"):
+    ftype, payload = wire.decode_frame(frame)
+    types.append(ftype)
+    if ftype == wire.ENTRIES:
+      got_upserts.update(wire.decode_entries(payload, header["algo"]))
+    elif ftype == wire.REMOVED:
+      got_removed += wire.decode_removed(payload)
+  assert types == [wire.ENTRIES] * 2 + [wire.REMOVED, wire.END]
+  assert got_upserts == upserts
+  assert got_removed == sorted(msg["removed"])
+
+
+def test_zlib_payload_from_older_peers():
+  payload = b"x" * 5000
+  frame = (struct.pack(">IBB", len(zlib.compress(payload)) + 2, wire.QUERY,
+                       wire.FLAG_GZIP) + zlib.compress(payload))
+  assert wire.decode_frame(frame) == (wire.QUERY, payload)
+
+
+@pytest.mark.parametrize("payload", [
+    b"",                          # no count
+    b"\x80",                      # varint cut off
+    b"\xff" * 11,                 # varint longer than 64 bits
+    b"\x01\x00\x05ab",            # path shorter than its length
+    b"\x01\x03\x01a",             # prefix longer than the previous path
+])
+def test_truncated_removed(payload):
+  with pytest.raises(wire.ProtocolError):
+    wire.decode_removed(payload)
+
+
+def test_truncated_entries():
+  frame = wire.encode_entries(_entries(), "sha256")
+  payload = wire.decode_frame(frame)[1]
+  for cut in (1, 5, len(payload) - 1):
+    with pytest.raises(wire.ProtocolError):
+      wire.decode_entries(payload[:cut], "sha256")
+
+
+@pytest.mark.parametrize("body", [
+    b"not gzip at all",
+    zlib.compress(b"y" * 5000)[:-10],   # stream cut off
+])
+def test_corrupt_gzip(body):
+  frame = struct.pack(">IBB", len(body) + 2, wire.ENTRIES, wire.FLAG_GZIP) + body
+  with pytest.raises(wire.ProtocolError):
+    wire.decode_frame(frame)
+  with pytest.raises(wire.ProtocolError):
+    _read(frame)
+
+
+def test_oversize_frame(monkeypatch):
+  header = struct.pack(">IBB", wire.MAX_FRAME + 3, wire.ENTRIES, 0)
+  with pytest.raises(wire.ProtocolError):
+    _read(header)
+  with pytest.raises(wire.ProtocolError):
+    wire.decode_frame(header + b"\0" * 16)
+  # a small payload that inflates past the limit
+  monkeypatch.setattr(wire, "MAX_FRAME", 64 * 1024)
+  frame = wire.encode_frame(wire.ENTRIES, bytes(wire.MAX_FRAME + 1), "gzip")
+  assert len(frame) < wire.MAX_FRAME
+  with pytest.raises(wire.ProtocolError):
+    wire.decode_frame(frame)
+
+
+def test_frame_length_mismatch():
+  frame = wire.encode_frame(wire.END, b"")
+  for bad in (frame[:3], frame + b"\0", struct.pack(">IBB", 1, wire.END, 0)):
+    with pytest.raises(wire.ProtocolError):
+      wire.decode_frame(bad)